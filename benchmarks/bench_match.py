@@ -0,0 +1,70 @@
+"""Measure how the parallel evaluation (``logic.match_many()``) scales with the number of processes (each row goes
+through a pool of that many processes, the first one is the evaluation in the current process).
+
+Usage: ``python benchmarks/bench_match.py [-n DOCUMENTS] [-w 1,2,4,8] [-r REPEAT]``
+"""
+
+import os
+import time
+import random
+import argparse
+import multiprocessing
+import concurrent.futures
+
+from logical_enough import logic
+
+WORDS = [
+    'alpha', 'beta', 'gamma', 'delta', 'epsilon', 'zeta', 'eta', 'theta', 'iota', 'kappa', 'lambda', 'mu', 'nu',
+    'omicron', 'rho', 'sigma', 'tau', 'upsilon', 'phi', 'chi', 'psi', 'omega', 'équipe', 'réseau', 'système'
+]
+
+EXPRESSION = '(alpha OR beta) -gamma "delta epsilon" OR sys* réseau'
+
+
+def make_documents(n: int, length: int = 30, seed: int = 42) -> list:
+    rng = random.Random(seed)
+    return [' '.join(rng.choice(WORDS) for _ in range(length)) for _ in range(n)]
+
+
+def measure(func, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--documents', type=int, default=100000)
+    parser.add_argument('-w', '--workers', default=','.join(
+        str(w) for w in [1, 2, 4, 8, 16] if w <= (os.cpu_count() or 1)) or '1')
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    documents = make_documents(args.documents)
+    expression = logic.parse(EXPRESSION)
+
+    reference = logic.match_many(expression, documents)
+    sequential = measure(lambda: logic.match_many(expression, documents), args.repeat)
+
+    print('{} documents, {} cpu(s), expression: {}'.format(len(documents), os.cpu_count(), EXPRESSION))
+    print('{:>8} {:>10} {:>8} {:>12}'.format('workers', 'time [s]', 'speedup', 'docs/s'))
+    print('{:>8} {:>10.3f} {:>8.2f} {:>12.0f}'.format('-', sequential, 1, len(documents) / sequential))
+
+    for workers in (int(w) for w in args.workers.split(',')):
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+
+            # start the processes (and check the results) first
+            assert logic.match_many(expression, documents, executor, workers) == reference
+
+            duration = measure(lambda: logic.match_many(expression, documents, executor, workers), args.repeat)
+            print('{:>8} {:>10.3f} {:>8.2f} {:>12.0f}'.format(
+                workers, duration, sequential / duration, len(documents) / duration))
+
+
+if __name__ == '__main__':
+    main()
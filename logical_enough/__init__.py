@@ -1,9 +1,12 @@
 import os
+import time
+import asyncio
 import shutil
 import random
+import sqlite3
 import click
 
-from flask import Flask
+from flask import Flask, current_app
 from flask.cli import with_appcontext
 
 from flask_restful import Api
@@ -11,6 +14,7 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_bootstrap import Bootstrap, WebCDN
 
 from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
 from sqlalchemy import event
 
 from logical_enough import settings
@@ -22,11 +26,42 @@ db = SQLAlchemy()
 
 @event.listens_for(Engine, 'connect')
 def set_sqlite_pragma(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+
     cursor = dbapi_connection.cursor()
-    cursor.execute('PRAGMA foreign_keys=ON')
+    for name, value in settings.SQLITE_PRAGMAS.items():
+        cursor.execute('PRAGMA {}={}'.format(name, value))
     cursor.close()
 
 
+def is_locked_error(e):
+    return isinstance(e, OperationalError) and 'database is locked' in str(e.orig)
+
+
+def commit_with_retry(work):
+    """Call ``work()``, which modifies the session, and commit.
+
+    If the database is locked, the session is rolled back and everything is retried (so ``work()`` must redo all its
+    modifications), at most ``DATABASE_LOCK_RETRIES`` times.
+    """
+
+    retries = current_app.config.get('DATABASE_LOCK_RETRIES', 3)
+    delay = current_app.config.get('DATABASE_LOCK_RETRY_DELAY', .05)
+
+    for attempt in range(retries + 1):
+        try:
+            result = work()
+            db.session.commit()
+            return result
+        except OperationalError as e:
+            db.session.rollback()
+            if not is_locked_error(e) or attempt == retries:
+                raise
+
+            time.sleep(delay * 2 ** attempt)
+
+
 @click.command('init')
 @with_appcontext
 def init_command():
@@ -57,6 +92,128 @@ def init_command():
     print('!! Created user', name_admin)
 
 
+@click.command('upgrade')
+@with_appcontext
+def upgrade_command():
+    """Upgrades the schema of an existing database"""
+
+    from logical_enough import models  # noqa
+    from logical_enough.migrations import upgrade_database
+
+    done = upgrade_database()
+
+    for what in done:
+        print('!!', what)
+
+    if not done:
+        print('!! Database is up to date')
+
+
+@click.command('warmup')
+@with_appcontext
+def warmup_command():
+    """Loads the public challenges in the caches, and reports how long it takes"""
+
+    from logical_enough.warmup import warm_up
+
+    report = warm_up(current_app)
+    print('!! Loaded {challenges} challenge(s), {questions} question(s) and {documents} document(s)'.format(**report))
+    print('!! Took {duration:.3f} s and {memory} KiB'.format(**report))
+
+
+@click.command('export')
+@click.argument('name', type=click.Choice(['answers', 'progress', 'users']))
+@click.option('-f', '--format', 'format_', type=click.Choice(['csv', 'jsonl']), default='csv')
+@click.option('-c', '--challenge', type=int, help='only the data of this challenge')
+@click.option('-o', '--output', type=click.File('w'), default='-')
+@with_appcontext
+def export_command(name, format_, challenge, output):
+    """Exports the answers, the progress of the users or the users"""
+
+    from logical_enough.export import generate
+
+    for chunk in generate(name, format_, challenge, current_app.config.get('EXPORT_BATCH_SIZE', 1000)):
+        output.write(chunk)
+
+
+@click.command('import-challenges')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('-n', '--dry-run', is_flag=True, help='only validate')
+@click.option('-j', '--jobs', type=int, help='number of processes for the validation')
+@with_appcontext
+def import_challenges_command(path, dry_run, jobs):
+    """Imports challenges from a JSON or YAML file"""
+
+    from logical_enough.importer import import_challenges, ImportException
+
+    try:
+        report, n = import_challenges(path, dry_run, jobs)
+    except (ImportException, ValueError, OSError) as e:
+        raise click.ClickException(str(e))
+
+    num_errors = 0
+    for entry in report:
+        print('!! {}: {} question(s)'.format(entry['name'], len(entry['questions'])))
+        for error in entry['errors']:
+            print('!!   error:', error)
+            num_errors += 1
+
+    if num_errors > 0:
+        raise click.ClickException('{} error(s), nothing imported'.format(num_errors))
+    elif dry_run:
+        print('!! Dry run, nothing imported')
+    else:
+        print('!! Imported {} challenge(s) and {} question(s)'.format(len(report), n))
+
+
+@click.command('import-users')
+@click.argument('csv_file', type=click.File('r'))
+@click.option('--admin', is_flag=True, help='create admins')
+@with_appcontext
+def import_users_command(csv_file, admin):
+    """Creates the users of a CSV file (one login per line), if they do not exist yet"""
+
+    from logical_enough.importer import read_logins, create_users
+
+    created, skipped = create_users(read_logins(csv_file), is_admin=admin)
+    print('!! Created {} user(s), skipped {} existing one(s)'.format(len(created), len(skipped)))
+
+
+@click.command('rebuild-stats')
+@with_appcontext
+def rebuild_stats_command():
+    """Recomputes the statistics from the answers"""
+
+    from logical_enough import stats
+
+    commit_with_retry(stats.rebuild)
+    print('!! Statistics rebuilt')
+
+
+@click.command('live-server')
+@click.option('--host', default='127.0.0.1')
+@click.option('--port', default=5001, type=int)
+@click.option('--path', default='/live')
+@with_appcontext
+def live_server_command(host, port, path):
+    """Serves the live channel (a WebSocket), to be set in LIVE_SERVER_URL"""
+
+    from logical_enough import live
+
+    async def run():
+        server = await live.serve(current_app._get_current_object(), host, port, path)
+        print('!! Listening on ws://{}:{}{}'.format(host, port, path))
+        try:
+            await server.serve_forever()
+        finally:
+            await server.close()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
 def create_app():
     # app
     app = Flask(__name__)
@@ -65,17 +222,46 @@ def create_app():
     # db
     db.init_app(app)
 
+    from logical_enough import profiling
+    profiling.init_app(app)
+
+    from logical_enough.writer import batch_writer
+    batch_writer.init_app(app)
+
+    from logical_enough import stats
+    from logical_enough.models import Answer
+    batch_writer.after_insert(Answer, stats.record_answers)
+
+    from logical_enough.content import content_cache
+    content_cache.init_app(app)
+
+    from logical_enough.results import results_cache
+    results_cache.init_app(app)
+
+    from logical_enough.offload import offloader
+    offloader.init_app(app)
+
     # bootstrap
     Bootstrap(app)
     app.extensions['bootstrap']['cdns']['jquery'] = WebCDN('//cdnjs.cloudflare.com/ajax/libs/jquery/3.2.1/')
 
     # cli
     app.cli.add_command(init_command)
+    app.cli.add_command(upgrade_command)
+    app.cli.add_command(warmup_command)
+    app.cli.add_command(export_command)
+    app.cli.add_command(import_challenges_command)
+    app.cli.add_command(import_users_command)
+    app.cli.add_command(rebuild_stats_command)
+    app.cli.add_command(live_server_command)
 
     # api
     api = Api(app)
 
     # Views
+    from logical_enough.base_views import PageContextMixin
+    app.teardown_request(PageContextMixin.forget_user)
+
     from logical_enough.visitors import views as user_views
     app.add_url_rule('/', view_func=user_views.IndexPage.as_view('index'))
     app.add_url_rule('/explications.html', view_func=user_views.ExplainPage.as_view('explain'))
@@ -93,6 +279,12 @@ def create_app():
     from logical_enough.visitors import views_api
     api.add_resource(views_api.CheckMatch, '/api/checks')
     api.add_resource(views_api.CheckMatchMany, '/api/checks_many')
+    api.add_resource(views_api.CheckMatchStream, '/api/checks_stream')
     api.add_resource(views_api.CheckQuestion, '/api/check_question')
 
+    # preload the challenges (before gunicorn forks the workers, with `--preload`)
+    if app.config.get('WARMUP', False):
+        from logical_enough.warmup import warm_up
+        warm_up(app)
+
     return app
@@ -1,13 +1,39 @@
+import json
+
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileField, FileRequired
 import wtforms as f
 
 
+def split_documents(value):
+    """Get the list of documents out of the ``documents`` field of ``QuestionForm``, which is a JSON list
+    (or, for compatibility, the documents separated by ``;``)
+    """
+
+    if value.startswith('['):
+        try:
+            documents = json.loads(value)
+        except ValueError:
+            pass
+        else:
+            if type(documents) is list:
+                return [str(d) for d in documents]
+
+    return value.split(';')
+
+
 class UserForm(FlaskForm):
     login = f.StringField('Login', validators=[f.validators.InputRequired()])
     is_admin = f.BooleanField('Est admin')
     add_button = f.SubmitField('Ajouter un nouvel utilisateur')
 
 
+class UsersImportForm(FlaskForm):
+    logins = FileField('Fichier CSV (un login par ligne)', validators=[FileRequired()])
+    is_admin = f.BooleanField('Sont admins')
+    import_button = f.SubmitField('Ajouter les utilisateurs')
+
+
 class ChallengeForm(FlaskForm):
     name = f.StringField('Nom du challenge', validators=[f.validators.InputRequired()])
     add_button = f.SubmitField('Ajouter un nouveau challenge')
@@ -18,3 +44,9 @@ class QuestionForm(FlaskForm):
     hint = f.TextAreaField('Aide')
     documents = f.StringField('Documents')
     add_button = f.SubmitField('Valider')
+
+
+class ReorderForm(FlaskForm):
+    order = f.StringField('Ordre des questions (identifiants séparés par des virgules)', validators=[
+        f.validators.InputRequired()])
+    reorder_button = f.SubmitField('Réordonner')
@@ -1,11 +1,16 @@
+import csv
+import json
+
 import flask
 from flask import Blueprint
 from flask.views import MethodView
 
-from logical_enough import db, logic
-from logical_enough.admin.forms import UserForm, ChallengeForm, QuestionForm
-from logical_enough.models import User, Challenge, Question, Answer
-from logical_enough.base_views import RenderTemplateView, FormView, GetObjectMixin, DeleteView, PageContextMixin
+from logical_enough import db, logic, profiling, content, export, importer, stats
+from logical_enough.admin.forms import UserForm, UsersImportForm, ChallengeForm, QuestionForm, ReorderForm, \
+    split_documents
+from logical_enough.models import User, Challenge, Question, Answer, QuestionStats, ChallengeStats
+from logical_enough.base_views import RenderTemplateView, FormView, GetObjectMixin, DeleteView, PageContextMixin, \
+    KeysetPaginationMixin
 
 
 admin_blueprint = Blueprint('admin', __name__, url_prefix='/admin')
@@ -16,19 +21,28 @@ class AdminContextMixin(PageContextMixin):
 
 
 # --- Users
-class AdminUsersPage(AdminContextMixin, FormView):
+class AdminUsersPage(AdminContextMixin, KeysetPaginationMixin, FormView):
     form_class = UserForm
     template_name = 'admin/users.html'
 
+    sort_columns = {'id': User.id, 'name': User.name}
+    default_sort = 'name'
+    filter_key = 'name'
+
+    def get_query(self):
+        return User.query
+
     def get_context_data(self, *args, **kwargs):
         context = super().get_context_data(*args, **kwargs)
 
-        context['users'] = User.query.all()
+        if 'import_form' not in context:
+            context['import_form'] = UsersImportForm()
+
         return context
 
     def form_valid(self, form):
 
-        if User.query.filter(User.name.is_(form.login.data)).count() > 0:
+        if User.query.filter(User.name == form.login.data).count() > 0:
             flask.flash("Impossible d'ajouter 2 fois la même personne", 'error')
             return super().form_invalid(form)
 
@@ -45,6 +59,40 @@ class AdminUsersPage(AdminContextMixin, FormView):
 admin_blueprint.add_url_rule('/utilisateurs.html', view_func=AdminUsersPage.as_view('users'))
 
 
+class AdminUsersImport(AdminContextMixin, FormView):
+    form_class = UsersImportForm
+    modal_form = True
+
+    def get(self, *args, **kwargs):
+        return flask.redirect(flask.url_for('admin.users'))
+
+    def post(self, *args, **kwargs):
+        self.success_url = self.failure_url = flask.url_for('admin.users')
+        return super().post(*args, **kwargs)
+
+    def form_valid(self, form):
+        try:
+            logins = importer.read_logins(form.logins.data.read().decode('utf-8-sig').splitlines())
+        except (UnicodeDecodeError, csv.Error):
+            flask.flash('Impossible de lire le fichier', 'error')
+            return self.form_invalid(form)
+
+        created, skipped = importer.create_users(logins, is_admin=form.is_admin.data)
+
+        flask.flash('{} personne(s) ajoutée(s), {} déjà existante(s)'.format(len(created), len(skipped)), 'success')
+        return super().form_valid(form)
+
+    def form_invalid(self, form):
+        for errors in form.errors.values():
+            for error in errors:
+                flask.flash(error, 'error')
+
+        return super().form_invalid(form)
+
+
+admin_blueprint.add_url_rule('/utilisateurs-import.html', view_func=AdminUsersImport.as_view('users-import'))
+
+
 class AdminUsersDelete(AdminContextMixin, DeleteView):
     model = User
 
@@ -65,24 +113,25 @@ admin_blueprint.add_url_rule('/utilisateur-del-<int:id>.html', view_func=AdminUs
 
 
 # -- Challenge
-class AdminChallengesPage(AdminContextMixin, FormView):
+class AdminChallengesPage(AdminContextMixin, KeysetPaginationMixin, FormView):
     form_class = ChallengeForm
     template_name = 'admin/challenges.html'
 
-    def get_context_data(self, *args, **kwargs):
-        context = super().get_context_data(*args, **kwargs)
+    sort_columns = {'id': Challenge.id, 'name': Challenge.name}
+    filter_key = 'name'
 
-        context['challenges'] = Challenge.query.all()
-        return context
+    def get_query(self):
+        return Challenge.query
 
     def form_valid(self, form):
 
-        if Challenge.query.filter(Challenge.name.is_(form.name.data)).count() > 0:
+        if Challenge.query.filter(Challenge.name == form.name.data).count() > 0:
             flask.flash("Impossible d'ajouter 2 fois le même challenge", 'error')
             return super().form_invalid(form)
 
         challenge = Challenge(form.name.data)
         db.session.add(challenge)
+        content.invalidate()
         db.session.commit()
 
         flask.flash('Challenge créé', 'success')
@@ -97,6 +146,9 @@ admin_blueprint.add_url_rule('/challenges.html', view_func=AdminChallengesPage.a
 class AdminChallengeDelete(AdminContextMixin, DeleteView):
     model = Challenge
 
+    def pre_commit(self, obj):
+        content.invalidate()
+
     def delete(self, *args, **kwargs):
         self.success_url = flask.url_for('admin.challenges')
         flask.flash('Challenge supprimé', 'success')
@@ -116,6 +168,7 @@ class AdminChallengeToggle(AdminContextMixin, MethodView):
         if challenge is not None:
             challenge.is_public = not challenge.is_public
             db.session.add(challenge)
+            content.invalidate()
             db.session.commit()
         else:
             flask.flash("Ce challenge n'existe pas")
@@ -135,7 +188,10 @@ class AdminChallengePage(AdminContextMixin, GetObjectMixin, RenderTemplateView):
 
     def get_context_data(self, *args, **kwargs):
         context = super().get_context_data(*args, **kwargs)
-        context['questions'] = Question.query.filter(Question.challenge.is_(self.object.id))
+        context['questions'] = self.object.get_questions()
+
+        if 'reorder_form' not in context:
+            context['reorder_form'] = ReorderForm(order=','.join(str(q.id) for q in context['questions']))
 
         return context
 
@@ -143,6 +199,65 @@ class AdminChallengePage(AdminContextMixin, GetObjectMixin, RenderTemplateView):
 admin_blueprint.add_url_rule('/challenge-<int:id>.html', view_func=AdminChallengePage.as_view('challenge'))
 
 
+class AdminChallengeStatsPage(AdminContextMixin, GetObjectMixin, RenderTemplateView):
+
+    template_name = 'admin/challenge-stats.html'
+    model = Challenge
+    context_object_name = 'challenge'
+
+    def get_context_data(self, *args, **kwargs):
+        context = super().get_context_data(*args, **kwargs)
+        context['questions'] = self.object.get_questions()
+        context['question_stats'] = dict(
+            (s.question, s) for s in QuestionStats.query.filter(QuestionStats.challenge == self.object.id))
+        context['challenge_stats'] = ChallengeStats.query.filter(ChallengeStats.challenge == self.object.id).first()
+        context['leaderboard'] = stats.leaderboard(self.object.id)
+
+        return context
+
+
+admin_blueprint.add_url_rule(
+    '/challenge-<int:id>/statistiques.html', view_func=AdminChallengeStatsPage.as_view('challenge-stats'))
+
+
+class AdminChallengeReorder(AdminContextMixin, GetObjectMixin, FormView):
+    model = Challenge
+    context_object_name = 'challenge'
+    form_class = ReorderForm
+    modal_form = True
+
+    def get(self, *args, **kwargs):
+        return flask.redirect(flask.url_for('admin.challenge', id=self.get_object(*args, **kwargs).id))
+
+    def post(self, *args, **kwargs):
+        self.get_object(*args, **kwargs)
+        self.success_url = self.failure_url = flask.url_for('admin.challenge', id=self.object.id)
+        return super().post(*args, **kwargs)
+
+    def form_valid(self, form):
+        try:
+            order = [int(i) for i in form.order.data.split(',')]
+        except ValueError:
+            flask.flash('Ordre incorrect', 'error')
+            return self.form_invalid(form)
+
+        ids = [i for i, in db.session.query(Question.id).filter(Question.challenge == self.object.id)]
+        if len(order) != len(ids) or set(order) != set(ids):
+            flask.flash("L'ordre doit contenir chaque question du challenge une et une seule fois", 'error')
+            return self.form_invalid(form)
+
+        self.object.renumber_questions(order)
+        content.invalidate()
+        db.session.commit()
+
+        flask.flash('Questions réordonnées', 'success')
+        return super().form_valid(form)
+
+
+admin_blueprint.add_url_rule(
+    '/challenge-<int:id>/ordre.html', view_func=AdminChallengeReorder.as_view('challenge-reorder'))
+
+
 # -- Questions
 class AdminCreateQuestionPage(AdminContextMixin, GetObjectMixin, FormView):
     template_name = 'admin/question-create.html'
@@ -161,6 +276,9 @@ class AdminCreateQuestionPage(AdminContextMixin, GetObjectMixin, FormView):
             return self.form_invalid(form)
 
         db.session.add(q)
+        db.session.flush()
+        self.object.renumber_questions()
+        content.invalidate()
         db.session.commit()
 
         self.success_url = flask.url_for('admin.challenge', id=self.object.id)
@@ -186,9 +304,10 @@ class AdminQuestionPage(AdminContextMixin, GetObjectMixin, FormView):
         if obj.challenge != kwargs.get('challenge_id', -1):
             flask.abort(404)
 
-        self.challenge = Challenge.query.filter(Challenge.id.is_(obj.challenge)).first()
         if self.challenge is None:
-            flask.abort(404)
+            self.challenge = Challenge.query.get(obj.challenge)
+            if self.challenge is None:
+                flask.abort(404)
 
         return obj
 
@@ -204,7 +323,7 @@ class AdminQuestionPage(AdminContextMixin, GetObjectMixin, FormView):
         return {
             'hint_expr': self.object.hint_expr,
             'hint': self.object.hint,
-            'documents': ';'.join(self.object.get_documents())
+            'documents': json.dumps(self.object.get_documents())
         }
 
     def get_context_data(self, *args, **kwargs):
@@ -220,15 +339,7 @@ class AdminQuestionPage(AdminContextMixin, GetObjectMixin, FormView):
             flask.flash('Erreur du parser: "{}"'.format(e), 'error')
             return None
 
-        documents = form.data.get('documents').split(';')
-        good_docs = []
-        wrong_docs = []
-
-        for d in documents:
-            if search_expression.match(logic.analyze(d)):
-                good_docs.append(d)
-            else:
-                wrong_docs.append(d)
+        good_docs, wrong_docs = logic.classify(search_expression, split_documents(form.data.get('documents')))
 
         if len(good_docs) == 0:
             flask.flash('Il doit y avoir au moins un bon document', 'error')
@@ -237,7 +348,7 @@ class AdminQuestionPage(AdminContextMixin, GetObjectMixin, FormView):
         if obj is None:
             obj = Question(
                 challenge=challenge.id,
-                position=Challenge.query.count(),
+                position=Question.query.filter(Question.challenge == challenge.id).count(),  # last one
                 wrong_docs=wrong_docs,
                 good_docs=good_docs,
                 hint=form.data.get('hint'),
@@ -246,8 +357,7 @@ class AdminQuestionPage(AdminContextMixin, GetObjectMixin, FormView):
 
             flask.flash('Question ajoutée', 'success')
         else:
-            obj.wrong_documents = ';'.join(wrong_docs)
-            obj.good_documents = ';'.join(good_docs)
+            obj.set_documents(good_docs, wrong_docs)
             obj.hint = form.data.get('hint')
             obj.hint_expr = str(search_expression)
 
@@ -261,6 +371,7 @@ class AdminQuestionPage(AdminContextMixin, GetObjectMixin, FormView):
             return self.form_invalid(form)
 
         db.session.add(q)
+        content.invalidate()
         db.session.commit()
         self.success_url = flask.url_for('admin.challenge', id=self.challenge.id)
 
@@ -281,6 +392,11 @@ class AdminQuestionDelete(AdminContextMixin, DeleteView):
         self.success_url = flask.url_for('admin.challenge', id=self.object.challenge)
         return True
 
+    def pre_commit(self, obj):
+        # in the same transaction as the deletion, so that the next question pointers are never left cleared
+        Question.renumber(obj.challenge)
+        content.invalidate()
+
     def delete(self, *args, **kwargs):
         flask.flash('Question supprimée', 'success')
         return super().delete(*args, **kwargs)
@@ -291,11 +407,15 @@ admin_blueprint.add_url_rule(
     view_func=AdminQuestionDelete.as_view('question-delete'))
 
 
-class AdminViewAnswersPage(AdminContextMixin, GetObjectMixin, RenderTemplateView):
+class AdminViewAnswersPage(AdminContextMixin, KeysetPaginationMixin, GetObjectMixin, RenderTemplateView):
     model = Question
     context_object_name = 'question'
     template_name = 'admin/answers.html'
 
+    sort_columns = {'id': Answer.id, 'user_name': User.name}
+    default_sort = '-id'
+    filter_key = 'user_name'
+
     challenge = None
 
     def get_object(self, *args, **kwargs):
@@ -304,21 +424,59 @@ class AdminViewAnswersPage(AdminContextMixin, GetObjectMixin, RenderTemplateView
         if obj.challenge != kwargs.get('challenge_id', -1):
             flask.abort(404)
 
-        self.challenge = Challenge.query.filter(Challenge.id.is_(obj.challenge)).first()
         if self.challenge is None:
-            flask.abort(404)
+            self.challenge = Challenge.query.get(obj.challenge)
+            if self.challenge is None:
+                flask.abort(404)
 
         return obj
 
     def get_context_data(self, *args, **kwargs):
         context = super().get_context_data(*args, **kwargs)
         context['challenge'] = self.challenge
-        context['answers'] = Answer.query.filter(Answer.question.is_(self.object.id)).all()
-        context['users'] = dict((u.id, u) for u in User.query.all())
 
         return context
 
+    def get_query(self):
+        return db.session.query(Answer.id, Answer.date_created, Answer.answer, User.name.label('user_name'))\
+            .outerjoin(User, User.id == Answer.user)\
+            .filter(Answer.question == self.object.id)\
+            .filter(Answer.is_correct.is_(True))
+
 
 admin_blueprint.add_url_rule(
     '/challenge-<int:challenge_id>/question-<int:id>-réponses.html',
     view_func=AdminViewAnswersPage.as_view('question-answers'))
+
+
+# -- Exports
+class AdminExportPage(AdminContextMixin, MethodView):
+
+    def get(self, name, format_):
+        """Stream an export (``?challenge=`` to only get the ones of a challenge)"""
+
+        if name not in export.EXPORTS or format_ not in export.FORMATS:
+            flask.abort(404)
+
+        lines = export.generate(
+            name,
+            format_,
+            challenge_id=flask.request.args.get('challenge', type=int),
+            batch_size=flask.current_app.config.get('EXPORT_BATCH_SIZE', 1000))
+
+        response = flask.Response(flask.stream_with_context(lines), mimetype=export.FORMATS[format_])
+        response.headers['Content-Disposition'] = 'attachment; filename={}.{}'.format(name, format_)
+        return response
+
+
+admin_blueprint.add_url_rule('/export/<name>.<format_>', view_func=AdminExportPage.as_view('export'))
+
+
+# -- Metrics
+class AdminMetricsPage(AdminContextMixin, MethodView):
+
+    def get(self, *args, **kwargs):
+        return flask.jsonify(profiling.collect_metrics())
+
+
+admin_blueprint.add_url_rule('/metrics.json', view_func=AdminMetricsPage.as_view('metrics'))
@@ -1,9 +1,11 @@
 import functools
+import collections
 
 import flask
 from flask.views import MethodView
+from sqlalchemy import or_, and_
 
-from logical_enough import db
+from logical_enough import db, commit_with_retry
 from logical_enough.models import User
 
 
@@ -114,6 +116,12 @@ class DeleteView(GetObjectMixin, MethodView):
         """
         return True
 
+    def pre_commit(self, obj):
+        """Performs an action along with the deletion, in the same transaction (updates what depends on the object,
+        for example). Note: it may be called again if the database is locked.
+        """
+        pass
+
     def post_deletion(self, obj):
         """Performs an action after deletion from database"""
         pass
@@ -129,18 +137,102 @@ class DeleteView(GetObjectMixin, MethodView):
         if not self.pre_deletion(obj, *args, **kwargs):
             return flask.abort(403)
 
-        db.session.delete(obj)
-        db.session.commit()
+        def delete_object():
+            db.session.delete(obj)
+            self.pre_commit(obj)
+
+        commit_with_retry(delete_object)
 
         self.post_deletion(obj)
 
         return flask.redirect(self.success_url)
 
 
+# a page of a listing, and the URL arguments of the next one (if any)
+Page = collections.namedtuple('Page', ['items', 'next_args', 'sort', 'filter'])
+
+
+class KeysetPaginationMixin:
+    """Paginate a listing, by ``per_page`` rows (``PAGE_SIZE`` if not set).
+
+    The next page is the one that comes after the last row, which is fetched with ``WHERE (key, id) > (?, ?)``
+    rather than an ``OFFSET``, so it does not get slower with the page number (as long as the key is indexed).
+
+    The listing is sorted (``?tri=<key>``, or ``?tri=-<key>`` for the descending order) on one of ``sort_columns``
+    (the keys of which are also the attributes of the rows), the ties being broken by ``sort_columns['id']``,
+    and filtered (``?q=``) on the values of ``sort_columns[filter_key]`` that contain the string.
+    """
+
+    per_page = None
+    sort_columns = {}
+    default_sort = 'id'
+    filter_key = None
+
+    def get_query(self):
+        raise NotImplementedError()
+
+    def get_page(self) -> Page:
+        args = flask.request.args
+
+        sort = args.get('tri', self.default_sort)
+        if sort.lstrip('-') not in self.sort_columns:
+            sort = self.default_sort
+
+        key = sort.lstrip('-')
+        column, id_column = self.sort_columns[key], self.sort_columns['id']
+        descending = sort.startswith('-')
+
+        query = self.get_query()
+
+        filter_ = args.get('q', '').strip()
+        if filter_ and self.filter_key is not None:
+            query = query.filter(self.sort_columns[self.filter_key].contains(filter_, autoescape=True))
+
+        after_id = args.get('apres_id', type=int)
+        if after_id is not None:
+            if key == 'id':
+                query = query.filter(id_column < after_id if descending else id_column > after_id)
+            else:
+                try:
+                    after = column.type.python_type(args.get('apres', ''))
+                except ValueError:
+                    flask.abort(400)
+
+                if descending:
+                    query = query.filter(or_(column < after, and_(column == after, id_column < after_id)))
+                else:
+                    query = query.filter(or_(column > after, and_(column == after, id_column > after_id)))
+
+        if descending:
+            query = query.order_by(column.desc(), id_column.desc())
+        else:
+            query = query.order_by(column, id_column)
+
+        per_page = self.per_page or flask.current_app.config.get('PAGE_SIZE', 50)
+        items = query.limit(per_page + 1).all()
+
+        next_args = None
+        if len(items) > per_page:
+            items = items[:per_page]
+            next_args = {'tri': sort, 'q': filter_, 'apres': getattr(items[-1], key), 'apres_id': items[-1].id}
+
+        return Page(items, next_args, sort, filter_)
+
+    def get_context_data(self, *args, **kwargs):
+        context = super().get_context_data(*args, **kwargs)
+        context['page'] = self.get_page()
+        return context
+
+
+# identity of the logged in user, as stored in the (signed) session cookie
+SessionUser = collections.namedtuple('SessionUser', ['id', 'name', 'is_admin'])
+
+
 class PageContextMixin:
     """Maintain the logged_in information in context"""
 
     LOGIN_VAR = 'logged_user'
+    IDENTITY_VAR = 'identity'
 
     def get_context_data(self, *args, **kwargs):
         context = super().get_context_data(*args, **kwargs)
@@ -149,32 +241,62 @@ class PageContextMixin:
         return context
 
     @staticmethod
-    def get_user():
-        """Get logged in user"""
+    def get_user(from_database=False):
+        """Get logged in user (memoized for the request).
 
-        if PageContextMixin.LOGIN_VAR in flask.session:
-            return User.query\
-                .filter(User.id.is_(flask.session[PageContextMixin.LOGIN_VAR]))\
+        If ``SESSION_IDENTITY`` is set, a ``SessionUser`` is built from the session instead of querying the
+        database, unless ``from_database`` is set.
+        """
+
+        if PageContextMixin.LOGIN_VAR not in flask.session:
+            return None
+
+        if PageContextMixin.LOGIN_VAR in flask.g:
+            user = flask.g.get(PageContextMixin.LOGIN_VAR)
+            if not from_database or not isinstance(user, SessionUser):
+                return user
+
+        if not from_database and flask.current_app.config.get('SESSION_IDENTITY', False) \
+                and PageContextMixin.IDENTITY_VAR in flask.session:
+            user = SessionUser(*flask.session[PageContextMixin.IDENTITY_VAR])
+        else:
+            user = User.query\
+                .filter(User.id == flask.session[PageContextMixin.LOGIN_VAR])\
                 .first()
 
-        return None
+        setattr(flask.g, PageContextMixin.LOGIN_VAR, user)
+        return user
+
+    @staticmethod
+    def forget_user(exc=None):
+        """Drop the memoized user (at the end of the request, or when it changes)"""
+
+        flask.g.pop(PageContextMixin.LOGIN_VAR, None)
 
     @staticmethod
     def login_user(eid):
-        user = User.query.filter(User.name.is_(eid)).first()
+        user = User.query.filter(User.name == eid).first()
 
         if user is None:
             flask.flash("Tu n'existes pas, va t'en !", 'error')
             return None
 
         flask.session[PageContextMixin.LOGIN_VAR] = user.id
+        flask.session[PageContextMixin.IDENTITY_VAR] = [user.id, user.name, user.is_admin]
         if user.is_admin:
             flask.session['is_admin'] = True
         else:
             flask.session['is_admin'] = False
 
+        setattr(flask.g, PageContextMixin.LOGIN_VAR, user)
         return user
 
+    @staticmethod
+    def logout_user():
+        flask.session.pop(PageContextMixin.LOGIN_VAR, None)
+        flask.session.pop(PageContextMixin.IDENTITY_VAR, None)
+        PageContextMixin.forget_user()
+
     @staticmethod
     def login_required(f):
         @functools.wraps(f)
@@ -186,9 +308,12 @@ class PageContextMixin:
 
     @staticmethod
     def admin_required(f):
+        """Check that the user is (still) an admin, always against the database"""
+
         @functools.wraps(f)
         def decorated_function(*args, **kwargs):
-            if 'is_admin' not in flask.session or not flask.session['is_admin']:
+            user = PageContextMixin.get_user(from_database=True)
+            if user is None or not user.is_admin:
                 return flask.abort(403)
             return f(*args, **kwargs)
         return decorated_function
@@ -0,0 +1,269 @@
+import os
+import time
+import pickle
+import sqlite3
+import hashlib
+import logging
+import threading
+import collections
+
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache:
+    """A (thread-safe) mapping with a maximum size, which drops the least recently used entries first"""
+
+    MISSING = object()
+
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.RLock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        with self.lock:
+            value = self.entries.get(key, LRUCache.MISSING)
+            if value is LRUCache.MISSING:
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value) -> None:
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def get_or_set(self, key, func):
+        """Get the value of ``key``, or set it to ``func()`` if it is not there"""
+
+        value = self.get(key, LRUCache.MISSING)
+        if value is LRUCache.MISSING:
+            value = func()
+            self.set(key, value)
+
+        return value
+
+    def delete(self, key) -> None:
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> dict:
+        return {'size': len(self), 'max_size': self.max_size, 'hits': self.hits, 'misses': self.misses}
+
+
+class SQLiteCache:
+    """A cache shared by all the processes of the machine (e.g. the gunicorn workers), stored in a SQLite file.
+
+    Values are pickled, and expire after ``ttl`` seconds. Every ``EVICTION_INTERVAL`` insertions, the expired entries
+    are dropped, then the ones that expire first if there is more than ``max_size`` entries.
+    Since it is only a cache, errors are logged (and counted) but never raised.
+
+    ``path`` can be a function, so that it is only resolved when connecting.
+    """
+
+    EVICTION_INTERVAL = 100
+
+    def __init__(self, path, max_size: int = 100000, ttl: float = 7 * 24 * 3600):
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self.local = threading.local()
+
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.insertions = 0
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """Connection of the current thread (a connection does not survive a fork)"""
+
+        path = self.path() if callable(self.path) else self.path
+        if getattr(self.local, 'key', None) != (os.getpid(), path):
+            connection = sqlite3.connect(path, timeout=1, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=OFF')
+            connection.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, expires REAL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS ix_cache_expires ON cache (expires)')
+
+            self.local.connection = connection
+            self.local.key = (os.getpid(), path)
+
+        return self.local.connection
+
+    @staticmethod
+    def make_key(key) -> str:
+        return hashlib.sha256(repr(key).encode()).hexdigest()
+
+    def get(self, key, default=None):
+        try:
+            row = self.connection.execute(
+                'SELECT value FROM cache WHERE key = ? AND expires > ?', (self.make_key(key), time.time())).fetchone()
+
+            if row is not None:
+                value = pickle.loads(row[0])
+                self.hits += 1
+                return value
+        except (sqlite3.Error, pickle.UnpicklingError, AttributeError, EOFError):
+            self.errors += 1
+            logger.exception('unable to get {} from the cache'.format(repr(key)))
+
+        self.misses += 1
+        return default
+
+    def set(self, key, value) -> None:
+        try:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)',
+                (self.make_key(key), pickle.dumps(value, pickle.HIGHEST_PROTOCOL), time.time() + self.ttl))
+
+            self.insertions += 1
+            if self.insertions % self.EVICTION_INTERVAL == 0:
+                self.evict()
+        except (sqlite3.Error, pickle.PicklingError, RecursionError):
+            self.errors += 1
+            logger.exception('unable to put {} in the cache'.format(repr(key)))
+
+    def evict(self) -> None:
+        connection = self.connection
+        connection.execute('DELETE FROM cache WHERE expires <= ?', (time.time(), ))
+
+        n = connection.execute('SELECT COUNT(*) FROM cache').fetchone()[0] - self.max_size
+        if n > 0:
+            connection.execute('DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY expires LIMIT ?)', (n, ))
+
+    def delete(self, key) -> None:
+        self.connection.execute('DELETE FROM cache WHERE key = ?', (self.make_key(key), ))
+
+    def clear(self) -> None:
+        self.connection.execute('DELETE FROM cache')
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+
+    def stats(self) -> dict:
+        return {'max_size': self.max_size, 'hits': self.hits, 'misses': self.misses, 'errors': self.errors}
+
+
+class TieredCache:
+    """An in-memory cache (``local``, private to the process), in front of a slower but shared one (``shared``,
+    if any). Any object with the ``get()``, ``set()``, ``delete()``, ``clear()`` and ``stats()`` methods of
+    ``LRUCache`` can be used as a tier.
+    """
+
+    def __init__(self, local, shared=None):
+        self.local = local
+        self.shared = shared
+
+    def get(self, key, default=None):
+        value = self.local.get(key, LRUCache.MISSING)
+        if value is not LRUCache.MISSING:
+            return value
+
+        if self.shared is not None:
+            value = self.shared.get(key, LRUCache.MISSING)
+            if value is not LRUCache.MISSING:
+                self.local.set(key, value)
+                return value
+
+        return default
+
+    def set(self, key, value) -> None:
+        self.local.set(key, value)
+        if self.shared is not None:
+            self.shared.set(key, value)
+
+    def get_or_set(self, key, func):
+        """Get the value of ``key``, or set it to ``func()`` (in both tiers) if it is not there"""
+
+        value = self.get(key, LRUCache.MISSING)
+        if value is LRUCache.MISSING:
+            value = func()
+            self.set(key, value)
+
+        return value
+
+    def delete(self, key) -> None:
+        self.local.delete(key)
+        if self.shared is not None:
+            self.shared.delete(key)
+
+    def clear(self) -> None:
+        self.local.clear()
+        if self.shared is not None:
+            self.shared.clear()
+
+    def stats(self) -> dict:
+        return {
+            'local': self.local.stats(),
+            'shared': self.shared.stats() if self.shared is not None else None
+        }
+
+
+class SingleFlight:
+    """Coalesce the concurrent computations of the same value: while ``func()`` runs for ``key``, the other threads
+    that ask for ``key`` wait for its result (or its exception) instead of computing it again.
+
+    Nothing is kept once the computation is done (this is not a cache).
+    """
+
+    class Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.exception = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+        self.executed = 0
+        self.shared = 0
+
+    def do(self, key, func):
+        with self.lock:
+            call = self.calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self.calls[key] = SingleFlight.Call()
+                self.executed += 1
+            else:
+                self.shared += 1
+
+        if not is_leader:
+            call.done.wait()
+            if call.exception is not None:
+                raise call.exception
+            return call.result
+
+        try:
+            call.result = func()
+            return call.result
+        except Exception as e:
+            call.exception = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+    def stats(self) -> dict:
+        return {'in_flight': len(self.calls), 'executed': self.executed, 'shared': self.shared}
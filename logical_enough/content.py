@@ -0,0 +1,156 @@
+import collections
+
+import flask
+
+from logical_enough import db, profiling
+from logical_enough.cache import LRUCache
+from logical_enough.models import Challenge, Question, Document, ContentVersion
+
+
+ChallengeInfo = collections.namedtuple('ChallengeInfo', ['id', 'name', 'is_public', 'question_count'])
+QuestionInfo = collections.namedtuple(
+    'QuestionInfo', ['id', 'challenge', 'position', 'next_question', 'hint', 'hint_expr'])
+DocumentInfo = collections.namedtuple('DocumentInfo', ['content', 'is_good', 'content_hash'])
+
+
+class VersionedCache(LRUCache):
+    """A cache which is dropped when the version of its content changes.
+
+    The version is stored in the database and checked (at most) once per request, so the admin views bump it in the
+    same transaction as their modifications, and every worker notices it.
+    """
+
+    def __init__(self, name: str, max_size: int = 1024):
+        super().__init__(max_size)
+        self.name = name
+        self.version = None
+
+    @property
+    def _flag(self):
+        return '_{}_version_checked'.format(self.name)
+
+    def check_version(self):
+        """Drop the content if its version changed, and get the version (the one seen by the request, if any)"""
+
+        if flask.has_request_context() and self._flag in flask.g:
+            return flask.g.get(self._flag)
+
+        version = ContentVersion.get(self.name)
+        with self.lock:
+            if version != self.version:
+                self.clear()
+                self.version = version
+
+        if flask.has_request_context():
+            setattr(flask.g, self._flag, version)
+
+        return version
+
+    def set(self, key, value, version=None) -> None:
+        """Set ``key``, unless the content moved to another version than ``version`` (when the value was loaded)"""
+
+        with self.lock:
+            if version is None or version == self.version:
+                super().set(key, value)
+
+    def get_or_set(self, key, func):
+        version = self.check_version()
+
+        value = self.get(key, LRUCache.MISSING)
+        if value is LRUCache.MISSING:
+            value = func()
+            self.set(key, value, version)
+
+        return value
+
+    def bump(self) -> None:
+        """Invalidate the content (the change is only visible once the session is committed)"""
+
+        ContentVersion.bump(self.name)
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        stats['version'] = self.version
+        return stats
+
+    def init_app(self, app):
+        self.max_size = app.config.get('CONTENT_CACHE_SIZE', self.max_size)
+        profiling.register_metrics('{}_cache'.format(self.name), self.stats)
+
+        @app.teardown_request
+        def reset_version_checked(exc=None):
+            flask.g.pop(self._flag, None)
+
+
+# read-through cache of the (rarely modified) challenges, questions and documents, as immutable tuples
+content_cache = VersionedCache('content')
+
+
+def _challenge_info(challenge):
+    return ChallengeInfo(challenge.id, challenge.name, challenge.is_public, challenge.question_count)
+
+
+def _question_info(question):
+    return QuestionInfo(
+        question.id, question.challenge, question.position, question.next_question, question.hint, question.hint_expr)
+
+
+def get_public_challenges() -> list:
+    return content_cache.get_or_set(('public_challenges', ), lambda: [
+        _challenge_info(c) for c in Challenge.query.filter(Challenge.is_public.is_(True)).order_by(Challenge.id)
+    ])
+
+
+def get_challenge(challenge_id: int):
+    """Get a challenge (or ``None`` if it does not exists)"""
+
+    def load():
+        challenge = Challenge.query.get(challenge_id)
+        return _challenge_info(challenge) if challenge is not None else None
+
+    return content_cache.get_or_set(('challenge', challenge_id), load)
+
+
+def get_questions(challenge_id: int) -> list:
+    """Get the questions of a challenge, in order"""
+
+    version = content_cache.check_version()
+
+    def load():
+        questions = db.session.query(
+            Question.id, Question.challenge, Question.position, Question.next_question, Question.hint,
+            Question.hint_expr)\
+            .filter(Question.challenge == challenge_id)\
+            .order_by(Question.position)
+
+        questions = [QuestionInfo(*q) for q in questions]
+        for question in questions:  # they will be needed one by one as well
+            content_cache.set(('question', question.id), question, version)
+
+        return questions
+
+    return content_cache.get_or_set(('questions', challenge_id), load)
+
+
+def get_question(question_id: int):
+    """Get a question (or ``None`` if it does not exists)"""
+
+    def load():
+        question = Question.query.get(question_id)
+        return _question_info(question) if question is not None else None
+
+    return content_cache.get_or_set(('question', question_id), load)
+
+
+def get_documents(question_id: int) -> list:
+    """Get the documents of a question, in order"""
+
+    return content_cache.get_or_set(('documents', question_id), lambda: [
+        DocumentInfo(*d) for d in db.session.query(Document.content, Document.is_good, Document.content_hash)
+        .filter(Document.question == question_id)
+        .order_by(Document.position)
+    ])
+
+
+def invalidate() -> None:
+    content_cache.bump()
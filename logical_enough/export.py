@@ -0,0 +1,111 @@
+import io
+import csv
+import json
+
+from logical_enough import db
+from logical_enough.models import User, Challenge, Question, UserChallenge, Answer
+
+
+def answers_query(challenge_id: int = None):
+    query = db.session.query(
+        Answer.id,
+        Answer.date_created,
+        User.name.label('user'),
+        Challenge.name.label('challenge'),
+        Question.position.label('question'),
+        Answer.answer,
+        Answer.is_correct,
+        Answer.duration)\
+        .outerjoin(User, User.id == Answer.user)\
+        .join(Question, Question.id == Answer.question)\
+        .join(Challenge, Challenge.id == Question.challenge)\
+        .order_by(Answer.id)
+
+    if challenge_id is not None:
+        query = query.filter(Question.challenge == challenge_id)
+
+    return query
+
+
+def progress_query(challenge_id: int = None):
+    query = db.session.query(
+        UserChallenge.id,
+        User.name.label('user'),
+        Challenge.name.label('challenge'),
+        UserChallenge.is_done,
+        UserChallenge.current_position,
+        Challenge.question_count,
+        UserChallenge.date_created,
+        UserChallenge.date_modified)\
+        .join(User, User.id == UserChallenge.user)\
+        .join(Challenge, Challenge.id == UserChallenge.challenge)\
+        .order_by(UserChallenge.id)
+
+    if challenge_id is not None:
+        query = query.filter(UserChallenge.challenge == challenge_id)
+
+    return query
+
+
+def users_query(challenge_id: int = None):
+    return db.session.query(User.id, User.name, User.is_admin, User.date_created).order_by(User.id)
+
+
+# what can be exported (the challenge is ignored for the users)
+EXPORTS = {
+    'answers': answers_query,
+    'progress': progress_query,
+    'users': users_query,
+}
+
+FORMATS = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+}
+
+
+def _csv_lines(columns, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def _jsonl_lines(columns, rows):
+    for row in rows:
+        yield json.dumps(dict(zip(columns, row)), default=str) + '\n'
+
+
+def generate(name: str, format_: str = 'csv', challenge_id: int = None, batch_size: int = 1000):
+    """Yield an export, in CSV or JSONL, by chunks of ``batch_size`` lines.
+
+    The rows are fetched by batches of ``batch_size`` as well (``yield_per()``), so the memory does not depend on the
+    number of rows (and since the database is in WAL mode, reading them does not block the writers).
+    """
+
+    if name not in EXPORTS:
+        raise ValueError('unknown export {}'.format(name))
+    if format_ not in FORMATS:
+        raise ValueError('unknown format {}'.format(format_))
+
+    query = EXPORTS[name](challenge_id)
+    columns = [c['name'] for c in query.column_descriptions]
+    rows = query.yield_per(batch_size)
+
+    lines = _csv_lines(columns, rows) if format_ == 'csv' else _jsonl_lines(columns, rows)
+
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= batch_size:
+            yield ''.join(chunk)
+            chunk = []
+
+    if chunk:
+        yield ''.join(chunk)
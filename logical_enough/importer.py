@@ -0,0 +1,244 @@
+import csv
+import json
+import concurrent.futures
+
+from logical_enough import db, logic, content, commit_with_retry
+from logical_enough.models import User, Challenge, Question
+
+try:
+    import yaml
+except ImportError:  # optional
+    yaml = None
+
+
+class ImportException(Exception):
+    pass
+
+
+def load(path: str) -> list:
+    """Load the challenges of a JSON or YAML file, which contains a list of challenges (or ``{'challenges': [...]}``):
+
+    .. code-block:: yaml
+
+        - name: My challenge
+          is_public: false
+          questions:
+            - hint_expr: a OR b
+              hint: some help
+              documents: [a, b, c]
+    """
+
+    with open(path) as f:
+        if path.endswith('.yml') or path.endswith('.yaml'):
+            if yaml is None:
+                raise ImportException('PyYAML is required to read {}'.format(path))
+
+            try:
+                data = yaml.safe_load(f)
+            except yaml.YAMLError as e:
+                raise ImportException('invalid YAML: {}'.format(e))
+        else:
+            try:
+                data = json.load(f)
+            except ValueError as e:
+                raise ImportException('invalid JSON: {}'.format(e))
+
+    if isinstance(data, dict):
+        data = data.get('challenges')
+
+    if not isinstance(data, list):
+        raise ImportException('expected a list of challenges')
+
+    return data
+
+
+def validate_question(question) -> dict:
+    """Parse the expression and classify the documents of a question, the same way the admin views do.
+
+    Returns a dict with either ``errors`` or the ``hint_expr``, ``hint``, ``good_docs`` and ``wrong_docs``.
+    It is run in the workers of a process pool, so it must only use (and return) picklable objects.
+    """
+
+    if not isinstance(question, dict) or 'hint_expr' not in question:
+        return {'errors': ['no hint_expr']}
+
+    if not isinstance(question['hint_expr'], str):
+        return {'errors': ['hint_expr must be a string']}
+
+    if not isinstance(question.get('hint', ''), str):
+        return {'errors': ['hint must be a string']}
+
+    documents = question.get('documents', [])
+    if isinstance(documents, str):
+        documents = documents.split(Question.SEP)
+    elif not isinstance(documents, list) or not all(isinstance(d, str) for d in documents):
+        return {'errors': ['documents must be a string or a list of strings']}
+
+    try:
+        search_expression = logic.parse(question['hint_expr'])
+    except logic.ParserException as e:
+        return {'errors': ['parser error: "{}"'.format(e)]}
+
+    good_docs, wrong_docs = logic.classify(search_expression, documents)
+    if len(good_docs) == 0:
+        return {'errors': ['no good document for {}'.format(search_expression)]}
+
+    return {
+        'hint_expr': str(search_expression),
+        'hint': question.get('hint', ''),
+        'good_docs': good_docs,
+        'wrong_docs': wrong_docs,
+        'errors': []
+    }
+
+
+def validate(challenges: list, jobs: int = None) -> list:
+    """Validate the challenges, the questions being validated in a pool of ``jobs`` processes
+    (or in the current one if ``jobs`` is 1).
+
+    Returns a report: for each challenge, its name, whether it is public, its validated questions and its errors.
+    """
+
+    report = []
+    questions = []
+    names = set()
+
+    existing = set(
+        n for n, in db.session.query(Challenge.name).filter(Challenge.name.in_(
+            [c.get('name') for c in challenges if isinstance(c, dict) and isinstance(c.get('name'), str)])))
+
+    for i, challenge in enumerate(challenges):
+        if not isinstance(challenge, dict):
+            challenge = {}
+
+        entry = {'name': challenge.get('name'), 'is_public': bool(challenge.get('is_public', False)), 'errors': []}
+        report.append(entry)
+
+        if not entry['name']:
+            entry['errors'].append('challenge #{} has no name'.format(i + 1))
+        elif not isinstance(entry['name'], str):
+            entry['errors'].append('the name of challenge #{} must be a string'.format(i + 1))
+            entry['name'] = str(entry['name'])
+        elif entry['name'] in existing or entry['name'] in names:
+            entry['errors'].append('a challenge named "{}" already exists'.format(entry['name']))
+
+        names.add(entry['name'])
+
+        questions.append(challenge.get('questions') or [])
+        if not isinstance(questions[-1], list):
+            entry['errors'].append('questions must be a list')
+            questions[-1] = []
+        elif len(questions[-1]) == 0:
+            entry['errors'].append('no question')
+
+    flat = [q for qs in questions for q in qs]
+    if jobs == 1 or len(flat) < 2:
+        validated = [validate_question(q) for q in flat]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            validated = list(executor.map(validate_question, flat, chunksize=max(1, len(flat) // 64)))
+
+    start = 0
+    for entry, qs in zip(report, questions):
+        entry['questions'] = validated[start:start + len(qs)]
+        start += len(qs)
+
+        for j, q in enumerate(entry['questions']):
+            entry['errors'].extend('question #{}: {}'.format(j + 1, e) for e in q['errors'])
+
+    return report
+
+
+def insert(report: list) -> int:
+    """Insert the (validated) challenges, one transaction per challenge. Returns the number of questions"""
+
+    n = 0
+
+    for entry in report:
+        def add_challenge():
+            challenge = Challenge(entry['name'], is_public=entry['is_public'])
+            db.session.add(challenge)
+            db.session.flush()
+
+            db.session.add_all(
+                Question(
+                    challenge.id,
+                    hint_expr=q['hint_expr'],
+                    wrong_docs=q['wrong_docs'],
+                    good_docs=q['good_docs'],
+                    hint=q['hint'],
+                    position=i
+                ) for i, q in enumerate(entry['questions']))
+
+            db.session.flush()
+            challenge.renumber_questions()
+            content.invalidate()
+
+        commit_with_retry(add_challenge)
+        n += len(entry['questions'])
+
+    return n
+
+
+def import_challenges(path: str, dry_run: bool = False, jobs: int = None):
+    """Validate, then (if there is no error and it is not a dry run) insert the challenges of a file.
+
+    Returns the report and the number of inserted questions.
+    """
+
+    report = validate(load(path), jobs)
+    if dry_run or any(entry['errors'] for entry in report):
+        return report, 0
+
+    return report, insert(report)
+
+
+# --- Users
+def read_logins(lines) -> list:
+    """Get the logins out of a CSV file (or any iterable over its lines): the first column of each row, without
+    duplicates (a ``login`` or ``name`` header is skipped)
+    """
+
+    logins = []
+    seen = set()
+
+    for i, row in enumerate(csv.reader(lines)):
+        if not row:
+            continue
+
+        login = row[0].strip()
+        if login == '' or login in seen or (i == 0 and login.lower() in ('login', 'name')):
+            continue
+
+        seen.add(login)
+        logins.append(login)
+
+    return logins
+
+
+def create_users(logins: list, is_admin: bool = False, batch_size: int = 500):
+    """Create the users which do not exist yet, in a single transaction.
+
+    The existing ones are found with ``IN`` queries and the others inserted with a single ``executemany``, both by
+    batches of ``batch_size`` (SQLite limits the number of parameters of a statement).
+
+    Returns the list of the created and of the skipped logins.
+    """
+
+    existing = set()
+    for i in range(0, len(logins), batch_size):
+        existing.update(
+            n for n, in db.session.query(User.name).filter(User.name.in_(logins[i:i + batch_size])))
+
+    created = [login for login in logins if login not in existing]
+    skipped = [login for login in logins if login in existing]
+
+    def insert():
+        for i in range(0, len(created), batch_size):
+            db.session.execute(
+                User.__table__.insert(), [{'name': n, 'is_admin': is_admin} for n in created[i:i + batch_size]])
+
+    if created:
+        commit_with_retry(insert)
+
+    return created, skipped
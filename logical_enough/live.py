@@ -0,0 +1,438 @@
+import json
+import base64
+import struct
+import asyncio
+import hashlib
+import logging
+import http.cookies
+import urllib.parse
+
+from logical_enough import db, logic, content, results
+from logical_enough.models import UserChallenge
+
+
+logger = logging.getLogger(__name__)
+
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+# number of documents evaluated between two messages (and two checks for a newer expression)
+CHUNK_SIZE = 100
+
+STATISTICS = {'connections': 0, 'open_connections': 0, 'messages': 0, 'evaluations': 0, 'cancelled': 0}
+
+
+class LiveException(Exception):
+    def __init__(self, message, code=1008):
+        super().__init__(message)
+        self.message = message
+        self.code = code
+
+
+# --- WebSocket (RFC 6455), just what is needed here
+def accept_key(key: str) -> str:
+    return base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()).decode()
+
+
+def apply_mask(payload: bytes, mask: bytes) -> bytes:
+    """(Un)mask a payload, XOR-ing it at once as a big integer (byte per byte, it blocks the loop on large ones)"""
+
+    n = len(payload)
+    if n == 0:
+        return payload
+
+    key = int.from_bytes((mask * (n // 4 + 1))[:n], 'big')
+    return (int.from_bytes(payload, 'big') ^ key).to_bytes(n, 'big')
+
+
+def encode_frame(payload: bytes, opcode: int = OP_TEXT, mask: bytes = None) -> bytes:
+    """Encode a (final) frame. Frames sent by a client must be masked, the ones sent by the server must not."""
+
+    header = bytes([0x80 | opcode])
+    mask_bit = 0x80 if mask is not None else 0
+
+    if len(payload) < 126:
+        header += bytes([mask_bit | len(payload)])
+    elif len(payload) < 2 ** 16:
+        header += bytes([mask_bit | 126]) + struct.pack('!H', len(payload))
+    else:
+        header += bytes([mask_bit | 127]) + struct.pack('!Q', len(payload))
+
+    if mask is not None:
+        header += mask
+        payload = apply_mask(payload, mask)
+
+    return header + payload
+
+
+async def read_frame(reader: asyncio.StreamReader, max_size: int):
+    """Read a frame, and get ``(fin, opcode, payload)``"""
+
+    first, second = await reader.readexactly(2)
+    fin, opcode = bool(first & 0x80), first & 0x0F
+    masked, length = bool(second & 0x80), second & 0x7F
+
+    if length == 126:
+        length, = struct.unpack('!H', await reader.readexactly(2))
+    elif length == 127:
+        length, = struct.unpack('!Q', await reader.readexactly(8))
+
+    if length > max_size:
+        raise LiveException('message too big', code=1009)
+
+    mask = await reader.readexactly(4) if masked else None
+    payload = await reader.readexactly(length)
+    if mask is not None:
+        payload = apply_mask(payload, mask)
+
+    return fin, opcode, payload
+
+
+async def read_message(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, max_size: int):
+    """Read a (possibly fragmented) text message, answering the pings on the way. Get ``None`` if the connection is
+    closed.
+    """
+
+    fragments = []
+    while True:
+        fin, opcode, payload = await read_frame(reader, max_size)
+
+        if opcode == OP_CLOSE:
+            writer.write(encode_frame(payload[:2], OP_CLOSE))
+            return None
+        elif opcode == OP_PING:
+            writer.write(encode_frame(payload, OP_PONG))
+        elif opcode == OP_PONG:
+            pass
+        elif opcode == OP_BINARY:
+            raise LiveException('expected text', code=1003)
+        elif opcode in (OP_TEXT, OP_CONTINUATION):
+            fragments.append(payload)
+            if sum(len(f) for f in fragments) > max_size:
+                raise LiveException('message too big', code=1009)
+            if fin:
+                return b''.join(fragments).decode()
+
+
+def is_allowed_origin(headers: dict, allowed_origins: list = None) -> bool:
+    """Check the origin of the page which opened the connection, since the browsers send the cookies of the
+    application whatever the page is: it must be in ``allowed_origins`` (if set), or on the same host as the channel.
+    Clients which are not browsers do not send any origin (but they do not have the cookies of the users either).
+    """
+
+    origin = headers.get('origin')
+    if origin is None:
+        return True
+
+    if allowed_origins is not None:
+        return origin in allowed_origins
+
+    host = urllib.parse.urlsplit('//' + headers.get('host', '')).hostname
+    return host is not None and urllib.parse.urlsplit(origin).hostname == host
+
+
+async def handshake(
+        reader: asyncio.StreamReader, writer: asyncio.StreamWriter, path: str, allowed_origins: list = None) -> dict:
+    """Read the HTTP request, and upgrade the connection. Get the headers (lower-cased)."""
+
+    request = (await reader.readuntil(b'\r\n\r\n')).decode('latin-1').split('\r\n')
+    method, target, _ = (request[0].split(' ') + ['', ''])[:3]
+
+    headers = {}
+    for line in request[1:]:
+        if ':' in line:
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+
+    if method != 'GET' or target.split('?')[0] != path or headers.get('upgrade', '').lower() != 'websocket' \
+            or 'sec-websocket-key' not in headers:
+        writer.write(b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+        raise LiveException('not a WebSocket request')
+
+    if not is_allowed_origin(headers, allowed_origins):
+        writer.write(b'HTTP/1.1 403 Forbidden\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+        raise LiveException('origin not allowed')
+
+    writer.write((
+        'HTTP/1.1 101 Switching Protocols\r\n'
+        'Upgrade: websocket\r\n'
+        'Connection: Upgrade\r\n'
+        'Sec-WebSocket-Accept: {}\r\n\r\n').format(accept_key(headers['sec-websocket-key'])).encode())
+
+    return headers
+
+
+# --- The channel
+class LiveConnection:
+    """State of a connection: the (analyzed) documents, and the evaluation of the last expression.
+
+    The client sends JSON messages:
+
+    + ``{"documents": [...]}``, to check its own documents (e.g. in the question editor, the normalized documents are
+      sent back as ``{"normalized_documents": [...]}``), or
+      ``{"question": id}``, to check the documents of the current question of the logged in user
+      (which are sent back once, as ``{"documents": [[content, is_good], ...]}``);
+    + ``{"expression": "...", "id": n}``, each time the expression changes.
+
+    For each expression, the results are pushed as they are computed, by chunks:
+    ``{"id": n, "offset": i, "matched": [...], "done": false}`` (or ``{"id": n, "error": {...}}``).
+    A newer expression cancels the evaluation of the previous one.
+
+    What blocks (the analysis of the documents and the database) runs in the default executor of the loop.
+    """
+
+    def __init__(self, app, writer: asyncio.StreamWriter, user_id: int = None):
+        self.app = app
+        self.writer = writer
+        self.user_id = user_id
+        self.drain_lock = asyncio.Lock()
+
+        self.documents = []
+        self.analyzed = []
+        self.evaluation = None
+
+    def send(self, message: dict) -> None:
+        self.writer.write(encode_frame(json.dumps(message).encode()))
+
+    async def drain(self) -> None:
+        """Wait for the messages to be sent (the evaluation and the connection both send, but only one can wait)"""
+
+        async with self.drain_lock:
+            await self.writer.drain()
+
+    async def run_in_executor(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+    @staticmethod
+    def analyze_documents(documents: list) -> list:
+        return [results.analyze(d) for d in documents]
+
+    async def set_documents(self, documents: list) -> None:
+        analyzed = await self.run_in_executor(self.analyze_documents, documents)
+        self.documents, self.analyzed = documents, analyzed
+
+    def get_question_documents(self, question_id: int) -> list:
+        """Get the documents of the current question of the user"""
+
+        with self.app.app_context():
+            try:
+                question = content.get_question(question_id)
+                if question is None:
+                    raise LiveException('no such question')
+
+                user_challenge = UserChallenge.query\
+                    .filter(UserChallenge.user == self.user_id)\
+                    .filter(UserChallenge.challenge == question.challenge)\
+                    .first()
+
+                if user_challenge is None or user_challenge.is_done \
+                        or user_challenge.current_question != question_id:
+                    raise LiveException('not the right question')
+
+                return content.get_documents(question_id)
+            finally:
+                db.session.remove()
+
+    async def load_question(self, question_id: int) -> None:
+        if self.user_id is None:
+            raise LiveException('not logged in')
+
+        documents = await self.run_in_executor(self.get_question_documents, question_id)
+
+        await self.set_documents([d.content for d in documents])
+        self.send({'documents': [(d.content, d.is_good) for d in documents]})
+
+    async def evaluate(self, message_id, expression: logic.SearchExpr) -> None:
+        STATISTICS['evaluations'] += 1
+
+        for offset in range(0, len(self.analyzed), CHUNK_SIZE):
+            self.send({
+                'id': message_id,
+                'offset': offset,
+                'matched': [expression.match(d) for d in self.analyzed[offset:offset + CHUNK_SIZE]],
+                'done': False
+            })
+
+            await self.drain()
+            await asyncio.sleep(0)  # let a newer expression come in
+
+        self.send({'id': message_id, 'offset': len(self.analyzed), 'matched': [], 'done': True})
+
+    def cancel(self) -> None:
+        if self.evaluation is not None and not self.evaluation.done():
+            self.evaluation.cancel()
+            STATISTICS['cancelled'] += 1
+
+    async def receive(self, message: str) -> None:
+        STATISTICS['messages'] += 1
+
+        try:
+            data = json.loads(message)
+        except ValueError:
+            raise LiveException('invalid JSON', code=1007)
+
+        if not isinstance(data, dict):
+            raise LiveException('expected a JSON object', code=1007)
+
+        if 'documents' in data:
+            documents = data['documents']
+            if not isinstance(documents, list) or not all(isinstance(d, str) for d in documents):
+                raise LiveException('expected a list of strings', code=1007)
+            if len(documents) > self.app.config.get('LIVE_MAX_DOCUMENTS', 2000):
+                raise LiveException('too many documents', code=1009)
+
+            self.cancel()
+            await self.set_documents(documents)
+            self.send({'normalized_documents': [' '.join(str(t.value) for t in d) for d in self.analyzed]})
+
+        elif 'question' in data:
+            if not isinstance(data['question'], int):
+                raise LiveException('expected an id', code=1007)
+
+            self.cancel()
+            await self.load_question(data['question'])
+
+        elif 'expression' in data:
+            if not isinstance(data['expression'], str):
+                raise LiveException('expected a string', code=1007)
+
+            self.cancel()
+
+            try:
+                expression = results.parse(data['expression'])
+            except logic.ParserException as e:
+                self.send({'id': data.get('id'), 'error': {'position': e.token.position, 'error': e.message}})
+                return
+
+            self.evaluation = asyncio.ensure_future(self.evaluate(data.get('id'), expression))
+
+
+def get_user_id(app, headers: dict):
+    """Get the id of the logged in user, from the session cookie of the Flask app (if any)"""
+
+    cookie = http.cookies.SimpleCookie()
+    try:
+        cookie.load(headers.get('cookie', ''))
+    except http.cookies.CookieError:
+        return None
+
+    if app.session_cookie_name not in cookie:
+        return None
+
+    serializer = app.session_interface.get_signing_serializer(app)
+    if serializer is None:
+        return None
+
+    try:
+        session = serializer.loads(
+            cookie[app.session_cookie_name].value, max_age=app.permanent_session_lifetime.total_seconds())
+    except Exception:
+        return None
+
+    from logical_enough.base_views import PageContextMixin
+    return session.get(PageContextMixin.LOGIN_VAR)
+
+
+class LiveServer:
+    """The live channel server (the Flask app gives the settings, the database and the secret key).
+
+    It keeps track of the open connections, so that ``close()`` ends them (and waits for them) as well.
+    """
+
+    def __init__(self, app, path: str = '/live'):
+        self.app = app
+        self.path = path
+        self.server = None
+        self.connections = {}  # task -> writer
+
+    @property
+    def sockets(self):
+        return self.server.sockets
+
+    async def start(self, host: str = '127.0.0.1', port: int = 5001):
+        self.server = await asyncio.start_server(self.handle, host, port)
+        return self
+
+    async def serve_forever(self) -> None:
+        await self.server.serve_forever()
+
+    async def close(self, timeout: float = 5) -> None:
+        """Stop listening, close the connections and wait for their handlers (which are cancelled after ``timeout``)
+        """
+
+        self.server.close()
+        await self.server.wait_closed()
+
+        tasks = list(self.connections)
+        for writer in self.connections.values():
+            writer.close()  # the handler gets the end of the stream
+
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=timeout)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        self.connections[task] = writer
+        try:
+            await self.handle_connection(reader, writer)
+        finally:
+            del self.connections[task]
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        connection = None
+        STATISTICS['connections'] += 1
+        STATISTICS['open_connections'] += 1
+
+        try:
+            headers = await handshake(reader, writer, self.path, self.app.config.get('LIVE_ALLOWED_ORIGINS'))
+            connection = LiveConnection(self.app, writer, get_user_id(self.app, headers))
+            max_size = self.app.config.get('LIVE_MAX_MESSAGE_SIZE', 512 * 1024)
+
+            while True:
+                message = await read_message(reader, writer, max_size)
+                if message is None:
+                    break
+
+                try:
+                    await connection.receive(message)
+                except LiveException as e:
+                    if e.code != 1008:  # policy violations (e.g. not the right question) are not fatal
+                        raise
+                    connection.send({'error': e.message})
+
+                await connection.drain()
+        except LiveException as e:
+            if connection is not None:
+                writer.write(encode_frame(struct.pack('!H', e.code) + e.message.encode(), OP_CLOSE))
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        except Exception:
+            logger.exception('error in the live channel')
+        finally:
+            STATISTICS['open_connections'] -= 1
+            if connection is not None:
+                connection.cancel()
+
+            try:
+                if connection is not None:
+                    await connection.drain()
+                else:
+                    await writer.drain()
+                writer.close()
+            except ConnectionError:
+                pass
+
+
+async def serve(app, host: str = '127.0.0.1', port: int = 5001, path: str = '/live') -> LiveServer:
+    """Start the live channel server"""
+
+    return await LiveServer(app, path).start(host, port)
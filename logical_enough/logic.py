@@ -1,9 +1,16 @@
 import re
+import struct
 import unicodedata
+import concurrent.futures
 
-from typing import Iterator, Union, List
+from typing import Iterator, Union, List, Optional
 from logical_enough.stopwords import FRENCH_STOPWORDS, ENGLISH_STOPWORDS
 
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Python < 3.8
+    shared_memory = None
+
 
 def remove_accents(input_str: str):
     """Remove diacritics, due to https://stackoverflow.com/a/517974
@@ -37,6 +44,10 @@ NOT = 'NOT'
 
 ALL_OPERATORS = [AND, OR, NOT]
 
+# to be changed each time the lexer, the parser or the analyzer give different results (it is part of the HTTP
+# cache validators of the API)
+ENGINE_VERSION = '1'
+
 
 # Token
 class Token:
@@ -485,3 +496,143 @@ class Analyzer:
 
 def analyze(inp: str):
     return list(Analyzer(inp).filter())
+
+
+def classify(expression: SearchExpr, documents: List[str]):
+    """Split the documents into the ones that are matched by the expression and the others"""
+
+    good_docs = []
+    wrong_docs = []
+
+    for d in documents:
+        if expression.match(analyze(d)):
+            good_docs.append(d)
+        else:
+            wrong_docs.append(d)
+
+    return good_docs, wrong_docs
+
+
+# --- Parallel evaluation
+# The documents are packed in a shared memory block: the number of documents ``n``, the ``n + 1`` offsets of the
+# documents (as unsigned 64 bits integers), the documents (UTF-8), then one byte per document for the results.
+# Each task gets a range of documents and the expression in its canonical form (``str()``), which is parsed once per
+# worker process.
+
+_HEADER = struct.Struct('Q')
+_OFFSETS = struct.Struct('QQ')
+
+_worker_expressions = {}
+
+
+def _pack_documents(documents: List[str]):
+    encoded = [d.encode() for d in documents]
+
+    offsets = [0]
+    for d in encoded:
+        offsets.append(offsets[-1] + len(d))
+
+    data_start = _HEADER.size * (len(documents) + 2)
+    block = shared_memory.SharedMemory(create=True, size=max(1, data_start + offsets[-1] + len(documents)))
+
+    struct.pack_into('{}Q'.format(len(documents) + 2), block.buf, 0, len(documents), *offsets)
+    block.buf[data_start:data_start + offsets[-1]] = b''.join(encoded)
+
+    return block, data_start + offsets[-1]
+
+
+def _match_shard(name: str, expr: str, start: int, end: int, normalize: bool = False) -> Optional[List[str]]:
+    """Match the documents ``start`` to ``end`` of the block ``name`` (in a worker process), and get them normalized
+    if ``normalize``
+    """
+
+    if expr not in _worker_expressions:
+        _worker_expressions.clear()
+        _worker_expressions[expr] = parse(expr)
+
+    expression = _worker_expressions[expr]
+
+    normalized = [] if normalize else None
+
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        buf = block.buf
+        n, = _HEADER.unpack_from(buf, 0)
+        data_start = _HEADER.size * (n + 2)
+        results_start = data_start + _HEADER.unpack_from(buf, _HEADER.size * (n + 1))[0]
+
+        for i in range(start, end):
+            begin, stop = _OFFSETS.unpack_from(buf, _HEADER.size * (i + 1))
+            tokens = analyze(bytes(buf[data_start + begin:data_start + stop]).decode())
+            buf[results_start + i] = expression.match(tokens)
+            if normalize:
+                normalized.append(' '.join(str(t.value) for t in tokens))
+
+        del buf
+    finally:
+        block.close()
+
+    return normalized
+
+
+class Shards:
+    """``documents`` packed in shared memory, and checked against ``expression`` by shards of ``shard_size``
+    documents in the processes of ``executor``: ``futures`` are the shards, in order. If ``normalize``, their results
+    are the normalized documents.
+
+    ``close()`` frees the shared memory, once the results are read.
+    """
+
+    def __init__(self, expression: SearchExpr, documents: List[str], executor: concurrent.futures.Executor,
+                 shard_size: int, normalize: bool = False):
+        self.block, self.results_start = _pack_documents(documents)
+        self.bounds = [
+            (start, min(start + shard_size, len(documents))) for start in range(0, len(documents), shard_size)]
+        self.futures = []
+
+        try:
+            expr = str(expression)
+            for start, end in self.bounds:
+                self.futures.append(executor.submit(_match_shard, self.block.name, expr, start, end, normalize))
+        except Exception:
+            self.close()
+            raise
+
+    def matched(self, i: int) -> List[bool]:
+        """Get the results of the shard ``i`` (once it is done)"""
+
+        start, end = self.bounds[i]
+        return [bool(r) for r in self.block.buf[self.results_start + start:self.results_start + end]]
+
+    def close(self) -> None:
+        if self.block is not None:
+            for future in self.futures:
+                future.cancel()
+
+            self.block.close()
+            self.block.unlink()
+            self.block = None
+
+
+def match_many(expression: SearchExpr, documents: List[str], executor: concurrent.futures.Executor = None,
+               workers: int = 1, shards_per_worker: int = 4) -> List[bool]:
+    """Check which ``documents`` are matched by ``expression`` (in order), by shards in the processes of
+    ``executor`` (a ``ProcessPoolExecutor`` of ``workers`` processes, which gives the number of shards).
+
+    Without an executor (or without ``multiprocessing.shared_memory``), the documents are checked in the current
+    process.
+    """
+
+    if executor is None or shared_memory is None or len(documents) < 2:
+        return [expression.match(analyze(d)) for d in documents]
+
+    shards = Shards(expression, documents, executor, max(1, -(-len(documents) // (workers * shards_per_worker))))
+    try:
+        matched = []
+        for i, future in enumerate(shards.futures):
+            future.result()
+            matched.extend(shards.matched(i))
+
+        return matched
+    finally:
+        shards.close()
@@ -0,0 +1,244 @@
+import itertools
+
+from sqlalchemy import inspect, bindparam, text
+from sqlalchemy.schema import CreateColumn
+
+from logical_enough import db, stats
+from logical_enough.models import Question, Document
+
+
+def deduplicate_users(connection) -> int:
+    """Merge the users with the same login into the first one (so that the unique index can be created): their
+    answers and progression are moved to it, and it is an admin if any of them was.
+    """
+
+    rows = connection.execute(
+        'SELECT user.id, user.name, user.is_admin FROM user JOIN '
+        '(SELECT name FROM user GROUP BY name HAVING COUNT(*) > 1) AS duplicated ON duplicated.name = user.name '
+        'ORDER BY user.name, user.id').fetchall()
+
+    n = 0
+    for _, users in itertools.groupby(rows, key=lambda r: r.name):
+        users = list(users)
+        kept, others = users[0].id, [u.id for u in users[1:]]
+
+        for table in ['answer', 'user_challenge']:
+            connection.execute(
+                text('UPDATE {} SET user = :kept WHERE user IN :others'.format(table))
+                .bindparams(bindparam('others', expanding=True)), kept=kept, others=others)
+
+        connection.execute(
+            text('DELETE FROM user_challenge_stats WHERE user IN :others')
+            .bindparams(bindparam('others', expanding=True)), others=others)
+
+        if any(u.is_admin for u in users):
+            connection.execute(text('UPDATE user SET is_admin = 1 WHERE id = :kept'), kept=kept)
+
+        connection.execute(
+            text('DELETE FROM user WHERE id IN :others').bindparams(bindparam('others', expanding=True)), others=others)
+
+        n += len(others)
+
+    return n
+
+
+def deduplicate_user_challenges(connection) -> int:
+    """Only keep the first ``UserChallenge`` of each (user, challenge), so that the unique index can be created
+    """
+
+    result = connection.execute(
+        'DELETE FROM user_challenge WHERE id NOT IN (SELECT MIN(id) FROM user_challenge GROUP BY user, challenge)')
+
+    return result.rowcount
+
+
+def renumber_questions(connection) -> int:
+    """Make the question positions dense within each challenge, and set the next question pointers.
+
+    Positions used to be filled with the number of challenges, so if they are not already dense, the questions are
+    ordered by id (which was the implicit order).
+    """
+
+    table = Question.__table__
+    rows = connection.execute(
+        'SELECT id, challenge, position, next_question FROM question ORDER BY challenge, position, id').fetchall()
+
+    updates = []
+    for _, questions in itertools.groupby(rows, key=lambda r: r.challenge):
+        questions = list(questions)
+
+        positions = [q.position for q in questions]
+        if None in positions or sorted(positions) != list(range(len(questions))):
+            questions.sort(key=lambda q: q.id)
+
+        current = dict((q.id, (q.position, q.next_question)) for q in questions)
+        for o in Question.ordering([q.id for q in questions]):
+            if current[o['id']] != (o['position'], o['next_question']):
+                updates.append({'b_id': o['id'], 'b_position': o['position'], 'b_next_question': o['next_question']})
+
+    if updates:
+        connection.execute(
+            table.update()
+            .where(table.c.id == bindparam('b_id'))
+            .values(position=bindparam('b_position'), next_question=bindparam('b_next_question')),
+            updates)
+
+    return len(updates)
+
+
+def move_documents(connection) -> int:
+    """Move the documents, which used to be joined by ``;`` in ``question.good_documents`` and
+    ``question.wrong_documents``, to the document table (the old columns are then emptied).
+    """
+
+    columns = set(c['name'] for c in inspect(connection).get_columns('question'))
+    if 'good_documents' not in columns:
+        return 0
+
+    rows = connection.execute(
+        'SELECT id, good_documents, wrong_documents FROM question '
+        'WHERE good_documents IS NOT NULL OR wrong_documents IS NOT NULL').fetchall()
+
+    documents = []
+    for row in rows:
+        good_docs = row.good_documents.split(Question.SEP) if row.good_documents is not None else []
+        wrong_docs = row.wrong_documents.split(Question.SEP) if row.wrong_documents is not None else []
+
+        for i, (content, is_good) in enumerate([(d, True) for d in good_docs] + [(d, False) for d in wrong_docs]):
+            documents.append(
+                {'question': row.id, 'position': i, 'is_good': is_good, 'content': content,
+                 'content_hash': Document.hash(content)})
+
+    if documents:
+        connection.execute(Document.__table__.insert(), documents)
+
+    if rows:
+        connection.execute('UPDATE question SET good_documents = NULL, wrong_documents = NULL')
+
+    return len(rows)
+
+
+def count_questions(connection) -> int:
+    """Set the question count of the challenges, and the position of the users in them"""
+
+    n = connection.execute(
+        'UPDATE challenge SET question_count = (SELECT COUNT(*) FROM question WHERE question.challenge = challenge.id) '
+        'WHERE question_count IS NULL '
+        'OR question_count != (SELECT COUNT(*) FROM question WHERE question.challenge = challenge.id)').rowcount
+
+    n += connection.execute(
+        'UPDATE user_challenge SET current_position = '
+        '(SELECT position FROM question WHERE question.id = user_challenge.current_question) '
+        'WHERE NOT is_done AND (current_position IS NULL OR current_position != '
+        '(SELECT position FROM question WHERE question.id = user_challenge.current_question))').rowcount
+
+    n += connection.execute(
+        'UPDATE user_challenge SET current_position = '
+        '(SELECT question_count FROM challenge WHERE challenge.id = user_challenge.challenge) '
+        'WHERE is_done AND (current_position IS NULL OR current_position != '
+        '(SELECT question_count FROM challenge WHERE challenge.id = user_challenge.challenge))').rowcount
+
+    return n
+
+
+def start_questions(connection) -> int:
+    """Set when the current questions were started: the progression used to be only modified when they changed"""
+
+    return connection.execute(
+        'UPDATE user_challenge SET question_started_at = COALESCE(date_modified, date_created) '
+        'WHERE question_started_at IS NULL').rowcount
+
+
+def count_distinct_answers(connection) -> int:
+    """Fill the distinct answers (which used to be counted from all the answers), and recount them"""
+
+    n = connection.execute(
+        'INSERT INTO distinct_answer (question, answer, date_created, date_modified) '
+        'SELECT DISTINCT question, answer, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP FROM answer '
+        'WHERE answer IS NOT NULL AND NOT EXISTS (SELECT 1 FROM distinct_answer '
+        'WHERE distinct_answer.question = answer.question AND distinct_answer.answer = answer.answer)').rowcount
+
+    if n:
+        connection.execute(
+            'UPDATE question_stats SET distinct_answers = '
+            '(SELECT COUNT(*) FROM distinct_answer WHERE distinct_answer.question = question_stats.question)')
+
+    return n
+
+
+def build_stats(connection) -> int:
+    """Answers used to be the correct ones only; compute the statistics if they were never computed (or if the
+    progress of the users in the challenges is missing)
+    """
+
+    n = connection.execute('UPDATE answer SET is_correct = 1 WHERE is_correct IS NULL').rowcount
+
+    never_computed = connection.execute('SELECT COUNT(*) FROM challenge_stats').scalar() == 0 \
+        and connection.execute('SELECT COUNT(*) FROM user_challenge').scalar() > 0
+    missing_users = connection.execute('SELECT COUNT(*) FROM user_challenge_stats').scalar() == 0 \
+        and connection.execute('SELECT COUNT(*) FROM answer').scalar() > 0
+
+    if never_computed or missing_users:
+        stats.rebuild(connection)
+        n += connection.execute('SELECT COUNT(*) FROM challenge_stats').scalar()
+
+    return n
+
+
+# Data migrations, run in that order once the missing columns are added (but before the indexes are created).
+# Each of them gets the connection, must be idempotent, and returns the number of modified rows.
+MIGRATIONS = [
+    deduplicate_users,
+    deduplicate_user_challenges,
+    renumber_questions,
+    move_documents,
+    count_questions,
+    start_questions,
+    count_distinct_answers,
+    build_stats,
+]
+
+
+def upgrade_database() -> list:
+    """Bring an existing database up to date with the models:
+
+    1. create the missing tables,
+    2. add the missing columns to the existing tables (so they must be nullable or have a default),
+    3. run the data migrations,
+    4. create the missing indexes.
+
+    Returns a list of what was done.
+    """
+
+    done = []
+
+    with db.engine.begin() as connection:
+        existing_tables = set(inspect(connection).get_table_names())
+        preparer = connection.dialect.identifier_preparer
+
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                table.create(connection)
+                done.append('created table {}'.format(table.name))
+                continue
+
+            existing_columns = set(c['name'] for c in inspect(connection).get_columns(table.name))
+            for column in table.columns:
+                if column.name not in existing_columns:
+                    connection.execute('ALTER TABLE {} ADD COLUMN {}'.format(
+                        preparer.format_table(table), CreateColumn(column).compile(dialect=connection.dialect)))
+                    done.append('added column {}.{}'.format(table.name, column.name))
+
+        for migration in MIGRATIONS:
+            n = migration(connection)
+            if n:
+                done.append('{}: {} row(s)'.format(migration.__name__, n))
+
+        for table in db.metadata.sorted_tables:
+            existing_indexes = set(i['name'] for i in inspect(connection).get_indexes(table.name))
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    index.create(connection)
+                    done.append('created index {}'.format(index.name))
+
+    return done
@@ -1,3 +1,5 @@
+import hashlib
+
 from logical_enough import db
 
 
@@ -12,7 +14,7 @@ class BaseModel(db.Model):
 class User(BaseModel):
     """An user"""
 
-    name = db.Column(db.Text)
+    name = db.Column(db.Text, index=True, unique=True)
     is_admin = db.Column(db.Boolean, default=False)
 
     def __init__(self, name, is_admin=False):
@@ -25,67 +27,260 @@ class Challenge(BaseModel):
 
     name = db.Column(db.Text)
     is_public = db.Column(db.Boolean)
+    question_count = db.Column(db.Integer, default=0)  # maintained by `Question.renumber()`
 
     def __init__(self, name, is_public=False):
         self.name = name
         self.is_public = is_public
+        self.question_count = 0
 
     def get_questions(self):
-        return Question.query.filter(Question.challenge.is_(self.id)).all()
+        return Question.query.filter(Question.challenge == self.id).order_by(Question.position).all()
+
+    def renumber_questions(self, order=None):
+        Question.renumber(self.id, order)
 
 
 class Question(BaseModel):
 
+    __table_args__ = (
+        db.Index('ix_question_challenge_position', 'challenge', 'position'),
+    )
+
     challenge = db.Column(db.Integer, db.ForeignKey(Challenge.id, ondelete='CASCADE'))
     position = db.Column(db.Integer)
-    wrong_documents = db.Column(db.Text)
-    good_documents = db.Column(db.Text)
+    next_question = db.Column(db.Integer, db.ForeignKey('question.id', ondelete='SET NULL'), nullable=True)
     hint = db.Column(db.Text, default='')
     hint_expr = db.Column(db.Text, default='')
 
+    documents = db.relationship(
+        'Document', order_by='Document.position', cascade='all, delete-orphan', passive_deletes=True)
+
     SEP = ';'
 
     def __init__(self, challenge, hint_expr, wrong_docs, good_docs, hint='', position=0):
         self.challenge = challenge
         self.position = position
-        self.wrong_documents = Question.SEP.join(wrong_docs) if type(wrong_docs) is list else wrong_docs
-        self.good_documents = Question.SEP.join(good_docs) if type(good_docs) is list else good_docs
+        self.set_documents(good_docs, wrong_docs)
         self.hint = hint
         self.hint_expr = hint_expr
 
+    @staticmethod
+    def ordering(ids):
+        """Get the positions and next question pointers of the questions, given the list of their ids, in order
+        """
+
+        return [
+            {'id': i, 'position': p, 'next_question': ids[p + 1] if p + 1 < len(ids) else None}
+            for p, i in enumerate(ids)
+        ]
+
+    @staticmethod
+    def renumber(challenge_id, order=None):
+        """Make the positions of the questions of a challenge dense and update their next question pointers,
+        as well as the question count of the challenge and the position of the users which are doing it.
+
+        :param challenge_id: id of the challenge
+        :param order: list of the question ids in their new order (the current order is kept if not given)
+        """
+
+        if order is None:
+            order = [
+                i for i, in db.session.query(Question.id)
+                .filter(Question.challenge == challenge_id)
+                .order_by(Question.position, Question.id)
+            ]
+
+        db.session.bulk_update_mappings(Question, Question.ordering(order))
+
+        Challenge.query\
+            .filter(Challenge.id == challenge_id)\
+            .update({Challenge.question_count: len(order)}, synchronize_session=False)
+
+        UserChallenge.query\
+            .filter(UserChallenge.challenge == challenge_id)\
+            .filter(UserChallenge.is_done.is_(False))\
+            .update({UserChallenge.current_position: UserChallenge.position_of_current_question()},
+                    synchronize_session=False)
+
+    def set_documents(self, good_docs, wrong_docs):
+        """Replace the documents (the good ones first)"""
+
+        if type(good_docs) is str:
+            good_docs = good_docs.split(Question.SEP)
+        if type(wrong_docs) is str:
+            wrong_docs = wrong_docs.split(Question.SEP)
+
+        self.documents = [
+            Document(content, is_good=is_good, position=i) for i, (content, is_good) in enumerate(
+                [(d, True) for d in good_docs] + [(d, False) for d in wrong_docs])
+        ]
+
     def get_documents(self):
-        d = self.get_good_documents()
-        d.extend(self.get_wrong_documents())
-        return d
+        return [d.content for d in self.documents]
 
     def get_good_documents(self):
-        return self.good_documents.split(Question.SEP)
+        return [d.content for d in self.documents if d.is_good]
 
     def get_wrong_documents(self):
-        return self.wrong_documents.split(Question.SEP)
+        return [d.content for d in self.documents if not d.is_good]
+
+
+class Document(BaseModel):
+    """A document of a question, which is expected to be matched (or not) by the search expression"""
+
+    __table_args__ = (
+        db.Index('ix_document_question_position', 'question', 'position'),
+    )
+
+    question = db.Column(db.Integer, db.ForeignKey(Question.id, ondelete='CASCADE'))
+    position = db.Column(db.Integer)
+    is_good = db.Column(db.Boolean, default=False)
+    content = db.Column(db.Text)
+    content_hash = db.Column(db.String(64), index=True)
+
+    def __init__(self, content, is_good=False, position=0, question=None):
+        self.question = question
+        self.position = position
+        self.is_good = is_good
+        self.content = content
+        self.content_hash = Document.hash(content)
+
+    @staticmethod
+    def hash(content):
+        return hashlib.sha256(content.encode()).hexdigest()
 
 
 class UserChallenge(BaseModel):
 
+    __table_args__ = (
+        db.Index('ix_user_challenge_user_challenge', 'user', 'challenge', unique=True),
+    )
+
     user = db.Column(db.Integer, db.ForeignKey(User.id, ondelete='CASCADE'))
     challenge = db.Column(db.Integer, db.ForeignKey(Challenge.id, ondelete='CASCADE'))
     is_done = db.Column(db.Boolean, default=False)
     current_question = db.Column(db.Integer, db.ForeignKey(Question.id, ondelete='CASCADE'), nullable=True)
+    current_position = db.Column(db.Integer, default=0)  # position of the current question (or number of questions)
+    question_started_at = db.Column(db.DateTime, default=db.func.current_timestamp())  # set when the question changes
 
-    def __init__(self, user, challenge, current_question, is_done=False):
+    def __init__(self, user, challenge, current_question, is_done=False, current_position=0):
         self.user = user
         self.challenge = challenge
         self.is_done = is_done
         self.current_question = current_question
+        self.current_position = current_position
+
+    @staticmethod
+    def position_of_current_question():
+        """Correlated subquery for the position of the current question"""
+
+        return db.session.query(Question.position)\
+            .filter(Question.id == UserChallenge.current_question)\
+            .correlate(UserChallenge.__table__)\
+            .as_scalar()
 
 
 class Answer(BaseModel):
+    """An attempt of an user to answer a question"""
 
-    question = db.Column(db.Integer, db.ForeignKey(Question.id, ondelete='CASCADE'))
+    __table_args__ = (
+        db.Index('ix_answer_question_answer', 'question', 'answer'),
+    )
+
+    question = db.Column(db.Integer, db.ForeignKey(Question.id, ondelete='CASCADE'), index=True)
     answer = db.Column(db.Text)
-    user = db.Column(db.Integer, db.ForeignKey(User.id, ondelete='CASCADE'))
+    user = db.Column(db.Integer, db.ForeignKey(User.id, ondelete='CASCADE'), index=True)
+    is_correct = db.Column(db.Boolean, default=True)
+    duration = db.Column(db.Float, nullable=True)  # [s] since the question was started
 
-    def __init__(self, user, question, answer):
+    def __init__(self, user, question, answer, is_correct=True, duration=None):
         self.user = user
         self.question = question
         self.answer = answer
+        self.is_correct = is_correct
+        self.duration = duration
+
+
+class ContentVersion(BaseModel):
+    """Version of some content, bumped each time it is modified (so that the caches know when to drop it)"""
+
+    name = db.Column(db.Text, index=True, unique=True)
+    version = db.Column(db.Integer, default=0)
+
+    def __init__(self, name, version=0):
+        self.name = name
+        self.version = version
+
+    @staticmethod
+    def get(name):
+        return db.session.query(ContentVersion.version).filter(ContentVersion.name == name).scalar() or 0
+
+    @staticmethod
+    def bump(name):
+        """Increase the version (in the current transaction)"""
+
+        n = ContentVersion.query\
+            .filter(ContentVersion.name == name)\
+            .update({ContentVersion.version: ContentVersion.version + 1}, synchronize_session=False)
+
+        if n == 0:
+            db.session.add(ContentVersion(name, 1))
+
+
+# --- Statistics, maintained by `logical_enough.stats`
+class QuestionStats(BaseModel):
+
+    question = db.Column(db.Integer, db.ForeignKey(Question.id, ondelete='CASCADE'), index=True, unique=True)
+    challenge = db.Column(db.Integer, db.ForeignKey(Challenge.id, ondelete='CASCADE'), index=True)
+    attempts = db.Column(db.Integer, default=0)
+    successes = db.Column(db.Integer, default=0)
+    distinct_answers = db.Column(db.Integer, default=0)
+    solve_time = db.Column(db.Float, default=0)  # [s] total, for the successes
+
+    @property
+    def success_rate(self):
+        return self.successes / self.attempts if self.attempts else None
+
+    @property
+    def mean_solve_time(self):
+        return self.solve_time / self.successes if self.successes else None
+
+
+class DistinctAnswer(BaseModel):
+    """The answers given to a question, each of them once (to count them without scanning all the answers)"""
+
+    __table_args__ = (
+        db.Index('ix_distinct_answer_question_answer', 'question', 'answer', unique=True),
+    )
+
+    question = db.Column(db.Integer, db.ForeignKey(Question.id, ondelete='CASCADE'))
+    answer = db.Column(db.Text)
+
+
+class ChallengeStats(BaseModel):
+
+    challenge = db.Column(db.Integer, db.ForeignKey(Challenge.id, ondelete='CASCADE'), index=True, unique=True)
+    started = db.Column(db.Integer, default=0)
+    finished = db.Column(db.Integer, default=0)
+    attempts = db.Column(db.Integer, default=0)
+
+
+class UserChallengeStats(BaseModel):
+    """Progress of an user in a challenge (for the leaderboard of the challenge)"""
+
+    __table_args__ = (
+        db.Index('ix_user_challenge_stats_user_challenge', 'user', 'challenge', unique=True),
+    )
+
+    user = db.Column(db.Integer, db.ForeignKey(User.id, ondelete='CASCADE'))
+    challenge = db.Column(db.Integer, db.ForeignKey(Challenge.id, ondelete='CASCADE'))
+    attempts = db.Column(db.Integer, default=0)
+    solved = db.Column(db.Integer, default=0)
+    finished = db.Column(db.Integer, default=0)
+
+
+# the leaderboard of a challenge is read in this order
+db.Index(
+    'ix_user_challenge_stats_leaderboard',
+    UserChallengeStats.challenge, UserChallengeStats.solved.desc(), UserChallengeStats.attempts)
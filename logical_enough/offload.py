@@ -0,0 +1,187 @@
+import os
+import atexit
+import threading
+import multiprocessing
+import concurrent.futures
+
+from logical_enough import logic, profiling
+
+
+class OverloadedException(Exception):
+    pass
+
+
+class Batch:
+    """Documents being checked by the pool (``logic.Shards``), by chunks. Iterate to get the results of each chunk,
+    in the format of the API, in order.
+
+    The batch holds a slot of the pool (and the shared memory) until it is closed and all its chunks are done: closing
+    it cancels the chunks which did not start, but the running ones keep the slot (e.g. after a timeout).
+    """
+
+    def __init__(self, documents: list, shards: logic.Shards, slots: threading.BoundedSemaphore, timeout: float,
+                 executor=None):
+        self.documents = documents
+        self.shards = shards
+        self.futures = shards.futures
+        self.slots = slots
+        self.timeout = timeout
+        self.executor = executor
+        self.closed = False
+        self.released = False
+        self.lock = threading.Lock()
+
+        for future in self.futures:
+            future.add_done_callback(self._release_if_done)
+
+    def __iter__(self):
+        try:
+            for i, future in enumerate(self.futures):
+                normalized = future.result(timeout=self.timeout)
+                start, end = self.shards.bounds[i]
+
+                yield [
+                    {'document': d, 'normalized_document': n, 'matched': m}
+                    for d, n, m in zip(self.documents[start:end], normalized, self.shards.matched(i))
+                ]
+        finally:
+            self.close()
+
+    def _release_if_done(self, future=None) -> None:
+        with self.lock:
+            if self.closed and not self.released and all(f.done() for f in self.futures):
+                self.shards.close()
+                self.slots.release()
+                self.released = True
+
+    def close(self) -> None:
+        with self.lock:
+            if self.closed:
+                return
+
+            self.closed = True
+
+        for future in self.futures:  # (which calls the callbacks)
+            future.cancel()
+
+        self._release_if_done()
+
+    def __del__(self):
+        self.close()
+
+
+class Offloader:
+    """Check the large batches of documents (at least ``OFFLOAD_MIN_DOCUMENTS``) in a pool of ``OFFLOAD_WORKERS``
+    processes, by chunks of ``OFFLOAD_CHUNK_SIZE``, so that they do not hold the GIL of the web worker: with threaded
+    workers (e.g. ``gunicorn -k gthread``), the light requests are still served meanwhile.
+
+    At most ``OFFLOAD_MAX_PENDING`` batches are in the pool at once, the next ones are refused
+    (``OverloadedException``) rather than queued. If ``OFFLOAD_WORKERS`` is 0, everything is checked in the worker.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.executor = None
+        self.slots = None
+        self.key = None
+        self.lock = threading.Lock()
+        self.stop_registered = False
+
+        self.stats = profiling.Counters('offloaded', 'chunks', 'rejected', 'timeouts', 'broken')
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions['offloader'] = self
+        profiling.register_metrics('offload', self.stats.to_dict)
+
+    def should_offload(self, n: int) -> bool:
+        return self.app.config.get('OFFLOAD_WORKERS', 0) > 0 and logic.shared_memory is not None \
+            and n >= self.app.config.get('OFFLOAD_MIN_DOCUMENTS', 200)
+
+    def _ensure_started(self):
+        """(Re)start the pool, which does not survive a fork (or a change of the settings)"""
+
+        key = (os.getpid(), self.app.config.get('OFFLOAD_WORKERS', 0), self.app.config.get('OFFLOAD_MAX_PENDING', 4))
+
+        with self.lock:
+            if self.key == key:
+                return
+
+            if self.executor is not None and self.key[0] == key[0]:
+                self.executor.shutdown(wait=False)
+
+            if not self.stop_registered:
+                atexit.register(self.stop)
+                self.stop_registered = True
+
+            # spawned (rather than forked from a threaded process), they only need the logic
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=key[1], mp_context=multiprocessing.get_context('spawn'))
+            self.slots = threading.BoundedSemaphore(key[2])
+            self.key = key
+
+    def reset(self, executor) -> None:
+        """Drop ``executor`` if it is broken (e.g. a worker was killed), so that the next batch starts a new pool"""
+
+        with self.lock:
+            if self.executor is not executor or executor is None:
+                return
+
+            executor.shutdown(wait=False)
+            self.executor = None
+            self.key = None
+
+        self.stats.add(broken=1)
+
+    def submit(self, expression: logic.SearchExpr, documents: list) -> Batch:
+        """Start to check ``documents``, or raise ``OverloadedException`` if the pool is full (or broken)"""
+
+        self._ensure_started()
+        executor, slots = self.executor, self.slots
+
+        if not slots.acquire(blocking=False):
+            self.stats.add(rejected=1)
+            raise OverloadedException('too many batches in the pool')
+
+        try:
+            shards = logic.Shards(
+                expression, documents, executor, self.app.config.get('OFFLOAD_CHUNK_SIZE', 500), normalize=True)
+        except concurrent.futures.BrokenExecutor:
+            slots.release()
+            self.reset(executor)
+            raise OverloadedException('the pool is broken')
+        except Exception:
+            slots.release()
+            raise
+
+        self.stats.add(offloaded=1, chunks=len(shards.futures))
+
+        return Batch(documents, shards, slots, self.app.config.get('OFFLOAD_TIMEOUT', 30), executor)
+
+    def check_documents(self, expression: logic.SearchExpr, documents: list) -> list:
+        """Check ``documents`` in the pool, and wait for the results"""
+
+        batch = self.submit(expression, documents)
+
+        checked = []
+        try:
+            for chunk in batch:
+                checked.extend(chunk)
+        except concurrent.futures.TimeoutError:
+            self.stats.add(timeouts=1)
+            raise OverloadedException('timeout')
+        except concurrent.futures.BrokenExecutor:
+            self.reset(batch.executor)
+            raise OverloadedException('the pool is broken')
+
+        return checked
+
+    def stop(self) -> None:
+        if self.executor is not None and self.key[0] == os.getpid():
+            self.executor.shutdown(wait=False)
+
+
+offloader = Offloader()
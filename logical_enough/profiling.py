@@ -0,0 +1,189 @@
+import time
+import logging
+import threading
+import collections
+
+import flask
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+def _active_counters():
+    if not hasattr(_local, 'counters'):
+        _local.counters = []
+
+    return _local.counters
+
+
+class QueryCounter:
+    """Count the SQL queries (and the time spent in them) executed by the current thread while active.
+
+    Can be used as a context manager:
+
+    .. code-block:: python
+
+        with QueryCounter() as counter:
+            do_something()
+
+        print(counter.count, counter.duration)
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.duration = .0
+        self.statements = collections.Counter()
+
+    def start(self) -> 'QueryCounter':
+        _active_counters().append(self)
+        return self
+
+    def stop(self) -> 'QueryCounter':
+        counters = _active_counters()
+        if self in counters:
+            counters.remove(self)
+
+        return self
+
+    def record(self, statement: str, duration: float) -> None:
+        self.count += 1
+        self.duration += duration
+        self.statements[statement] += 1
+
+    def repeated_statements(self, threshold: int = 2) -> list:
+        """Get the statements that were executed at least ``threshold`` times (which is the sign of a N+1 problem)
+        """
+        return [(s, n) for s, n in self.statements.most_common() if n >= threshold]
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start_times = conn.info.get('query_start_time')
+    if not start_times:
+        return
+
+    duration = time.perf_counter() - start_times.pop()
+    for counter in _active_counters():
+        counter.record(statement, duration)
+
+
+class RequestStatistics:
+    """Aggregate the SQL statistics of the requests, per endpoint"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    def add(self, endpoint: str, counter: QueryCounter, is_slow: bool = False) -> None:
+        with self.lock:
+            stats = self.endpoints.setdefault(
+                endpoint, {'requests': 0, 'queries': 0, 'duration': .0, 'max_queries': 0, 'slow_requests': 0})
+
+            stats['requests'] += 1
+            stats['queries'] += counter.count
+            stats['duration'] += counter.duration
+            stats['max_queries'] = max(stats['max_queries'], counter.count)
+            if is_slow:
+                stats['slow_requests'] += 1
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return dict((e, dict(s)) for e, s in self.endpoints.items())
+
+
+REQUEST_STATISTICS = RequestStatistics()
+
+
+class Counters:
+    """Counters which can be incremented from any thread, e.g. ``Counters('hits', 'misses').add(hits=1)``"""
+
+    def __init__(self, *names):
+        self.lock = threading.Lock()
+        self.values = dict((name, 0) for name in names)
+
+    def add(self, **increments) -> None:
+        with self.lock:
+            for name, increment in increments.items():
+                self.values[name] += increment
+
+    def __getitem__(self, name: str):
+        return self.values[name]
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return dict(self.values)
+
+
+# other modules can register their own metrics there, as a function returning a (JSON-serializable) dict
+METRICS_PROVIDERS = {
+    'sql': REQUEST_STATISTICS.to_dict
+}
+
+
+def register_metrics(name: str, provider) -> None:
+    METRICS_PROVIDERS[name] = provider
+
+
+def collect_metrics() -> dict:
+    return dict((name, provider()) for name, provider in METRICS_PROVIDERS.items())
+
+
+def init_app(app):
+    """Count the queries of each request if ``SQL_PROFILING`` is set.
+
+    The numbers are added to the response headers (``X-SQL-Queries`` and ``X-SQL-Duration``) and aggregated in the
+    metrics, and a warning is logged if the request goes over ``SQL_PROFILING_MAX_QUERIES`` or
+    ``SQL_PROFILING_MAX_DURATION``.
+    """
+
+    @app.before_request
+    def start_query_counter():
+        if app.config.get('SQL_PROFILING', False):
+            flask.g.query_counter = QueryCounter().start()
+
+    @app.after_request
+    def stop_query_counter(response):
+        counter = flask.g.pop('query_counter', None)
+        if counter is None:
+            return response
+
+        counter.stop()
+
+        is_slow = counter.count > app.config.get('SQL_PROFILING_MAX_QUERIES', 25) or \
+            counter.duration > app.config.get('SQL_PROFILING_MAX_DURATION', .1)
+
+        if is_slow:
+            logger.warning('{} {}: {} queries in {:.1f} ms (repeated: {})'.format(
+                flask.request.method,
+                flask.request.path,
+                counter.count,
+                counter.duration * 1000,
+                counter.repeated_statements()))
+
+        REQUEST_STATISTICS.add(flask.request.endpoint or '?', counter, is_slow)
+
+        response.headers['X-SQL-Queries'] = str(counter.count)
+        response.headers['X-SQL-Duration'] = '{:.6f}'.format(counter.duration)
+
+        return response
+
+    @app.teardown_request
+    def teardown_query_counter(exc=None):
+        counter = flask.g.pop('query_counter', None)
+        if counter is not None:  # `after_request` was not called (because of an exception)
+            counter.stop()
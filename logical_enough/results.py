@@ -0,0 +1,66 @@
+import os
+
+from logical_enough import logic, profiling, settings
+from logical_enough.cache import LRUCache, SQLiteCache, TieredCache, SingleFlight
+
+
+class ResultsCache(TieredCache):
+    """Cache of the (pure) results of the logic: parsed expressions, analyzed documents and grading results.
+
+    Each worker keeps the last ``RESULTS_CACHE_SIZE`` of them in memory, in front of a SQLite file shared by the
+    workers (``RESULTS_CACHE_FILE``, in ``DATA_FILES_DIRECTORY``), so that they reuse each other's work and do not
+    start cold after a restart. Only the results that are more expensive to compute than to unpickle go to the file.
+
+    Since the file outlives the code, every key contains ``logic.ENGINE_VERSION``.
+    """
+
+    def __init__(self):
+        super().__init__(LRUCache())
+
+    def init_app(self, app):
+        self.local = LRUCache(app.config.get('RESULTS_CACHE_SIZE', 4096))
+        self.shared = None
+
+        if app.config.get('RESULTS_CACHE_FILE') is not None:
+            self.shared = SQLiteCache(
+                lambda: os.path.join(os.path.abspath(settings.DATA_FILES_DIRECTORY), app.config['RESULTS_CACHE_FILE']),
+                max_size=app.config.get('RESULTS_CACHE_MAX_SIZE', 100000),
+                ttl=app.config.get('RESULTS_CACHE_TTL', 7 * 24 * 3600))
+
+        profiling.register_metrics('results_cache', self.stats)
+        profiling.register_metrics('single_flight', single_flight.stats)
+
+
+results_cache = ResultsCache()
+
+# identical requests of the same worker (e.g. a burst of keyups) wait for each other rather than compute in parallel
+single_flight = SingleFlight()
+
+
+def parse(expr: str) -> logic.SearchExpr:
+    """Cached ``logic.parse()``, in memory only (the result must not be modified, and parser errors are not cached)
+    """
+
+    return results_cache.local.get_or_set(('parse', logic.ENGINE_VERSION, expr), lambda: logic.parse(expr))
+
+
+def analyze(doc: str) -> list:
+    """Cached ``logic.analyze()``, in memory only: reading it from the file would cost as much as analyzing again
+    (the result must not be modified)
+    """
+
+    return results_cache.local.get_or_set(('analyze', logic.ENGINE_VERSION, doc), lambda: logic.analyze(doc))
+
+
+def grade(question_id: int, expression: logic.SearchExpr, documents: list) -> tuple:
+    """Cached grading of an answer: whether each of the ``documents`` (``content.DocumentInfo``) of a question is
+    matched by ``expression``.
+
+    The key contains the canonical form of the expression (so that equivalent spellings share it) and the hashes of
+    the documents, so a question edited by an admin gets new entries (the old ones are evicted eventually), as well as
+    the version of the logic, since the results are shared between the workers and kept after a restart.
+    """
+
+    key = ('grade', logic.ENGINE_VERSION, question_id, tuple(d.content_hash for d in documents), str(expression))
+    return results_cache.get_or_set(key, lambda: single_flight.do(
+        key, lambda: tuple(expression.match(analyze(d.content)) for d in documents)))
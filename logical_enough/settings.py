@@ -1,12 +1,95 @@
 import os
 
+from sqlalchemy.pool import QueuePool
+
 DATA_FILES_DIRECTORY = './data/'
 DATABASE_FILE = 'logical-enough.db'
 
+# executed on each new SQLite connection (see https://www.sqlite.org/pragma.html)
+SQLITE_PRAGMAS = {
+    'foreign_keys': 'ON',
+    'journal_mode': 'WAL',  # readers do not block the writer (and conversely)
+    'busy_timeout': 5000,  # [ms] wait that long for a lock before giving up
+    'synchronous': 'NORMAL',  # safe in WAL mode
+    'cache_size': -16000,  # [KiB] (if negative)
+    'mmap_size': 64 * 1024 * 1024,  # [bytes]
+}
+
 APP_SETTINGS = {
     'SQLALCHEMY_TRACK_MODIFICATIONS': False,
     'SECRET_KEY': 'Cv6(ePlTWZ 098C9_%{5!E4t',
-    'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(os.path.abspath(DATA_FILES_DIRECTORY), DATABASE_FILE)
+    'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(os.path.abspath(DATA_FILES_DIRECTORY), DATABASE_FILE),
+    'SQLALCHEMY_ENGINE_OPTIONS': {
+        # keep the connections (and their cache) open, and share them between the threads of a worker
+        'poolclass': QueuePool,
+        'pool_size': 5,
+        'max_overflow': 10,
+        'pool_timeout': 10,  # [s]
+        'connect_args': {'check_same_thread': False, 'timeout': 5},
+    },
+
+    # number of retries (with an exponential backoff) when the database is still locked after `busy_timeout`
+    'DATABASE_LOCK_RETRIES': 3,
+    'DATABASE_LOCK_RETRY_DELAY': .05,  # [s]
+
+    # write the answers from a background thread, by batches
+    'BATCH_WRITER': True,
+    'BATCH_WRITER_SIZE': 100,  # [rows]
+    'BATCH_WRITER_INTERVAL': .05,  # [s]
+    'BATCH_WRITER_MAX_QUEUE': 10000,  # [rows], then written synchronously
+
+    # number of entries of the cache of challenges, questions and documents
+    'CONTENT_CACHE_SIZE': 4096,
+
+    # cache of the parsed expressions, analyzed documents and grading results: in memory (per worker), in front of
+    # a SQLite file in DATA_FILES_DIRECTORY, shared by the workers, for the grading results only (set
+    # RESULTS_CACHE_FILE to None to disable it)
+    'RESULTS_CACHE_SIZE': 4096,  # [entries]
+    'RESULTS_CACHE_FILE': 'cache.db',
+    'RESULTS_CACHE_MAX_SIZE': 100000,  # [entries]
+    'RESULTS_CACHE_TTL': 7 * 24 * 3600,  # [s]
+
+    # how long the browsers (and proxies) may reuse the results of `/api/checks` and `/api/checks_many`
+    'CHECKS_MAX_AGE': 3600,  # [s]
+
+    # URL of the live channel (`flask live-server`, e.g. "ws://localhost:5001/live"), used by the question editor and
+    # the challenge pages instead of one HTTP request per check (if set)
+    'LIVE_SERVER_URL': None,
+    'LIVE_MAX_MESSAGE_SIZE': 512 * 1024,  # [bytes], enough for LIVE_MAX_DOCUMENTS documents of ~250 characters
+    'LIVE_MAX_DOCUMENTS': 2000,  # per connection (they are kept analyzed in memory)
+
+    # origins (e.g. "https://example.org") of the pages allowed to open the live channel. If None, only the pages
+    # served on the same host as the channel are (the application must then be served on the same host)
+    'LIVE_ALLOWED_ORIGINS': None,
+
+    # check the large batches of documents (of `/api/checks_many` and `/api/checks_stream`) in a pool of processes
+    # (0 to disable it), by chunks. At most OFFLOAD_MAX_PENDING batches are in the pool, the next ones get a 503.
+    'OFFLOAD_WORKERS': 0,
+    'OFFLOAD_MIN_DOCUMENTS': 200,
+    'OFFLOAD_CHUNK_SIZE': 500,
+    'OFFLOAD_MAX_PENDING': 4,
+    'OFFLOAD_TIMEOUT': 30,  # [s]
+
+    # maximum number of documents checked at once by `/api/checks_stream`
+    'CHECKS_STREAM_MAX_DOCUMENTS': 50000,
+
+    # number of rows of the (admin) listings
+    'PAGE_SIZE': 50,
+
+    # number of rows fetched (and sent) at once by the exports
+    'EXPORT_BATCH_SIZE': 1000,
+
+    # trust the identity (id, name and is_admin) stored in the signed session cookie at login, rather than querying
+    # the user on each page (the admin pages always check against the database)
+    'SESSION_IDENTITY': False,
+
+    # preload the public challenges in `create_app()` (see README)
+    'WARMUP': False,
+
+    # count the SQL queries of each request, and log the ones that go over the thresholds
+    'SQL_PROFILING': False,
+    'SQL_PROFILING_MAX_QUERIES': 25,
+    'SQL_PROFILING_MAX_DURATION': .1,  # [s]
 }
 
 # Load the production settings, overwrite the existing ones if needed
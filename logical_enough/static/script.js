@@ -1,16 +1,149 @@
+/* requests to the API */
+const CHECK_DELAY = 250; // [ms] of inactivity before checking
+const CHECK_MAX_URL_LENGTH = 2000; // above, the documents are sent in the body of a POST
+
+let pending_requests = {};
+
+function debounced_ajax(key, make_options) {
+    // send the request given by `make_options()` (see `$.ajax()`, or `null` to send nothing) once there was no other
+    // call with the same key for CHECK_DELAY ms. The previous request with the same key is aborted, and only the
+    // latest response is given to the callbacks.
+    if (!(key in pending_requests))
+        pending_requests[key] = {timer: null, xhr: null, sequence: 0};
+
+    let state = pending_requests[key];
+    clearTimeout(state.timer);
+
+    state.timer = setTimeout(function () {
+        if (state.xhr !== null)
+            state.xhr.abort();
+
+        let sequence = ++state.sequence;
+        let options = make_options();
+        if (options === null)
+            return;
+
+        state.xhr = $.ajax($.extend({}, options, {
+            success: function (result) {
+                if (sequence === state.sequence)
+                    options.success(result);
+            },
+            error: function (xhr, status, error) {
+                if (status !== 'abort' && sequence === state.sequence)
+                    options.error(xhr, status, error);
+            },
+            complete: function () {
+                if (sequence === state.sequence)
+                    state.xhr = null;
+            }
+        }));
+    }, CHECK_DELAY);
+}
+
+function checks_many_request(search_expr, documents, success, error) {
+    // check all the documents at once: with `/api/checks_many` (which the browser can cache) if the URL is short
+    // enough, otherwise with `/api/checks_stream`. Either way, `success()` gets `{documents: [...]}`.
+    let data = {documents: documents, search_expression: search_expr};
+
+    if ($.param(data, true).length <= CHECK_MAX_URL_LENGTH) {
+        return {url: '/api/checks_many', data: data, traditional: true, success: success, error: error};
+    }
+
+    return {
+        url: '/api/checks_stream',
+        method: 'POST',
+        contentType: 'application/json',
+        data: JSON.stringify(data),
+        dataType: 'text',
+        success: function (result) {
+            success({documents: result.split('\n').filter(function (line) {
+                return line !== '';
+            }).map(JSON.parse)});
+        },
+        error: error
+    };
+}
+
+/* live channel (see `logical_enough/live.py`) */
+function live_open(url, on_message) {
+    // open the channel, or get `null` if it is not available (then, the API is used)
+    if (url === null || !('WebSocket' in window))
+        return null;
+
+    let channel = {socket: new WebSocket(url), is_open: false, is_closed: false, queue: [], id: 0};
+
+    channel.socket.onopen = function () {
+        channel.is_open = true;
+        channel.queue.forEach(function (message) {
+            channel.socket.send(message);
+        });
+        channel.queue = [];
+    };
+
+    channel.socket.onmessage = function (event) {
+        on_message(JSON.parse(event.data));
+    };
+
+    channel.socket.onclose = function () {
+        channel.is_open = false;
+        channel.is_closed = true;
+    };
+
+    return channel;
+}
+
+function live_send(channel, message) {
+    let data = JSON.stringify(message);
+    if (channel.is_open)
+        channel.socket.send(data);
+    else
+        channel.queue.push(data);
+}
+
+function live_send_expression(channel, expression) {
+    // the results of the previous expressions are ignored (and their evaluation is cancelled)
+    channel.id += 1;
+    live_send(channel, {expression: expression, id: channel.id});
+}
+
 /* modifications of documents */
-function documents_management_setup() {
+let documents_management_live = null;
+function documents_management_get() {
+    // the documents are stored as a JSON list (or, in older forms, separated by ';')
+    let value = $('#documents').val();
+
+    if (value === '')
+        return [];
+    if (value.charAt(0) === '[') {
+        try {
+            return JSON.parse(value);
+        } catch (e) {
+            console.log(e);
+        }
+    }
+
+    return value.split(';');
+}
+
+function documents_management_sync() {
+    let document_txts = [];
+
+    $('.inputDocument').each(function () {
+        document_txts.push($(this).val());
+    });
+
+    $('#documents').val(JSON.stringify(document_txts));
+}
+
+function documents_management_setup(live_url = null) {
     let $documents = $('#documents');
     $documents.attr('type', 'hidden');
 
-    let document_txts = $documents.val().split(';');
-    $documents.val('');
+    let document_txts = documents_management_get();
+    if (document_txts.length === 0)
+        document_txts.push('');
 
     let $table = $('<div id="tableInputDocuments"></div>');
-    for (let i in document_txts) {
-        documents_management_add_doc($table, document_txts[i], false);
-    }
-
     let $tableDiv = $('<div></div>');
     $tableDiv.append($table);
 
@@ -22,55 +155,58 @@ function documents_management_setup() {
 
     $tableDiv.insertAfter($documents);
 
+    for (let i in document_txts) {
+        documents_management_add_doc($table, document_txts[i], false);
+    }
+
+    documents_management_live = live_open(live_url, documents_management_live_message);
+    if (documents_management_live !== null) {
+        documents_management_live.documents = null;
+        documents_management_live.normalized_documents = [];
+        documents_management_live.modified_input = null;
+    }
+
     // add expr_hint and check fields
     let $hint_expr = $('#hint_expr');
     $hint_expr.keyup(function () {
-        documents_management_change_expr($hint_expr);
+        documents_management_check_all();
     });
 
-    documents_management_change_expr($hint_expr);
+    documents_management_check_all();
 }
 
 function documents_management_modify_doc(input) {
-    // modify list
-    let new_value = input.val();
-    let previous_value = input.data('prev-value');
-    let $documents = $('#documents');
-
-    let document_txts = $documents.val().split(';');
-    let index = document_txts.indexOf(previous_value);
-    if (index > -1) {
-        document_txts[index] = new_value;
-    } else {
-        document_txts.push(new_value);
-    }
-    $documents.val(document_txts.join(';'));
-    input.data('prev-value', new_value);
+    documents_management_sync();
 
     // check matching
-    documents_management_doc_check_match(input, $('#hint_expr').val(), true);
+    documents_management_check_all(input);
 }
 
 function documents_management_doc_check_match(input, search_expr, show_tooltip=false) {
-    $.ajax({
-        url: '/api/checks',
-        data: {
-            document: input.val(),
-            search_expression: search_expr,
-        },
-        success: function (result) {
-            if ('matched' in result) {
-                documents_management_set_matched(input, result['matched'], result['normalized_document'], show_tooltip);
-            } else {
+    // (one request per input, for the test documents of the explanations)
+    if (input.data('check-key') === undefined)
+        input.data('check-key', 'check-' + Object.keys(pending_requests).length);
+
+    debounced_ajax(input.data('check-key'), function () {
+        return {
+            url: '/api/checks',
+            data: {
+                document: input.val(),
+                search_expression: search_expr,
+            },
+            success: function (result) {
+                if ('matched' in result) {
+                    documents_management_set_matched(input, result['matched'], result['normalized_document'], show_tooltip);
+                } else {
+                    documents_management_set_matched(input, false);
+                    console.log(result);
+                }
+            },
+            error: function (xhr, status, error) {
                 documents_management_set_matched(input, false);
-                console.log(result);
+                console.log(error);
             }
-        },
-        error: function (xhr, status, error) {
-            documents_management_set_matched(input, false);
-            console.log(error);
-        }
-
+        };
     });
 }
 
@@ -85,8 +221,8 @@ function documents_management_set_matched(input, matched, normalized = "", show_
 }
 
 function documents_management_add_doc($table, txt, check=true) {
-    let $inputText = $('<input type="text" class="inputDocument form-control" value="' + txt + '" title="not set" />');
-    $inputText.data('prev-value', txt);
+    let $inputText = $('<input type="text" class="inputDocument form-control" title="not set" />');
+    $inputText.val(txt);
     $inputText.tooltip();
 
     $inputText.keyup(function () {
@@ -97,69 +233,92 @@ function documents_management_add_doc($table, txt, check=true) {
 
     let $linkDel = $('<button class="btn btn-default" type="button"><span class="glyphicon glyphicon-remove" aria-hidden="true"></span></button>');
     $linkDel.click(function () {
-        let val = $tr.find('.inputDocument').val();
-        let $documents = $('#documents');
-        let vals = $documents.val().split(';');
-        let index = vals.indexOf(val);
-        if (index > -1)
-            vals.splice(index, 1);
-        $documents.val(vals.join(';'));
         $tr.remove();
+        documents_management_sync();
     });
 
     $tr.append($('<div class="input-group-btn"></div>').append($linkDel));
 
     $table.append($tr);
-
-    let $documents = $('#documents');
-    let v = $documents.val();
-    if (v === '') {
-        v = txt;
-    } else {
-        v = v + ';' + txt;
-    }
-    $documents.val(v);
+    documents_management_sync();
 
     if (check)
-        documents_management_doc_check_match($inputText);
+        documents_management_check_all();
 }
 
-function documents_management_change_expr(input) {
-    let $documents = $('.inputDocument');
-    let vals = [];
+function documents_management_live_message(message) {
+    let channel = documents_management_live;
+
+    if ('normalized_documents' in message) {
+        channel.normalized_documents = message['normalized_documents'];
+    } else if ('id' in message && message['id'] === channel.id) {
+        let $documents = $('.inputDocument');
+
+        if ('error' in message) {
+            $documents.each(function () {
+                documents_management_set_matched($(this), false);
+            });
+        } else {
+            message['matched'].forEach(function (matched, i) {
+                let $input = $documents.eq(message['offset'] + i);
+                documents_management_set_matched(
+                    $input, matched, channel.normalized_documents[message['offset'] + i],
+                    channel.modified_input !== null && $input.is(channel.modified_input));
+            });
+        }
+    } else if ('error' in message) {
+        console.log(message['error']);
+    }
+}
 
-    $documents.each(function () {
-        vals.push($(this).val());
-    });
+function documents_management_check_all(modified_input = null) {
+    // check all the documents against the expression: through the live channel if it is open, otherwise in a single
+    // (debounced) request. The inputs are only collected when it is sent, so that the response matches them.
+    let channel = documents_management_live;
+    if (channel !== null && !channel.is_closed) {
+        let vals = [];
+        $('.inputDocument').each(function () {
+            vals.push($(this).val());
+        });
 
-    $.ajax({
-        url: '/api/checks_many',
-        data: {
-            documents: vals,
-            search_expression: input.val()
-        },
-        traditional: true,
-        success: function (result) {
-            if ('documents' in result) {
-                let documents = result['documents'];
-                let i = 0;
-                $documents.each(function () {
-                    documents_management_set_matched($(this), documents[i]['matched'], documents[i]['normalized_document']);
-                    i += 1;
-                })
-            } else {
-                console.log(result);
-            }
-        },
-        error: function (xhr, status, error) {
-            console.log(error);
+        let documents = JSON.stringify(vals);
+        if (documents !== channel.documents) {
+            channel.documents = documents;
+            live_send(channel, {documents: vals});
         }
 
+        channel.modified_input = modified_input;
+        live_send_expression(channel, $('#hint_expr').val());
+        return;
+    }
+
+    debounced_ajax('documents', function () {
+        let $documents = $('.inputDocument');
+        let vals = [];
+
+        $documents.each(function () {
+            vals.push($(this).val());
+        });
+
+        if (vals.length === 0)
+            return null;
+
+        return checks_many_request($('#hint_expr').val(), vals, function (result) {
+            let documents = result['documents'];
+            $documents.each(function (i) {
+                let $input = $(this);
+                documents_management_set_matched(
+                    $input, documents[i]['matched'], documents[i]['normalized_document'],
+                    modified_input !== null && $input.is(modified_input));
+            });
+        }, function (xhr, status, error) {
+            console.log(error);
+        });
     });
 }
 
 /* challenge stuffs */
-function challenge_setup(user, challenge, question) {
+function challenge_setup(user, challenge, question, live_url = null) {
     let $search_expr = $('#search_expr');
     let $button = $('#search_button');
 
@@ -167,6 +326,21 @@ function challenge_setup(user, challenge, question) {
         challenge_test($search_expr, user, challenge, question);
     });
 
+    // preview the results while typing (the answer is only checked with the button)
+    let channel = live_open(live_url, function (message) {
+        challenge_live_message(channel, message);
+    });
+
+    if (channel !== null) {
+        channel.documents = [];
+        channel.matched = [];
+
+        live_send(channel, {question: question});
+        $search_expr.keyup(function () {
+            live_send_expression(channel, $search_expr.val());
+        });
+    }
+
     // first time
     challenge_test($search_expr, user, challenge, question);
 }
@@ -195,6 +369,26 @@ function challenge_test(input, user, challenge, question) {
     $button.prop('disabled', false);
 }
 
+function challenge_live_message(channel, message) {
+    if ('documents' in message) {
+        channel.documents = message['documents'];
+    } else if ('id' in message && message['id'] === channel.id && !('error' in message)) {
+        if (message['offset'] === 0)
+            channel.matched = [];
+
+        channel.matched = channel.matched.concat(message['matched']);
+
+        if (message['done']) {
+            let result = {good_documents: [], wrong_documents: [], question_end: false};
+            channel.documents.forEach(function (d, i) {
+                (channel.matched[i] ? result['good_documents'] : result['wrong_documents']).push(d);
+            });
+
+            challenge_treat_result(result);
+        }
+    }
+}
+
 function challenge_treat_result(result) {
     let $goodDocs = $('#goodDocs');
     let $wrongDocs = $('#wrongDocs');
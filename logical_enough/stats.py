@@ -0,0 +1,155 @@
+import collections
+
+from sqlalchemy import text
+
+from logical_enough import db
+from logical_enough.models import User, QuestionStats, ChallengeStats, UserChallengeStats, DistinctAnswer
+
+
+# Upserts (which need SQLite >= 3.24), incrementing the counters by the values of the parameters
+UPSERT_QUESTION = text(
+    'INSERT INTO question_stats '
+    '(question, challenge, attempts, successes, distinct_answers, solve_time, date_created, date_modified) '
+    'SELECT id, challenge, :attempts, :successes, :distinct_answers, :solve_time, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP '
+    'FROM question WHERE id = :question '
+    'ON CONFLICT (question) DO UPDATE SET '
+    'attempts = attempts + excluded.attempts, successes = successes + excluded.successes, '
+    'distinct_answers = distinct_answers + excluded.distinct_answers, '
+    'solve_time = solve_time + excluded.solve_time, date_modified = CURRENT_TIMESTAMP')
+
+# the new answers are the ones which are actually inserted
+INSERT_DISTINCT_ANSWER = text(
+    'INSERT OR IGNORE INTO distinct_answer (question, answer, date_created, date_modified) '
+    'VALUES (:question, :answer, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)')
+
+UPSERT_CHALLENGE = text(
+    'INSERT INTO challenge_stats (challenge, started, finished, attempts, date_created, date_modified) '
+    'SELECT challenge, 0, 0, :attempts, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP FROM question WHERE id = :question '
+    'ON CONFLICT (challenge) DO UPDATE SET '
+    'attempts = attempts + excluded.attempts, date_modified = CURRENT_TIMESTAMP')
+
+UPSERT_CHALLENGE_PROGRESS = text(
+    'INSERT INTO challenge_stats (challenge, started, finished, attempts, date_created, date_modified) '
+    'VALUES (:challenge, :started, :finished, 0, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP) '
+    'ON CONFLICT (challenge) DO UPDATE SET '
+    'started = started + excluded.started, finished = finished + excluded.finished, '
+    'date_modified = CURRENT_TIMESTAMP')
+
+UPSERT_USER = text(
+    'INSERT INTO user_challenge_stats (user, challenge, attempts, solved, finished, date_created, date_modified) '
+    'SELECT :user, challenge, :attempts, :solved, 0, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP '
+    'FROM question WHERE id = :question '
+    'ON CONFLICT (user, challenge) DO UPDATE SET '
+    'attempts = attempts + excluded.attempts, solved = solved + excluded.solved, date_modified = CURRENT_TIMESTAMP')
+
+UPSERT_USER_END = text(
+    'INSERT INTO user_challenge_stats (user, challenge, attempts, solved, finished, date_created, date_modified) '
+    'VALUES (:user, :challenge, 0, 0, 1, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP) '
+    'ON CONFLICT (user, challenge) DO UPDATE SET finished = 1, date_modified = CURRENT_TIMESTAMP')
+
+
+def record_answers(rows: list) -> None:
+    """Update the statistics with new answers (called by the batch writer, in the transaction that inserts them)"""
+
+    questions = collections.defaultdict(
+        lambda: {'attempts': 0, 'successes': 0, 'distinct_answers': 0, 'solve_time': .0})
+    users = collections.defaultdict(lambda: {'attempts': 0, 'solved': 0})  # per (user, question)
+    answers = collections.defaultdict(set)
+
+    for row in rows:
+        is_correct = row.get('is_correct', True)
+
+        q = questions[row['question']]
+        q['attempts'] += 1
+        if row.get('answer') is not None:
+            answers[row['question']].add(row['answer'])
+        if is_correct:
+            q['successes'] += 1
+            q['solve_time'] += row.get('duration') or .0
+
+        u = users[row['user'], row['question']]
+        u['attempts'] += 1
+        if is_correct:
+            u['solved'] += 1
+
+    for question_id, question_answers in answers.items():
+        questions[question_id]['distinct_answers'] = db.session.execute(
+            INSERT_DISTINCT_ANSWER, [{'question': question_id, 'answer': a} for a in question_answers]).rowcount
+
+    params = [dict(question=k, **v) for k, v in questions.items()]
+    db.session.execute(UPSERT_QUESTION, params)
+    db.session.execute(UPSERT_CHALLENGE, [{'question': k, 'attempts': v['attempts']} for k, v in questions.items()])
+    db.session.execute(UPSERT_USER, [dict(user=k[0], question=k[1], **v) for k, v in users.items()])
+
+
+def record_start(challenge_id: int) -> None:
+    """A challenge was started (in the current transaction)"""
+
+    db.session.execute(UPSERT_CHALLENGE_PROGRESS, {'challenge': challenge_id, 'started': 1, 'finished': 0})
+
+
+def record_end(challenge_id: int, user_id: int) -> None:
+    """A challenge was finished (in the current transaction)"""
+
+    db.session.execute(UPSERT_CHALLENGE_PROGRESS, {'challenge': challenge_id, 'started': 0, 'finished': 1})
+    db.session.execute(UPSERT_USER_END, {'user': user_id, 'challenge': challenge_id})
+
+
+def rebuild(connection=None) -> None:
+    """Recompute all the statistics from the answers and the progress of the users
+    (in the transaction of ``connection``, or of the session)
+    """
+
+    connection = connection if connection is not None else db.session
+
+    for model in [QuestionStats, ChallengeStats, UserChallengeStats, DistinctAnswer]:
+        connection.execute(model.__table__.delete())
+
+    connection.execute(
+        'INSERT INTO distinct_answer (question, answer, date_created, date_modified) '
+        'SELECT DISTINCT question, answer, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP FROM answer WHERE answer IS NOT NULL')
+
+    connection.execute(
+        'INSERT INTO question_stats '
+        '(question, challenge, attempts, successes, distinct_answers, solve_time, date_created, date_modified) '
+        'SELECT question.id, question.challenge, COUNT(answer.id), COALESCE(SUM(answer.is_correct), 0), '
+        'COUNT(DISTINCT answer.answer), COALESCE(SUM(CASE WHEN answer.is_correct THEN answer.duration END), 0), '
+        'CURRENT_TIMESTAMP, CURRENT_TIMESTAMP '
+        'FROM question JOIN answer ON answer.question = question.id GROUP BY question.id')
+
+    connection.execute(
+        'INSERT INTO challenge_stats (challenge, started, finished, attempts, date_created, date_modified) '
+        'SELECT challenge.id, '
+        '(SELECT COUNT(*) FROM user_challenge WHERE user_challenge.challenge = challenge.id), '
+        '(SELECT COUNT(*) FROM user_challenge WHERE user_challenge.challenge = challenge.id AND is_done), '
+        '(SELECT COALESCE(SUM(attempts), 0) FROM question_stats WHERE question_stats.challenge = challenge.id), '
+        'CURRENT_TIMESTAMP, CURRENT_TIMESTAMP '
+        'FROM challenge WHERE EXISTS (SELECT 1 FROM user_challenge WHERE user_challenge.challenge = challenge.id) '
+        'OR EXISTS (SELECT 1 FROM question_stats WHERE question_stats.challenge = challenge.id)')
+
+    connection.execute(
+        'INSERT INTO user_challenge_stats (user, challenge, attempts, solved, finished, date_created, date_modified) '
+        'SELECT answer.user, question.challenge, COUNT(answer.id), COALESCE(SUM(answer.is_correct), 0), '
+        'EXISTS (SELECT 1 FROM user_challenge WHERE user_challenge.user = answer.user '
+        'AND user_challenge.challenge = question.challenge AND is_done), CURRENT_TIMESTAMP, CURRENT_TIMESTAMP '
+        'FROM answer JOIN question ON question.id = answer.question GROUP BY answer.user, question.challenge')
+
+    # (finished without any answer, e.g. before the answers were recorded)
+    connection.execute(
+        'INSERT INTO user_challenge_stats (user, challenge, attempts, solved, finished, date_created, date_modified) '
+        'SELECT user, challenge, 0, 0, 1, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP FROM user_challenge WHERE is_done '
+        'AND NOT EXISTS (SELECT 1 FROM user_challenge_stats WHERE user_challenge_stats.user = user_challenge.user '
+        'AND user_challenge_stats.challenge = user_challenge.challenge)')
+
+
+def leaderboard(challenge_id: int, limit: int = 10) -> list:
+    """Get the users which solved the most questions of a challenge (with the fewest attempts)"""
+
+    columns = [User.name, UserChallengeStats.solved, UserChallengeStats.finished, UserChallengeStats.attempts]
+
+    return db.session.query(*columns)\
+        .join(User, User.id == UserChallengeStats.user)\
+        .filter(UserChallengeStats.challenge == challenge_id)\
+        .order_by(UserChallengeStats.solved.desc(), UserChallengeStats.attempts)\
+        .limit(limit)\
+        .all()
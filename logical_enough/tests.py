@@ -1,4 +1,18 @@
 from unittest import TestCase
+import contextlib
+import csv
+import io
+import html
+import re
+import gc
+import threading
+import multiprocessing
+import concurrent.futures
+import asyncio
+import socket
+import base64
+import struct
+import time
 import json
 import tempfile
 import shutil
@@ -6,9 +20,16 @@ import os
 
 import flask
 
-from logical_enough import db, settings, create_app, logic
-from logical_enough.models import User, Challenge, Question, UserChallenge, Answer
+from logical_enough import db, settings, create_app, logic, commit_with_retry, content, results, importer, stats, live
+from logical_enough.models import User, Challenge, Question, UserChallenge, Answer, Document, QuestionStats, \
+    ChallengeStats, UserChallengeStats
 from logical_enough.base_views import PageContextMixin
+from logical_enough.profiling import QueryCounter
+from logical_enough.cache import LRUCache, SQLiteCache, TieredCache, SingleFlight
+from logical_enough.migrations import upgrade_database
+from logical_enough.warmup import warm_up
+from logical_enough.writer import batch_writer
+from logical_enough.offload import offloader, OverloadedException
 
 
 class TestLogic(TestCase):
@@ -73,6 +94,29 @@ class TestLogic(TestCase):
                 x_toks = logic.analyze(x)
                 self.assertFalse(s.match(x_toks), msg=e + ' is matching ' + x)
 
+    def test_match_many(self):
+        documents = ['w', 'b x', 'Été w', '', 'x "z"', 'w b'] * 5
+        expression = logic.parse('(w OR b) -x')
+        expected = [expression.match(logic.analyze(d)) for d in documents]
+
+        self.assertEqual(logic.match_many(expression, documents), expected)
+
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=2, mp_context=multiprocessing.get_context('spawn')) as executor:
+            self.assertEqual(logic.match_many(expression, documents, executor, workers=2), expected)
+            self.assertEqual(logic.match_many(expression, [], executor, workers=2), [])
+            self.assertEqual(logic.match_many(expression, documents, executor), expected)  # a single shard
+
+            # the shards can also send back the normalized documents
+            shards = logic.Shards(expression, documents, executor, 7, normalize=True)
+            try:
+                self.assertEqual(
+                    [n for f in shards.futures for n in f.result()],
+                    [' '.join(str(t.value) for t in logic.analyze(d)) for d in documents])
+                self.assertEqual([m for i in range(len(shards.futures)) for m in shards.matched(i)], expected)
+            finally:
+                shards.close()
+
 
 class TestFlask(TestCase):
 
@@ -99,6 +143,10 @@ class TestFlask(TestCase):
         db.create_all()
         self.db_session = db.session
 
+        # the content cache outlives the database
+        content.content_cache.clear()
+        content.content_cache.version = None
+
         # add admin and user
         self.admin = User('admin', is_admin=True)
         self.db_session.add(self.admin)
@@ -117,6 +165,7 @@ class TestFlask(TestCase):
         self.client = self.app.test_client(use_cookies=True)
 
     def tearDown(self):
+        batch_writer.flush()
         shutil.rmtree(self.data_files_directory)
         self.app_context.pop()
 
@@ -137,6 +186,43 @@ class TestFlask(TestCase):
         with self.client.session_transaction() as session:
             return PageContextMixin.LOGIN_VAR not in session
 
+    def create_challenge(self, *questions, name='xxx', is_public=True):
+        """Create a challenge and its questions, in the given order.
+
+        :param questions: ``(hint_expr, wrong_docs, good_docs)`` of each question
+        :return: the challenge and the list of its questions
+        """
+
+        challenge = Challenge(name, is_public=is_public)
+        self.db_session.add(challenge)
+        self.db_session.commit()
+
+        questions = [Question(challenge.id, *args, position=i) for i, args in enumerate(questions)]
+        self.db_session.add_all(questions)
+        self.db_session.commit()
+        Question.renumber(challenge.id)
+        self.db_session.commit()
+
+        return challenge, questions
+
+    @contextlib.contextmanager
+    def assertQueryBudget(self, budget, msg=None):
+        """Check that the code within the context does not execute more than ``budget`` SQL queries.
+
+        Note: the session is cleared first, so that the identity map does not hide any query
+        (objects previously obtained from the session are detached).
+        """
+
+        db.session.remove()
+
+        with QueryCounter() as counter:
+            yield counter
+
+        self.assertLessEqual(
+            counter.count, budget,
+            msg='{}: {} queries (repeated: {})'.format(
+                msg or 'over budget', counter.count, counter.repeated_statements()))
+
 
 class TestAPI(TestFlask):
     def test_checks(self):
@@ -174,6 +260,81 @@ class TestAPI(TestFlask):
 
         self.assertEqual(matched, [True, True, False])
 
+    def test_conditional_get(self):
+        data = {'search_expression': 'w OR b', 'documents': ['w', 'x']}
+
+        response = self.client.get('/api/checks_many', query_string=data)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('max-age', response.headers['Cache-Control'])
+
+        etag = response.headers['ETag']
+        self.assertFalse(etag.startswith('W/'))  # strong
+
+        # the same request gives the same validator, and 304 if the client has it
+        self.assertEqual(self.client.get('/api/checks_many', query_string=data).headers['ETag'], etag)
+
+        response = self.client.get('/api/checks_many', query_string=data, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.get_data(), b'')
+
+        # ... even if a proxy made it weak (e.g. when compressing the response)
+        response = self.client.get('/api/checks_many', query_string=data, headers={'If-None-Match': 'W/' + etag})
+        self.assertEqual(response.status_code, 304)
+
+        # not for other arguments, nor for another version of the logic
+        data['documents'].append('b')
+        self.assertEqual(
+            self.client.get('/api/checks_many', query_string=data, headers={'If-None-Match': etag}).status_code, 200)
+
+        data = {'search_expression': 'w', 'document': 'w'}
+        etag = self.client.get('/api/checks', query_string=data).headers['ETag']
+
+        executed = results.single_flight.executed
+        response = self.client.get('/api/checks', query_string=data, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(results.single_flight.executed, executed)  # nothing was evaluated
+
+        engine_version = logic.ENGINE_VERSION
+        try:
+            logic.ENGINE_VERSION = engine_version + '.1'
+            response = self.client.get('/api/checks', query_string=data, headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response.headers['ETag'], etag)
+        finally:
+            logic.ENGINE_VERSION = engine_version
+
+        # errors are not cacheable
+        response = self.client.get('/api/checks', query_string={'search_expression': 'w (', 'document': 'w'})
+        self.assertEqual(response.status_code, 400)
+        self.assertNotIn('ETag', response.headers)
+
+    def test_checks_stream(self):
+
+        def make_request(data, status=200):
+            response = self.client.post('/api/checks_stream', json=data)
+            self.assertEqual(response.status_code, status)
+            return response
+
+        response = make_request({'search_expression': 'w OR b', 'documents': ['w', 'b', 'x']})
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+
+        lines = [json.loads(line) for line in response.get_data().decode().splitlines()]
+        self.assertEqual([line['matched'] for line in lines], [True, True, False])
+        self.assertEqual(lines[0]['document'], 'w')
+
+        # without the documents
+        response = make_request({'search_expression': 'w', 'documents': ['w', 'x'], 'echo': False})
+        lines = [json.loads(line) for line in response.get_data().decode().splitlines()]
+        self.assertEqual(lines, [{'matched': True}, {'matched': False}])
+
+        # error behavior
+        self.assertIn('message', make_request({'search_expression': 'a (b', 'documents': []}, status=400).json)
+        make_request({'search_expression': 'w', 'documents': 'w'}, status=400)
+        make_request({'documents': ['w']}, status=400)
+
+        self.app.config['CHECKS_STREAM_MAX_DOCUMENTS'] = 2
+        make_request({'search_expression': 'w', 'documents': ['w'] * 3}, status=413)
+
     def test_check_question(self):
 
         def make_request(search_expr, user_id, challenge_id, question_id, status=200):
@@ -244,6 +405,7 @@ class TestAPI(TestFlask):
 
         # wrong answer to first question
         answer_count = Answer.query.count()
+        correct_answers = Answer.query.filter(Answer.is_correct.is_(True))
 
         test_expr = logic.parse('w')
         j = make_request(str(test_expr), self.admin.id, challenge.id, question_1.id)
@@ -272,10 +434,17 @@ class TestAPI(TestFlask):
         user_challenge = UserChallenge.query.get(user_challenge.id)
         self.assertFalse(user_challenge.is_done)
         self.assertEqual(user_challenge.current_question, question_2.id)
+        self.assertEqual(user_challenge.current_position, 1)
 
-        self.assertEqual(Answer.query.count(), answer_count + 1)
+        response = self.client.get(flask.url_for('index'))
+        self.assertIn('Commencé (1/2)', response.get_data().decode())
+
+        self.assertTrue(batch_writer.flush(timeout=5))
+        self.assertEqual(correct_answers.count(), answer_count + 1)
+        self.assertEqual(Answer.query.count(), answer_count + 2)  # the wrong answer is recorded as well
         last_answer = Answer.query.order_by(Answer.id.desc()).first()
         self.assertEqual(last_answer.answer, str(search_expression_1))
+        self.assertTrue(last_answer.is_correct)
 
         # if we try the same question, we get error
         make_request(str(search_expression_1), self.admin.id, challenge.id, question_1.id, status=400)
@@ -288,7 +457,8 @@ class TestAPI(TestFlask):
         user_challenge = UserChallenge.query.get(user_challenge.id)
         self.assertTrue(user_challenge.is_done)  # ok, we're good
 
-        self.assertEqual(Answer.query.count(), answer_count + 2)
+        self.assertTrue(batch_writer.flush(timeout=5))
+        self.assertEqual(correct_answers.count(), answer_count + 2)
         last_answer = Answer.query.order_by(Answer.id.desc()).first()
         self.assertEqual(last_answer.answer, str(search_expression_2))
 
@@ -472,6 +642,232 @@ class TestViews(TestFlask):
         self.assertEqual(response.status_code, 403)
         self.assertEqual(Challenge.query.count(), challenges_count + 1)  # cannot delete
 
+    def test_admin_questions_documents(self):
+        self.assertTrue(self.login(self.admin.name))
+
+        self.client.post(flask.url_for('admin.challenges'), data={'name': 'xxx'}, follow_redirects=False)
+        challenge = Challenge.query.order_by(Challenge.id.desc()).first()
+
+        # documents are given as a JSON list, so they can contain the old separator
+        documents = ['alpha; beta', 'gamma', 'alpha']
+        response = self.client.post(flask.url_for('admin.question-create', id=challenge.id), data={
+            'hint_expr': 'alpha',
+            'hint': '',
+            'documents': json.dumps(documents)
+        }, follow_redirects=False)
+        self.assertEqual(response.status_code, 302)
+
+        question = Question.query.order_by(Question.id.desc()).first()
+        self.assertEqual(question.get_good_documents(), ['alpha; beta', 'alpha'])
+        self.assertEqual(question.get_wrong_documents(), ['gamma'])
+
+        stored = Document.query.filter(Document.question == question.id).order_by(Document.position).all()
+        self.assertEqual([d.position for d in stored], [0, 1, 2])
+        self.assertEqual([d.content_hash for d in stored], [Document.hash(d) for d in question.get_documents()])
+
+        # and are given back as such
+        response = self.client.get(flask.url_for('admin.question', id=question.id, challenge_id=challenge.id))
+        self.assertIn(json.dumps(question.get_documents()).replace('"', '&quot;'), response.get_data().decode())
+
+        # editing replaces the documents
+        response = self.client.post(flask.url_for('admin.question', id=question.id, challenge_id=challenge.id), data={
+            'hint_expr': 'gamma',
+            'hint': '',
+            'documents': json.dumps(documents[1:])
+        }, follow_redirects=False)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Document.query.filter(Document.question == question.id).count(), 2)
+
+        # deleting the question deletes its documents
+        response = self.client.post(
+            flask.url_for('admin.question-delete', id=question.id, challenge_id=challenge.id), follow_redirects=False)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Document.query.filter(Document.question == question.id).count(), 0)
+
+    def test_admin_pagination(self):
+        self.app.config['PAGE_SIZE'] = 3
+
+        names = ['user{}'.format(i) for i in range(8)]
+        self.db_session.add_all(User(name) for name in names)
+        self.db_session.commit()
+
+        self.assertTrue(self.login(self.admin.name))
+
+        def walk(**kwargs):
+            """Follow the "next" links, and get the users"""
+
+            seen = []
+            url = flask.url_for('admin.users', **kwargs)
+            while url is not None:
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                text = response.get_data().decode()
+
+                seen.extend(re.findall(r'<td><span>(.*?)</span> </td>', text))
+                next_link = re.search(r'<li class="next"><a href="(.*?)">', text)
+                url = html.unescape(next_link.group(1)) if next_link else None
+
+            return seen
+
+        self.assertEqual(walk(), sorted(names + ['admin', 'user']))
+        self.assertEqual(walk(tri='-name'), sorted(names + ['admin', 'user'], reverse=True))
+        self.assertEqual(walk(tri='id'), ['admin', 'user'] + names)
+        self.assertEqual(walk(q='user1'), ['user1'])
+        self.assertEqual(walk(q='%'), [])  # not a wildcard
+        self.assertEqual(walk(tri='whatever', q='user'), sorted(names + ['user']))
+
+        response = self.client.get(flask.url_for('admin.users', tri='name', apres_id='x'))  # ignored
+        self.assertEqual(response.status_code, 200)
+
+    def test_admin_answers(self):
+        challenge, (question, ) = self.create_challenge(('alpha', ['beta'], ['alpha']))
+
+        self.db_session.add_all([
+            Answer(self.user.id, question.id, 'first answer'), Answer(self.admin.id, question.id, 'second answer')])
+        self.db_session.commit()
+
+        self.assertTrue(self.login(self.admin.name))
+
+        response = self.client.get(
+            flask.url_for('admin.question-answers', id=question.id, challenge_id=challenge.id))
+        self.assertEqual(response.status_code, 200)
+        text = response.get_data().decode()
+        self.assertLess(text.index('second answer'), text.index('first answer'))  # last ones first
+        self.assertIn('<td>user</td>', text)
+
+        response = self.client.get(
+            flask.url_for('admin.question-answers', id=question.id, challenge_id=challenge.id, q='adm'))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('first answer', response.get_data().decode())
+        self.assertIn('second answer', response.get_data().decode())
+
+    def test_admin_export(self):
+        challenge, (question, ) = self.create_challenge(('alpha', ['beta'], ['alpha']))
+
+        self.db_session.add(UserChallenge(self.user.id, challenge.id, question.id))
+        self.db_session.add_all(Answer(self.user.id, question.id, 'answer {}'.format(i)) for i in range(25))
+        self.db_session.commit()
+
+        self.assertTrue(self.login(self.admin.name))
+        self.app.config['EXPORT_BATCH_SIZE'] = 10
+
+        response = self.client.get(flask.url_for('admin.export', name='answers', format_='csv'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_streamed)
+        self.assertIn('attachment', response.headers['Content-Disposition'])
+
+        rows = list(csv.DictReader(io.StringIO(response.get_data().decode())))
+        self.assertEqual(len(rows), 25)
+        self.assertEqual(rows[0]['user'], 'user')
+        self.assertEqual(rows[0]['challenge'], 'xxx')
+        self.assertEqual(rows[-1]['answer'], 'answer 24')
+
+        response = self.client.get(
+            flask.url_for('admin.export', name='progress', format_='jsonl', challenge=challenge.id))
+        self.assertEqual(response.status_code, 200)
+        rows = [json.loads(line) for line in response.get_data().decode().splitlines()]
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['user'], 'user')
+        self.assertEqual(rows[0]['question_count'], 1)
+
+        response = self.client.get(
+            flask.url_for('admin.export', name='progress', format_='jsonl', challenge=challenge.id + 1))
+        self.assertEqual(response.get_data().decode(), '')
+
+        self.assertEqual(
+            self.client.get(flask.url_for('admin.export', name='questions', format_='csv')).status_code, 404)
+        self.assertEqual(
+            self.client.get(flask.url_for('admin.export', name='users', format_='xls')).status_code, 404)
+
+        # CLI
+        result = self.app.test_cli_runner().invoke(args=['export', 'users', '--format', 'jsonl'])
+        self.assertEqual(result.exit_code, 0, msg=result.output)
+        self.assertEqual([json.loads(line)['name'] for line in result.output.splitlines()], ['admin', 'user'])
+
+    def test_admin_questions_order(self):
+        self.assertTrue(self.login(self.admin.name))
+
+        self.client.post(flask.url_for('admin.challenges'), data={'name': 'xxx'}, follow_redirects=False)
+        challenge = Challenge.query.order_by(Challenge.id.desc()).first()
+
+        def check_order(ids):
+            questions = challenge.get_questions()
+            self.assertEqual([q.id for q in questions], ids)
+            for o, q in zip(Question.ordering(ids), questions):
+                self.assertEqual(q.position, o['position'])
+                self.assertEqual(q.next_question, o['next_question'])
+
+        # questions are added at the end
+        for search_expression in ['alpha', 'beta', 'gamma', 'delta']:
+            response = self.client.post(flask.url_for('admin.question-create', id=challenge.id), data={
+                'hint_expr': search_expression,
+                'hint': '',
+                'documents': 'alpha;beta;gamma;delta'
+            }, follow_redirects=False)
+            self.assertEqual(response.status_code, 302)
+
+        ids = [q.id for q in Question.query.filter(Question.challenge == challenge.id).order_by(Question.id)]
+        check_order(ids)
+
+        # reorder
+        new_order = [ids[2], ids[0], ids[3], ids[1]]
+        response = self.client.post(flask.url_for('admin.challenge-reorder', id=challenge.id), data={
+            'order': ','.join(str(i) for i in new_order)
+        }, follow_redirects=False)
+        self.assertEqual(response.status_code, 302)
+        check_order(new_order)
+
+        # incorrect orders are refused
+        for order in [new_order[:-1], new_order + [new_order[0]], ['x']]:
+            response = self.client.post(flask.url_for('admin.challenge-reorder', id=challenge.id), data={
+                'order': ','.join(str(i) for i in order)
+            }, follow_redirects=False)
+            self.assertEqual(response.status_code, 302)
+            check_order(new_order)
+
+        # deleting keeps the positions dense, in the same transaction
+        renumber = Question.renumber
+        try:
+            def fail(*args, **kwargs):
+                raise RuntimeError('renumbering failed')
+
+            Question.renumber = staticmethod(fail)
+            with self.assertRaises(RuntimeError):
+                self.client.post(flask.url_for('admin.question-delete', id=ids[0], challenge_id=challenge.id))
+        finally:
+            Question.renumber = renumber
+
+        db.session.rollback()
+        self.assertIsNotNone(Question.query.get(ids[0]))
+        check_order(new_order)
+
+        response = self.client.post(
+            flask.url_for('admin.question-delete', id=ids[0], challenge_id=challenge.id), follow_redirects=False)
+        self.assertEqual(response.status_code, 302)
+        check_order([ids[2], ids[3], ids[1]])
+
+        # the challenge follows the order
+        self.client.get(flask.url_for('admin.challenge-toggle', id=challenge.id))
+        response = self.client.get(flask.url_for('challenge', id=challenge.id))
+        self.assertIn('question 1/3', response.get_data().decode())
+        user_challenge = UserChallenge.query.filter(UserChallenge.challenge == challenge.id).first()
+        self.assertEqual(user_challenge.current_question, ids[2])
+
+        # ... and so do the counters
+        self.db_session.expire_all()
+        self.assertEqual(Challenge.query.get(challenge.id).question_count, 3)
+        self.assertEqual(user_challenge.current_position, 0)
+
+        response = self.client.post(flask.url_for('admin.challenge-reorder', id=challenge.id), data={
+            'order': ','.join(str(i) for i in [ids[3], ids[1], ids[2]])
+        }, follow_redirects=False)
+        self.assertEqual(response.status_code, 302)
+
+        self.db_session.expire_all()
+        self.assertEqual(UserChallenge.query.get(user_challenge.id).current_position, 2)
+        response = self.client.get(flask.url_for('challenge', id=challenge.id))
+        self.assertIn('question 3/3', response.get_data().decode())
+
     def test_admin_questions_management(self):
         challenge_name = 'xxx'
         self.assertTrue(self.login(self.admin.name))
@@ -635,3 +1031,1107 @@ class TestViews(TestFlask):
         self.assertEqual(response.status_code, 403)
 
         self.assertEqual(Question.query.count(), question_count + 1)
+
+
+class TestQueryBudget(TestFlask):
+
+    def setUp(self):
+        super().setUp()
+
+        # create a public challenge with a few questions
+        self.assertTrue(self.login(self.admin.name))
+
+        self.client.post(flask.url_for('admin.challenges'), data={'name': 'xxx'}, follow_redirects=False)
+        challenge = Challenge.query.order_by(Challenge.id.desc()).first()
+
+        for search_expression in ['a OR b', 'w OR -b', 'c']:
+            self.client.post(flask.url_for('admin.question-create', id=challenge.id), data={
+                'hint_expr': search_expression,
+                'hint': '',
+                'documents': 'a;b;c'
+            }, follow_redirects=False)
+
+        self.client.get(flask.url_for('admin.challenge-toggle', id=challenge.id))
+
+        self.challenge_id = challenge.id
+        self.question_ids = [q.id for q in Question.query.filter(Question.challenge == challenge.id).all()]
+        self.admin_id = self.admin.id
+
+    def test_visitors_budget(self):
+
+        with self.assertQueryBudget(4, 'index'):
+            response = self.client.get(flask.url_for('index'))
+            self.assertEqual(response.status_code, 200)
+
+        with self.assertQueryBudget(3, 'index (cached)'):
+            response = self.client.get(flask.url_for('index'))
+            self.assertEqual(response.status_code, 200)
+
+        with self.assertQueryBudget(8, 'challenge (start)'):
+            response = self.client.get(flask.url_for('challenge', id=self.challenge_id))
+            self.assertEqual(response.status_code, 200)
+
+        with self.assertQueryBudget(3, 'challenge'):
+            response = self.client.get(flask.url_for('challenge', id=self.challenge_id))
+            self.assertEqual(response.status_code, 200)
+
+        def check(search_expression):
+            return self.client.post('/api/check_question', data={
+                'search_expression': search_expression,
+                'user': self.admin_id,
+                'challenge': self.challenge_id,
+                'question': self.question_ids[0]
+            })
+
+        with self.assertQueryBudget(3, 'check_question (wrong)'):
+            self.assertFalse(json.loads(check('w').get_data().decode())['question_end'])
+
+        with self.assertQueryBudget(3, 'check_question (good)'):
+            self.assertTrue(json.loads(check('a OR b').get_data().decode())['question_end'])
+
+    def test_admin_budget(self):
+
+        with self.assertQueryBudget(2, 'users'):
+            self.assertEqual(self.client.get(flask.url_for('admin.users')).status_code, 200)
+
+        with self.assertQueryBudget(2, 'challenges'):
+            self.assertEqual(self.client.get(flask.url_for('admin.challenges')).status_code, 200)
+
+        with self.assertQueryBudget(3, 'challenge'):
+            response = self.client.get(flask.url_for('admin.challenge', id=self.challenge_id))
+            self.assertEqual(response.status_code, 200)
+
+        with self.assertQueryBudget(4, 'question'):
+            response = self.client.get(
+                flask.url_for('admin.question', id=self.question_ids[0], challenge_id=self.challenge_id))
+            self.assertEqual(response.status_code, 200)
+
+        with self.assertQueryBudget(4, 'answers'):
+            response = self.client.get(
+                flask.url_for('admin.question-answers', id=self.question_ids[0], challenge_id=self.challenge_id))
+            self.assertEqual(response.status_code, 200)
+
+    def test_session_identity(self):
+        self.app.config['SESSION_IDENTITY'] = True
+        self.client.get(flask.url_for('index'))  # fill the cache
+        self.client.get(flask.url_for('challenge', id=self.challenge_id))  # ... and start the challenge
+
+        with self.assertQueryBudget(2, 'index'):  # no user
+            response = self.client.get(flask.url_for('index'))
+            self.assertEqual(response.status_code, 200)
+
+        with self.assertQueryBudget(2, 'challenge'):
+            response = self.client.get(flask.url_for('challenge', id=self.challenge_id))
+            self.assertEqual(response.status_code, 200)
+
+        # ... but the admin pages still check
+        self.admin = User.query.get(self.admin_id)
+        self.admin.is_admin = False
+        self.db_session.add(self.admin)
+        self.db_session.commit()
+
+        self.assertEqual(self.client.get(flask.url_for('admin.users')).status_code, 403)
+
+        response = self.client.get(flask.url_for('index'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Utilisateurs', response.get_data().decode())  # not updated until the next login
+
+    def test_profiling(self):
+        self.app.config['SQL_PROFILING'] = True
+
+        response = self.client.get(flask.url_for('index'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('X-SQL-Queries', response.headers)
+        self.assertGreater(int(response.headers['X-SQL-Queries']), 0)
+
+        response = self.client.get(flask.url_for('admin.metrics'))
+        self.assertEqual(response.status_code, 200)
+
+        metrics = json.loads(response.get_data().decode())
+        self.assertIn('index', metrics['sql'])
+        self.assertGreater(metrics['sql']['index']['queries'], 0)
+
+
+class TestImport(TestFlask):
+
+    def setUp(self):
+        super().setUp()
+
+        self.challenges = [
+            {'name': 'first', 'is_public': True, 'questions': [
+                {'hint_expr': 'alpha OR beta', 'documents': ['alpha', 'beta', 'gamma']},
+                {'hint_expr': 'gamma', 'hint': 'easy', 'documents': 'alpha;gamma'},
+            ]},
+            {'name': 'second', 'questions': [{'hint_expr': 'delta', 'documents': ['delta']}]},
+        ]
+
+    def write(self, data, name='challenges.json'):
+        path = os.path.join(self.data_files_directory, name)
+        with open(path, 'w') as f:
+            json.dump(data, f)
+
+        return path
+
+    def test_import(self):
+        runner = self.app.test_cli_runner()
+        path = self.write({'challenges': self.challenges})
+
+        # dry run
+        result = runner.invoke(args=['import-challenges', path, '--dry-run'])
+        self.assertEqual(result.exit_code, 0, msg=result.output)
+        self.assertIn('first: 2 question(s)', result.output)
+        self.assertEqual(Challenge.query.count(), 0)
+
+        # import, with a pool of processes
+        result = runner.invoke(args=['import-challenges', path, '--jobs', '2'])
+        self.assertEqual(result.exit_code, 0, msg=result.output)
+        self.assertIn('Imported 2 challenge(s) and 3 question(s)', result.output)
+
+        first = Challenge.query.filter(Challenge.name == 'first').first()
+        self.assertTrue(first.is_public)
+        self.assertEqual(first.question_count, 2)
+
+        questions = first.get_questions()
+        self.assertEqual([q.hint_expr for q in questions], ['alpha OR beta', 'gamma'])
+        self.assertEqual(questions[0].get_good_documents(), ['alpha', 'beta'])
+        self.assertEqual(questions[0].get_wrong_documents(), ['gamma'])
+        self.assertEqual(questions[0].next_question, questions[1].id)
+        self.assertEqual(questions[1].hint, 'easy')
+
+        # ... which is visible to the students
+        self.assertTrue(self.login(self.user.name))
+        response = self.client.get(flask.url_for('challenge', id=first.id))
+        self.assertIn('question 1/2', response.get_data().decode())
+
+        # the second time, the names are already used
+        result = runner.invoke(args=['import-challenges', path, '--jobs', '1'])
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn('a challenge named "first" already exists', result.output)
+        self.assertEqual(Challenge.query.count(), 2)
+
+    def test_errors(self):
+        self.challenges[0]['questions'][1]['hint_expr'] = 'gamma ('
+        self.challenges[1]['questions'][0]['documents'] = ['alpha']
+        self.challenges.append({'name': 'second', 'questions': []})
+
+        result = self.app.test_cli_runner().invoke(args=['import-challenges', self.write(self.challenges)])
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn('question #2: parser error', result.output)
+        self.assertIn('question #1: no good document for delta', result.output)
+        self.assertIn('a challenge named "second" already exists', result.output)
+        self.assertIn('no question', result.output)
+        self.assertIn('4 error(s), nothing imported', result.output)
+        self.assertEqual(Challenge.query.count(), 0)
+
+        result = self.app.test_cli_runner().invoke(args=['import-challenges', self.write({'x': 1})])
+        self.assertIn('expected a list of challenges', result.output)
+
+        # wrong types are errors as well
+        report = importer.validate([
+            {'name': ['first'], 'questions': [{'hint_expr': 1}, {'hint_expr': 'alpha', 'hint': 2}]},
+            {'name': 'third', 'questions': [{'hint_expr': 'alpha', 'documents': [1, 'alpha']}]},
+            {'name': 'fourth', 'questions': 'alpha'}
+        ], jobs=1)
+
+        self.assertEqual(report[0]['errors'], [
+            'the name of challenge #1 must be a string',
+            'question #1: hint_expr must be a string',
+            'question #2: hint must be a string'
+        ])
+        self.assertEqual(report[1]['errors'], ['question #1: documents must be a string or a list of strings'])
+        self.assertEqual(report[2]['errors'], ['questions must be a list'])
+
+    def test_users(self):
+        logins = ['student{}'.format(i) for i in range(600)]
+        lines = ['login'] + logins + ['student1', '', 'user']
+
+        # CLI (with more users than parameters in an SQLite statement)
+        path = os.path.join(self.data_files_directory, 'users.csv')
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines))
+
+        with QueryCounter() as counter:
+            result = self.app.test_cli_runner().invoke(args=['import-users', path])
+
+        self.assertEqual(result.exit_code, 0, msg=result.output)
+        self.assertIn('Created 600 user(s), skipped 1 existing one(s)', result.output)
+        self.assertEqual(User.query.count(), 602)
+        self.assertLessEqual(counter.count, 6)
+        self.assertFalse(User.query.filter(User.name == 'student599').first().is_admin)
+
+        # upload
+        self.assertTrue(self.login('admin'))
+        response = self.client.post(flask.url_for('admin.users-import'), data={
+            'logins': (io.BytesIO('student1\nteacher,whatever\n'.encode()), 'users.csv'),
+            'is_admin': True
+        }, content_type='multipart/form-data', follow_redirects=True)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('1 personne(s) ajoutée(s), 1 déjà existante(s)', response.get_data().decode())
+        self.assertTrue(User.query.filter(User.name == 'teacher').first().is_admin)
+
+        response = self.client.post(flask.url_for('admin.users-import'), data={}, follow_redirects=False)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(User.query.count(), 603)
+
+    def test_yaml(self):
+        if importer.yaml is None:
+            self.skipTest('PyYAML is not installed')
+
+        path = os.path.join(self.data_files_directory, 'challenges.yml')
+        with open(path, 'w') as f:
+            importer.yaml.safe_dump(self.challenges, f)
+
+        report, n = importer.import_challenges(path, jobs=1)
+        self.assertEqual(n, 3)
+        self.assertEqual(Challenge.query.count(), 2)
+
+
+class TestStats(TestFlask):
+
+    def setUp(self):
+        super().setUp()
+
+        challenge, questions = self.create_challenge(
+            ('alpha', ['beta'], ['alpha']), ('beta', ['alpha'], ['beta']))
+
+        self.challenge_id = challenge.id
+        self.question_ids = [q.id for q in questions]
+
+    def check(self, expr, question_id):
+        response = self.client.post('/api/check_question', data={
+            'search_expression': expr,
+            'user': self.user.id,
+            'challenge': self.challenge_id,
+            'question': question_id
+        })
+
+        self.assertEqual(response.status_code, 200)
+
+    def snapshot(self):
+        return (
+            sorted((s.question, s.attempts, s.successes, s.distinct_answers) for s in QuestionStats.query.all()),
+            sorted((s.challenge, s.started, s.finished, s.attempts) for s in ChallengeStats.query.all()),
+            sorted((s.user, s.challenge, s.attempts, s.solved, s.finished) for s in UserChallengeStats.query.all()),
+        )
+
+    def play(self):
+        self.assertTrue(self.login(self.user.name))
+        self.assertEqual(self.client.get(flask.url_for('challenge', id=self.challenge_id)).status_code, 200)
+
+        self.check('beta', self.question_ids[0])
+        self.check('gamma', self.question_ids[0])
+        self.check('gamma', self.question_ids[0])  # not another distinct answer
+        self.check('alpha', self.question_ids[0])
+        self.check('beta', self.question_ids[1])
+
+        self.assertTrue(batch_writer.flush(timeout=5))
+
+    def test_incremental(self):
+        self.play()
+
+        question_stats, challenge_stats, user_stats = self.snapshot()
+        self.assertEqual(question_stats, [(self.question_ids[0], 4, 1, 3), (self.question_ids[1], 1, 1, 1)])
+        self.assertEqual(challenge_stats, [(self.challenge_id, 1, 1, 5)])
+        self.assertEqual(user_stats, [(self.user.id, self.challenge_id, 5, 2, 1)])
+
+        # the leaderboard only concerns the challenge
+        other, _ = self.create_challenge(name='other')
+
+        self.assertEqual(
+            [tuple(r) for r in stats.leaderboard(self.challenge_id)], [(self.user.name, 2, 1, 5)])
+        self.assertEqual(stats.leaderboard(other.id), [])
+
+        # rebuilding gives the same numbers
+        commit_with_retry(stats.rebuild)
+        self.assertEqual(self.snapshot(), (question_stats, challenge_stats, user_stats))
+
+        self.db_session.query(QuestionStats).delete()
+        self.db_session.commit()
+
+        result = self.app.test_cli_runner().invoke(args=['rebuild-stats'])
+        self.assertEqual(result.exit_code, 0, msg=result.output)
+        self.assertEqual(self.snapshot(), (question_stats, challenge_stats, user_stats))
+
+    def test_duration(self):
+        self.assertTrue(self.login(self.user.name))
+        self.assertEqual(self.client.get(flask.url_for('challenge', id=self.challenge_id)).status_code, 200)
+
+        # the progression may be modified without the question being changed (e.g. when the questions are renumbered)
+        db.session.execute(
+            "UPDATE user_challenge SET question_started_at = datetime('now', '-60 seconds'), "
+            'date_modified = CURRENT_TIMESTAMP')
+        self.db_session.commit()
+
+        self.check('alpha', self.question_ids[0])
+        self.check('gamma', self.question_ids[1])
+        self.assertTrue(batch_writer.flush(timeout=5))
+
+        durations = [a.duration for a in Answer.query.order_by(Answer.id)]
+        self.assertGreaterEqual(durations[0], 59)
+        self.assertLess(durations[1], 30)  # the next question was started when the first one was solved
+
+    def test_dashboard(self):
+        self.play()
+        self.logout()
+
+        self.assertTrue(self.login('admin'))
+        response = self.client.get(flask.url_for('admin.challenge-stats', id=self.challenge_id))
+        self.assertEqual(response.status_code, 200)
+
+        text = response.get_data().decode()
+        self.assertIn('1 utilisateur(s) ont commencé ce challenge', text)
+        self.assertIn('<td>user</td>', text)
+
+
+class TestOffload(TestFlask):
+
+    def setUp(self):
+        super().setUp()
+
+        self.app.config['OFFLOAD_WORKERS'] = 1
+        self.app.config['OFFLOAD_MIN_DOCUMENTS'] = 3
+        self.app.config['OFFLOAD_CHUNK_SIZE'] = 2
+        self.app.config['OFFLOAD_MAX_PENDING'] = 1
+
+    def test_offload(self):
+        documents = ['w', 'b', 'x', 'w b', 'Été']
+        expected = [
+            {'document': d, 'normalized_document': ' '.join(str(t.value) for t in logic.analyze(d)),
+             'matched': logic.parse('w OR b').match(logic.analyze(d))} for d in documents
+        ]
+
+        offloaded = offloader.stats['offloaded']
+
+        response = self.client.get(
+            '/api/checks_many', query_string={'search_expression': 'w OR b', 'documents': documents})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.get_data().decode())['documents'], expected)
+
+        response = self.client.post(
+            '/api/checks_stream', json={'search_expression': 'w OR b', 'documents': documents, 'echo': False})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [json.loads(line) for line in response.get_data().decode().splitlines()],
+            [{'matched': e['matched']} for e in expected])
+
+        self.assertEqual(offloader.stats['offloaded'], offloaded + 2)
+
+        # small batches are checked in the worker
+        response = self.client.get('/api/checks_many', query_string={'search_expression': 'w', 'documents': ['w']})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(offloader.stats['offloaded'], offloaded + 2)
+
+    def test_back_pressure(self):
+        documents = ['w', 'b', 'x']
+        rejected = offloader.stats['rejected']
+
+        batch = offloader.submit(logic.parse('w'), documents)  # holds the only slot
+
+        response = self.client.get('/api/checks_many', query_string={'search_expression': 'w', 'documents': documents})
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Retry-After', response.headers)
+        self.assertNotIn('ETag', response.headers)
+
+        response = self.client.post('/api/checks_stream', json={'search_expression': 'w', 'documents': documents})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(offloader.stats['rejected'], rejected + 2)
+
+        self.assertEqual([r['matched'] for chunk in batch for r in chunk], [True, False, False])
+
+        # the slot is released
+        response = self.client.get('/api/checks_many', query_string={'search_expression': 'w', 'documents': documents})
+        self.assertEqual(response.status_code, 200)
+
+    def test_timeout(self):
+        documents = ['w', 'b', 'x']
+        offloader.check_documents(logic.parse('w'), documents)  # start the pool
+
+        self.app.config['OFFLOAD_TIMEOUT'] = 0
+        self.app.config['OFFLOAD_CHUNK_SIZE'] = 30000
+        batch = offloader.submit(logic.parse('w'), documents * 20000)
+        while not batch.futures[0].running():
+            time.sleep(.01)
+
+        with self.assertRaises(concurrent.futures.TimeoutError):
+            next(iter(batch))
+
+        # the chunks which are running still hold the slot
+        self.assertFalse(batch.released)
+        with self.assertRaises(OverloadedException):
+            offloader.submit(logic.parse('w'), documents)
+
+        concurrent.futures.wait(batch.futures)
+        for _ in range(100):  # the callbacks of the futures run right after
+            if batch.released:
+                break
+            time.sleep(.01)
+
+        self.assertTrue(batch.released)
+        self.assertIsNone(batch.shards.block)
+
+    def test_broken_pool(self):
+        documents = ['w', 'b', 'x']
+        offloader.check_documents(logic.parse('w'), documents)  # start the pool
+        broken = offloader.stats['broken']
+
+        # a worker is killed
+        with self.assertRaises(concurrent.futures.BrokenExecutor):
+            offloader.executor.submit(os._exit, 1).result(timeout=30)
+
+        response = self.client.get('/api/checks_many', query_string={'search_expression': 'w', 'documents': documents})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(offloader.stats['broken'], broken + 1)
+
+        # ... and the pool is restarted
+        response = self.client.get('/api/checks_many', query_string={'search_expression': 'w', 'documents': documents})
+        self.assertEqual(response.status_code, 200)
+
+
+class TestLive(TestFlask):
+
+    def setUp(self):
+        super().setUp()
+
+        challenge, (question, ) = self.create_challenge(('alpha', ['beta', 'gamma'], ['alpha']))
+
+        self.challenge_id, self.question_id = challenge.id, question.id
+
+        # run the server in a thread
+        self.loop = asyncio.new_event_loop()
+        self.server = self.loop.run_until_complete(live.serve(self.app, '127.0.0.1', 0))
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def tearDown(self):
+        # the handlers end with their connection
+        asyncio.run_coroutine_threadsafe(self.server.close(), self.loop).result(10)
+        self.assertEqual(self.server.connections, {})
+
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(5)
+        self.loop.close()
+
+        super().tearDown()
+
+    def connect(self, cookie=None, origin=None, status=101):
+        sock = socket.create_connection(('127.0.0.1', self.port), timeout=5)
+        key = base64.b64encode(os.urandom(16)).decode()
+
+        sock.sendall((
+            'GET /live HTTP/1.1\r\nHost: localhost:{}\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+            'Sec-WebSocket-Key: {}\r\nSec-WebSocket-Version: 13\r\n{}{}\r\n').format(
+                self.port, key, 'Cookie: {}\r\n'.format(cookie) if cookie else '',
+                'Origin: {}\r\n'.format(origin) if origin else '').encode())
+
+        stream = sock.makefile('rb')
+        response = b''
+        while not response.endswith(b'\r\n\r\n'):
+            response += stream.read(1)
+
+        self.assertIn(' {} '.format(status).encode(), response)
+        if status != 101:
+            sock.close()
+            return None, None
+
+        self.assertIn(live.accept_key(key).encode(), response)
+        return sock, stream
+
+    def send(self, sock, message):
+        sock.sendall(live.encode_frame(json.dumps(message).encode(), mask=os.urandom(4)))
+
+    def receive(self, stream):
+        first, length = stream.read(2)
+        self.assertEqual(first & 0x0F, live.OP_TEXT)
+        if length == 126:
+            length, = struct.unpack('!H', stream.read(2))
+
+        return json.loads(stream.read(length).decode())
+
+    def test_mask(self):
+        mask = os.urandom(4)
+        for payload in [b'', b'a', b'\x00abcde', os.urandom(1001)]:
+            masked = live.apply_mask(payload, mask)
+            self.assertEqual(masked, bytes(b ^ mask[i % 4] for i, b in enumerate(payload)))
+            self.assertEqual(live.apply_mask(masked, mask), payload)
+
+    def test_documents(self):
+        sock, stream = self.connect()
+
+        self.send(sock, {'documents': ['alpha', 'Beta', 'alpha gamma']})
+        self.assertEqual(self.receive(stream), {'normalized_documents': ['alpha', 'beta', 'alpha gamma']})
+
+        self.send(sock, {'expression': 'alpha', 'id': 1})
+        self.assertEqual(
+            self.receive(stream), {'id': 1, 'offset': 0, 'matched': [True, False, True], 'done': False})
+        self.assertEqual(self.receive(stream)['done'], True)
+
+        # parser error
+        self.send(sock, {'expression': 'alpha (', 'id': 2})
+        message = self.receive(stream)
+        self.assertEqual(message['id'], 2)
+        self.assertIn('error', message)
+
+        # the documents of a question need a user
+        self.send(sock, {'question': self.question_id})
+        self.assertEqual(self.receive(stream), {'error': 'not logged in'})
+
+        sock.close()
+
+    def test_question(self):
+        self.assertTrue(self.login(self.user.name))
+        cookie = next(c for c in self.client.cookie_jar if c.name == self.app.session_cookie_name)
+        cookie = '{}={}'.format(cookie.name, cookie.value)
+
+        # not started yet
+        sock, stream = self.connect(cookie)
+        self.send(sock, {'question': self.question_id})
+        self.assertEqual(self.receive(stream), {'error': 'not the right question'})
+
+        self.assertEqual(self.client.get(flask.url_for('challenge', id=self.challenge_id)).status_code, 200)
+
+        self.send(sock, {'question': self.question_id})
+        self.assertEqual(self.receive(stream), {'documents': [['alpha', True], ['beta', False], ['gamma', False]]})
+
+        self.send(sock, {'expression': 'alpha OR gamma', 'id': 1})
+        self.assertEqual(self.receive(stream)['matched'], [True, False, True])
+
+        sock.close()
+
+    def test_origin(self):
+        # the pages of the application (on another port) may connect, not the other sites
+        sock, stream = self.connect(origin='http://localhost:5000')
+        sock.close()
+
+        self.connect(origin='http://evil.example.org', status=403)
+
+        self.app.config['LIVE_ALLOWED_ORIGINS'] = ['http://evil.example.org']
+        try:
+            sock, stream = self.connect(origin='http://evil.example.org')
+            sock.close()
+            self.connect(origin='http://localhost:5000', status=403)
+        finally:
+            self.app.config['LIVE_ALLOWED_ORIGINS'] = None
+
+    def test_limits(self):
+        sock, stream = self.connect()
+
+        # the documents are kept analyzed, so there are few of them
+        self.send(sock, {'documents': ['alpha'] * (self.app.config['LIVE_MAX_DOCUMENTS'] + 1)})
+        first, length = stream.read(2)
+        self.assertEqual(first & 0x0F, live.OP_CLOSE)
+        self.assertEqual(struct.unpack('!H', stream.read(length)[:2])[0], 1009)
+
+        sock.close()
+
+
+class TestContentCache(TestFlask):
+
+    def setUp(self):
+        super().setUp()
+
+        self.challenge, _ = self.create_challenge()
+
+    def test_lru(self):
+        cache = LRUCache(max_size=2)
+
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)  # now, "b" is the least recently used
+
+        cache.set('c', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+        self.assertEqual(cache.get_or_set('d', lambda: 4), 4)
+        self.assertEqual(cache.get_or_set('d', lambda: 5), 4)
+
+        self.assertEqual(cache.stats()['hits'], 4)
+        self.assertEqual(cache.stats()['misses'], 2)
+
+    def test_read_through(self):
+        with self.app.test_request_context():
+            self.assertEqual([c.name for c in content.get_public_challenges()], ['xxx'])
+
+        with self.app.test_request_context():
+            with QueryCounter() as counter:
+                self.assertEqual([c.name for c in content.get_public_challenges()], ['xxx'])
+
+            self.assertEqual(counter.count, 1)  # only the version
+            self.assertEqual(content.get_challenge(self.challenge.id).name, 'xxx')
+            self.assertEqual(content.get_challenge(self.challenge.id + 1), None)
+
+        # a modification which is not followed by a bump is not seen
+        self.challenge.is_public = False
+        self.db_session.add(self.challenge)
+        self.db_session.commit()
+
+        with self.app.test_request_context():
+            self.assertEqual(len(content.get_public_challenges()), 1)
+
+        # ... and is seen once bumped (even by another process, since the version is in the database)
+        content.invalidate()
+        self.db_session.commit()
+
+        with self.app.test_request_context():
+            self.assertEqual(len(content.get_public_challenges()), 0)
+            self.assertFalse(content.get_challenge(self.challenge.id).is_public)
+
+    def test_stale_set(self):
+        def load():
+            # another thread bumps the version while this one loads
+            content.invalidate()
+            self.db_session.commit()
+            content.content_cache.check_version()
+            return 'stale'
+
+        content.content_cache.check_version()
+        self.assertEqual(content.content_cache.get_or_set(('stale', 1), load), 'stale')
+        self.assertIsNone(content.content_cache.get(('stale', 1)))
+
+        # when nothing changed, the value is kept
+        self.assertEqual(content.content_cache.get_or_set(('stale', 1), lambda: 'fresh'), 'fresh')
+        self.assertEqual(content.content_cache.get(('stale', 1)), 'fresh')
+
+    def test_admin_invalidates(self):
+        self.assertTrue(self.login(self.user.name))
+
+        response = self.client.get(flask.url_for('index'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('xxx', response.get_data().decode())
+
+        self.assertTrue(self.logout())
+        self.assertTrue(self.login(self.admin.name))
+        self.client.get(flask.url_for('admin.challenge-toggle', id=self.challenge.id))
+
+        self.assertTrue(self.logout())
+        self.assertTrue(self.login(self.user.name))
+        response = self.client.get(flask.url_for('index'))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('xxx', response.get_data().decode())
+
+        self.assertTrue(self.logout())
+        self.assertTrue(self.login(self.admin.name))
+        metrics = json.loads(self.client.get(flask.url_for('admin.metrics')).get_data().decode())
+        self.assertEqual(metrics['content_cache']['version'], 1)
+
+
+class TestResultsCache(TestFlask):
+
+    def test_shared(self):
+        path = os.path.join(self.data_files_directory, 'shared.db')
+
+        # two workers
+        worker_1 = TieredCache(LRUCache(), SQLiteCache(path))
+        worker_2 = TieredCache(LRUCache(), SQLiteCache(path))
+
+        self.assertEqual(worker_1.get_or_set('x', lambda: logic.parse('a OR b')).__class__, logic.SearchExpr)
+        self.assertEqual(str(worker_2.get_or_set('x', lambda: self.fail('not shared'))), 'a OR b')
+        self.assertEqual(worker_2.stats()['shared']['hits'], 1)
+
+        # ... which is then in memory
+        self.assertEqual(str(worker_2.get('x')), 'a OR b')
+        self.assertEqual(worker_2.stats()['local']['hits'], 1)
+        self.assertEqual(worker_2.stats()['shared']['hits'], 1)
+
+    def test_eviction(self):
+        cache = SQLiteCache(os.path.join(self.data_files_directory, 'shared.db'), max_size=5, ttl=60)
+        cache.EVICTION_INTERVAL = 10
+
+        for i in range(10):
+            cache.set(i, i)
+
+        self.assertEqual(len(cache), 5)
+        self.assertIsNone(cache.get(0))
+        self.assertEqual(cache.get(9), 9)
+
+        # expired
+        cache.ttl = -1
+        cache.set('x', 'x')
+        self.assertIsNone(cache.get('x'))
+
+    def test_api(self):
+        response = self.client.get('/api/checks', data={'search_expression': 'w OR b', 'document': 'w'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(json.loads(response.get_data().decode())['matched'])
+
+        # parsing and analyzing are cheap, so they are only kept in memory
+        self.assertEqual(
+            str(results.results_cache.local.get(('parse', logic.ENGINE_VERSION, 'w OR b'))), 'w OR b')
+        self.assertIsNotNone(results.results_cache.local.get(('analyze', logic.ENGINE_VERSION, 'w')))
+        self.assertEqual(len(results.results_cache.shared), 0)
+
+        # a parser error is not cached
+        response = self.client.get('/api/checks', data={'search_expression': 'w (', 'document': 'w'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIsNone(results.results_cache.local.get(('parse', logic.ENGINE_VERSION, 'w (')))
+
+    def test_single_flight(self):
+        single_flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def compute():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 42
+
+        leader = threading.Thread(target=lambda: calls.append(single_flight.do('x', compute)))
+        leader.start()
+        self.assertTrue(started.wait(5))
+
+        # while the first computation is in flight, the others wait for it
+        results_ = []
+        followers = [threading.Thread(target=lambda: results_.append(single_flight.do('x', compute))) for _ in range(3)]
+        for thread in followers:
+            thread.start()
+
+        while single_flight.shared < 3:
+            time.sleep(.01)
+
+        release.set()
+        for thread in [leader] + followers:
+            thread.join(5)
+
+        self.assertEqual(calls, [1, 42])
+        self.assertEqual(results_, [42] * 3)
+        self.assertEqual(single_flight.stats(), {'in_flight': 0, 'executed': 1, 'shared': 3})
+
+        # exceptions are shared as well, and nothing is kept
+        with self.assertRaises(ZeroDivisionError):
+            single_flight.do('x', lambda: 1 / 0)
+
+        self.assertEqual(single_flight.do('x', lambda: 1), 1)
+        self.assertEqual(single_flight.executed, 3)
+
+    def test_grade(self):
+        challenge, (question, ) = self.create_challenge(('alpha', ['beta'], ['alpha']))
+
+        documents = content.get_documents(question.id)
+        self.assertEqual(results.grade(question.id, logic.parse('alpha'), documents), (True, False))
+
+        # an equivalent expression hits the cache
+        hits = results.results_cache.local.hits
+        self.assertEqual(results.grade(question.id, logic.parse('alpha  '), documents), (True, False))
+        self.assertEqual(results.results_cache.local.hits, hits + 1)
+
+        # an edited question does not
+        question.set_documents(['alpha', 'gamma'], ['beta'])
+        content.invalidate()
+        self.db_session.commit()
+
+        documents = content.get_documents(question.id)
+        self.assertEqual(results.grade(question.id, logic.parse('alpha'), documents), (True, False, False))
+
+        # nor with another version of the logic
+        misses = results.results_cache.local.misses
+        engine_version = logic.ENGINE_VERSION
+        try:
+            logic.ENGINE_VERSION = engine_version + '.1'
+            self.assertEqual(results.grade(question.id, logic.parse('alpha'), documents), (True, False, False))
+        finally:
+            logic.ENGINE_VERSION = engine_version
+
+        self.assertGreater(results.results_cache.local.misses, misses)
+
+
+class TestWarmup(TestFlask):
+
+    def test_warm_up(self):
+        self.assertTrue(self.login(self.admin.name))
+
+        self.client.post(flask.url_for('admin.challenges'), data={'name': 'xxx'}, follow_redirects=False)
+        challenge = Challenge.query.order_by(Challenge.id.desc()).first()
+        self.client.post(flask.url_for('admin.question-create', id=challenge.id), data={
+            'hint_expr': 'alpha OR beta',
+            'hint': '',
+            'documents': 'alpha;beta;gamma'
+        }, follow_redirects=False)
+        self.client.get(flask.url_for('admin.challenge-toggle', id=challenge.id))
+
+        # ... and a broken one, which is reported (but does not prevent the start)
+        broken = Question(challenge.id, 'alpha AND', [], [], position=2)
+        self.db_session.add(broken)
+        self.db_session.commit()
+
+        challenge_id = challenge.id
+        content.content_cache.clear()
+        results.results_cache.clear()
+
+        try:
+            report = warm_up(self.app)
+        finally:
+            gc.unfreeze()
+
+        self.assertEqual(report['challenges'], 1)
+        self.assertEqual(report['questions'], 2)
+        self.assertEqual(report['documents'], 3)
+        self.assertEqual(report['errors'], 1)
+
+        self.assertIsNotNone(results.results_cache.local.get(('parse', logic.ENGINE_VERSION, 'alpha OR beta')))
+        self.assertIsNotNone(results.results_cache.local.get(('analyze', logic.ENGINE_VERSION, 'gamma')))
+
+        # only the version is checked
+        with self.app.test_request_context():
+            with QueryCounter() as counter:
+                questions = content.get_questions(challenge_id)
+                content.get_documents(questions[0].id)
+
+            self.assertEqual(counter.count, 1)
+
+        response = self.client.get(flask.url_for('admin.metrics'))
+        self.assertEqual(json.loads(response.get_data().decode())['warmup']['questions'], 2)
+
+
+class TestSchema(TestFlask):
+
+    @staticmethod
+    def query_plan(query):
+        statement = query.statement.compile(dialect=db.engine.dialect, compile_kwargs={'literal_binds': True})
+        return ' '.join(r[-1] for r in db.session.execute('EXPLAIN QUERY PLAN {}'.format(statement)))
+
+    def test_indexes_are_used(self):
+        queries = [
+            (UserChallenge.query.filter(UserChallenge.user == 1).filter(UserChallenge.challenge == 1),
+             'ix_user_challenge_user_challenge'),
+            (UserChallenge.query.filter(UserChallenge.user == 1), 'ix_user_challenge_user_challenge'),
+            (Question.query.filter(Question.challenge == 1), 'ix_question_challenge_position'),
+            (Question.query.filter(Question.challenge == 1).order_by(Question.position),
+             'ix_question_challenge_position'),
+            (Answer.query.filter(Answer.question == 1), 'ix_answer_question'),
+            (User.query.filter(User.name == 'user'), 'ix_user_name'),
+        ]
+
+        for query, index in queries:
+            plan = self.query_plan(query)
+            self.assertIn('USING', plan)
+            self.assertIn(index, plan)
+
+        # the leaderboard of a challenge is read in the order of the index (without sorting)
+        query = UserChallengeStats.query\
+            .filter(UserChallengeStats.challenge == 1)\
+            .order_by(UserChallengeStats.solved.desc(), UserChallengeStats.attempts)
+
+        plan = self.query_plan(query)
+        self.assertIn('ix_user_challenge_stats_leaderboard', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_upgrade(self):
+        challenge, (question, ) = self.create_challenge(('a', ['b'], ['a']))
+
+        # mimic an old database: no index, and duplicated user challenges
+        for index in ['ix_user_name', 'ix_question_challenge_position', 'ix_user_challenge_user_challenge']:
+            db.session.execute('DROP INDEX {}'.format(index))
+
+        for _ in range(3):
+            self.db_session.add(UserChallenge(self.user.id, challenge.id, question.id))
+        self.db_session.commit()
+
+        # ... and duplicated logins
+        duplicate = User('user', is_admin=True)
+        self.db_session.add(duplicate)
+        self.db_session.commit()
+        self.db_session.add(Answer(duplicate.id, question.id, 'a'))
+        self.db_session.commit()
+
+        done = upgrade_database()
+        self.assertIn('created index ix_user_name', done)
+        self.assertIn('created index ix_user_challenge_user_challenge', done)
+        self.assertIn('created index ix_question_challenge_position', done)
+        self.assertIn('deduplicate_users: 1 row(s)', done)
+        self.assertIn('deduplicate_user_challenges: 2 row(s)', done)
+        self.assertIn('count_distinct_answers: 1 row(s)', done)
+        self.db_session.expire_all()
+
+        self.assertEqual(UserChallenge.query.count(), 1)
+        self.assertEqual(User.query.filter(User.name == 'user').count(), 1)
+        self.assertTrue(User.query.get(self.user.id).is_admin)
+        self.assertEqual(Answer.query.one().user, self.user.id)
+        self.assertIn('ix_user_name', self.query_plan(User.query.filter(User.name == 'user')))
+
+        # positions used to be set to the number of challenges
+        questions = [Question(challenge.id, 'a', ['b'], ['a'], position=3) for _ in range(3)]
+        self.db_session.add_all(questions)
+        self.db_session.commit()
+        question_ids = [question.id] + [q.id for q in questions]
+
+        done = upgrade_database()
+        self.assertIn('renumber_questions: 3 row(s)', done)
+        self.db_session.expire_all()
+
+        ordering = Question.ordering(question_ids)
+        for o in ordering:
+            q = Question.query.get(o['id'])
+            self.assertEqual(q.position, o['position'])
+            self.assertEqual(q.next_question, o['next_question'])
+
+        # documents used to be joined in the question table
+        db.session.execute('ALTER TABLE question ADD COLUMN good_documents TEXT')
+        db.session.execute('ALTER TABLE question ADD COLUMN wrong_documents TEXT')
+        db.session.execute(
+            'UPDATE question SET good_documents = :good, wrong_documents = :wrong WHERE id = :id',
+            {'good': 'a;a b', 'wrong': 'c', 'id': question.id})
+        Document.query.filter(Document.question == question.id).delete()
+        self.db_session.commit()
+
+        done = upgrade_database()
+        self.assertIn('move_documents: 1 row(s)', done)
+        self.db_session.expire_all()
+
+        question = Question.query.get(question.id)
+        self.assertEqual(question.get_good_documents(), ['a', 'a b'])
+        self.assertEqual(question.get_wrong_documents(), ['c'])
+
+        # counters did not exist
+        db.session.execute('UPDATE challenge SET question_count = NULL')
+        db.session.execute('UPDATE user_challenge SET current_position = NULL, question_started_at = NULL')
+        self.db_session.commit()
+
+        done = upgrade_database()
+        self.assertIn('count_questions: 2 row(s)', done)
+        self.assertIn('start_questions: 1 row(s)', done)
+        self.db_session.expire_all()
+
+        self.assertEqual(Challenge.query.get(challenge.id).question_count, 4)
+        self.assertEqual(UserChallenge.query.first().current_position, 0)
+
+        # nothing to do the second time
+        self.assertEqual(upgrade_database(), [])
+
+
+class TestConcurrency(TestFlask):
+
+    def test_pragmas(self):
+        self.assertEqual(db.session.execute('PRAGMA journal_mode').scalar(), 'wal')
+        self.assertEqual(db.session.execute('PRAGMA foreign_keys').scalar(), 1)
+        self.assertEqual(
+            db.session.execute('PRAGMA busy_timeout').scalar(), settings.SQLITE_PRAGMAS['busy_timeout'])
+
+    def test_concurrent_writers(self):
+        challenge, (question, ) = self.create_challenge(('a', ['b'], ['a']))
+
+        user_id, question_id = self.user.id, question.id
+        num_writers, num_writes = 16, 25
+        errors = []
+
+        def writer(n):
+            with self.app.app_context():
+                try:
+                    for i in range(num_writes):
+                        commit_with_retry(lambda: db.session.add(Answer(user_id, question_id, '{}-{}'.format(n, i))))
+                except Exception as e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=writer, args=(n, )) for n in range(num_writers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(Answer.query.count(), num_writers * num_writes)
+
+    def test_concurrent_start(self):
+        challenge, (question, ) = self.create_challenge(('a', ['b'], ['a']))
+
+        user_id, challenge_id, question_id = self.user.id, challenge.id, question.id
+        record_start = stats.record_start
+
+        def start_concurrently(challenge_id_):
+            # another request starts the challenge in the meantime
+            with db.engine.begin() as connection:
+                connection.execute(UserChallenge.__table__.insert(), {
+                    'user': user_id, 'challenge': challenge_id, 'current_question': question_id,
+                    'is_done': False, 'current_position': 0})
+
+            record_start(challenge_id_)
+
+        self.assertTrue(self.login(self.user.name))
+
+        try:
+            stats.record_start = start_concurrently
+            response = self.client.get(flask.url_for('challenge', id=challenge_id))
+        finally:
+            stats.record_start = record_start
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('question 1/1', response.get_data().decode())
+        self.assertEqual(UserChallenge.query.count(), 1)
+
+
+class TestBatchWriter(TestFlask):
+
+    def setUp(self):
+        super().setUp()
+
+        challenge, (question, ) = self.create_challenge(('a', ['b'], ['a']))
+
+        self.user_id, self.question_id = self.user.id, question.id
+
+    def answer(self, i):
+        return {'user': self.user_id, 'question': self.question_id, 'answer': str(i)}
+
+    def test_batches(self):
+        self.app.config['BATCH_WRITER_SIZE'] = 10
+        self.app.config['BATCH_WRITER_INTERVAL'] = 1
+
+        batches = batch_writer.stats['batches']
+        for i in range(25):
+            batch_writer.put(Answer, self.answer(i))
+
+        self.assertTrue(batch_writer.flush(timeout=5))
+        self.assertEqual(sorted(int(a.answer) for a in Answer.query.all()), list(range(25)))
+        self.assertEqual(batch_writer.stats['batches'] - batches, 3)
+
+        # stop writes what remains, and the thread is restarted if needed
+        batch_writer.put(Answer, self.answer(25))
+        batch_writer.stop()
+        self.assertFalse(batch_writer.thread.is_alive())
+        self.assertEqual(Answer.query.count(), 26)
+
+        batch_writer.put(Answer, self.answer(26))
+        self.assertTrue(batch_writer.flush(timeout=5))
+        self.assertEqual(Answer.query.count(), 27)
+
+    def test_bad_row(self):
+        self.app.config['BATCH_WRITER_SIZE'] = 10
+        self.app.config['BATCH_WRITER_INTERVAL'] = 1
+
+        failed = batch_writer.stats['failed']
+        for i in range(5):
+            batch_writer.put(Answer, self.answer(i))
+        batch_writer.put(Answer, dict(self.answer(5), question=self.question_id + 1))  # no such question
+
+        self.assertTrue(batch_writer.flush(timeout=5))
+
+        # only the bad row is lost (and the statistics see the other ones)
+        self.assertEqual(sorted(int(a.answer) for a in Answer.query.all()), list(range(5)))
+        self.assertEqual(batch_writer.stats['failed'] - failed, 1)
+        self.assertEqual(QuestionStats.query.filter(QuestionStats.question == self.question_id).one().attempts, 5)
+
+    def test_synchronous(self):
+        self.app.config['BATCH_WRITER'] = False
+
+        batch_writer.put(Answer, self.answer(0))
+        self.assertEqual(Answer.query.count(), 1)
+
+    def test_stats(self):
+        failed = batch_writer.stats['failed']
+
+        def count():
+            for i in range(1000):
+                batch_writer.stats.add(failed=1)
+
+        threads = [threading.Thread(target=count) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(batch_writer.stats['failed'] - failed, 4000)
+        batch_writer.stats.add(failed=-4000)
@@ -1,14 +1,15 @@
 import flask
+from sqlalchemy.exc import IntegrityError
 
-from logical_enough import db
+from logical_enough import db, commit_with_retry, content, stats
 from logical_enough.visitors.forms import LoginForm
-from logical_enough.models import Challenge, UserChallenge, Question
+from logical_enough.models import UserChallenge
 from logical_enough.base_views import RenderTemplateView, FormView, GetObjectMixin, PageContextMixin
 
 
 @PageContextMixin.login_required
 def logout():
-    del flask.session[PageContextMixin.LOGIN_VAR]
+    PageContextMixin.logout_user()
     return flask.redirect(flask.url_for('login'))
 
 
@@ -56,9 +57,11 @@ class IndexPage(PageContextMixin, RenderTemplateView):
     def get_context_data(self, *args, **kwargs):
         context = super().get_context_data(*args, **kwargs)
 
-        context['challenges'] = Challenge.query.filter(Challenge.is_public.is_(True)).all()
+        context['challenges'] = content.get_public_challenges()
         context['user_challenges'] = dict(
-            (c.challenge, c) for c in UserChallenge.query.filter(UserChallenge.user.is_(self.get_user().id)).all())
+            (c.challenge, c) for c in db.session.query(
+                UserChallenge.challenge, UserChallenge.is_done, UserChallenge.current_position)
+            .filter(UserChallenge.user == self.get_user().id))
         return context
 
 
@@ -71,43 +74,65 @@ class ChallengePage(PageContextMixin, GetObjectMixin, RenderTemplateView):
 
     decorators = [PageContextMixin.login_required]
     template_name = 'challenge.html'
-    model = Challenge
     context_object_name = 'challenge'
 
     current_question = None
+    current_position = 0
     challenge_done = False
 
     def get_object(self, *args, **kwargs):
-        obj = super().get_object(*args, **kwargs)
-        if not obj.is_public:
+        if self.object is not None:
+            return self.object
+
+        obj = content.get_challenge(kwargs.get(self.url_parameter))
+        if obj is None or not obj.is_public:
             flask.abort(404)
 
-        user_challenge = UserChallenge.query\
-            .filter(UserChallenge.user.is_(self.get_user().id))\
-            .filter(UserChallenge.challenge.is_(obj.id))\
-            .first()
+        self.object = obj
+
+        user_challenge = self.get_user_challenge(obj.id)
 
         if user_challenge is None:  # never did the challenge, starts it
-            self.current_question = Question.query.filter(Question.challenge.is_(obj.id)).first()
-            user_challenge = UserChallenge(self.get_user().id, obj.id, self.current_question.id)
-            db.session.add(user_challenge)
-            db.session.commit()
-        else:
+            questions = content.get_questions(obj.id)
+            if len(questions) == 0:
+                flask.abort(404)
+
+            self.current_question = questions[0]
+            user_id, question_id = self.get_user().id, self.current_question.id
+
+            def start():
+                db.session.add(UserChallenge(user_id, obj.id, question_id))
+                stats.record_start(obj.id)
+
+            try:
+                commit_with_retry(start)
+            except IntegrityError:  # started at the same time by another request (e.g. a double click)
+                db.session.rollback()
+                user_challenge = self.get_user_challenge(obj.id)
+
+        if user_challenge is not None:
             self.challenge_done = user_challenge.is_done
+            self.current_position = user_challenge.current_position
             if not self.challenge_done:
-                self.current_question = Question.query.get(user_challenge.current_question)
+                self.current_question = content.get_question(user_challenge.current_question)
 
         return obj
 
+    def get_user_challenge(self, challenge_id):
+        return UserChallenge.query\
+            .filter(UserChallenge.user == self.get_user().id)\
+            .filter(UserChallenge.challenge == challenge_id)\
+            .first()
+
     def get_context_data(self, *args, **kwargs):
         context = super().get_context_data(*args, **kwargs)
         context['question'] = self.current_question
         context['challenge_done'] = self.challenge_done
 
-        questions = self.object.get_questions()
+        num_questions = self.object.question_count
         if self.challenge_done:
-            context['progression'] = (len(questions), len(questions))
+            context['progression'] = (num_questions, num_questions)
         else:
-            context['progression'] = ([q.id for q in questions].index(self.current_question.id) + 1, len(questions))
+            context['progression'] = (self.current_position + 1, num_questions)
 
         return context
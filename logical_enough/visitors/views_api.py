@@ -1,17 +1,54 @@
+import json
+import hashlib
+import datetime
+import concurrent.futures
+
+import flask
 from flask_restful import Resource, reqparse
 
-from logical_enough import logic, db
-from logical_enough.models import Question, UserChallenge, Challenge, Answer
+from logical_enough import db, logic, commit_with_retry, content, results, stats
+from logical_enough.offload import offloader, OverloadedException
+from logical_enough.writer import batch_writer
+from logical_enough.models import UserChallenge, Answer
 
 
 def make_error(msg, arg, code=400):
     return {'message': {arg: msg}}, code
 
 
+def make_overloaded_error():
+    return {'message': 'too many checks in progress, try again later'}, 503, {'Retry-After': '1'}
+
+
 def normalize(tokens, sep=' '):
     return sep.join(str(t.value) for t in tokens)
 
 
+def conditional_response(key, func):
+    """Get the response of a pure function of ``key`` (and of the logic), with a strong ETag and a
+    ``Cache-Control`` header (``CHECKS_MAX_AGE``).
+
+    If the client already has it (``If-None-Match``, with the weak comparison, since the proxies which compress the
+    response make it weak), answer 304 without calling ``func()``.
+    Errors (a tuple, as returned by ``make_error()``) are not cacheable.
+    """
+
+    etag = hashlib.sha256(repr((logic.ENGINE_VERSION, key)).encode()).hexdigest()
+    headers = {
+        'ETag': '"{}"'.format(etag),
+        'Cache-Control': 'public, max-age={}'.format(flask.current_app.config.get('CHECKS_MAX_AGE', 3600))
+    }
+
+    if flask.request.if_none_match.contains_weak(etag):
+        return flask.Response(status=304, headers=headers)
+
+    result = func()
+    if isinstance(result, tuple):
+        return result
+
+    return result, 200, headers
+
+
 class CheckMatch(Resource):
 
     def __init__(self):
@@ -22,20 +59,26 @@ class CheckMatch(Resource):
 
     def get(self):
         args = self.parser.parse_args()
+        expr, doc = args.get('search_expression'), args.get('document')
 
-        doc = args.get('document')
-        normalized_doc = logic.analyze(doc)
+        return conditional_response(('checks', expr, doc), lambda: self.check(expr, doc))
 
+    @staticmethod
+    def check(expr, doc):
         try:
-            expression = logic.parse(args.get('search_expression'))
+            expression = results.parse(expr)
         except logic.ParserException as e:
             return make_error({'position': e.token.position, 'error': e.message}, 'search_expression')
 
-        return {
-            'document': doc,
-            'normalized_document': normalize(normalized_doc),
-            'matched': expression.match(normalized_doc)
-        }
+        def evaluate():
+            normalized_doc = results.analyze(doc)
+            return {
+                'document': doc,
+                'normalized_document': normalize(normalized_doc),
+                'matched': expression.match(normalized_doc)
+            }
+
+        return results.single_flight.do(('checks', str(expression), doc), evaluate)
 
 
 class CheckMatchMany(Resource):
@@ -48,23 +91,108 @@ class CheckMatchMany(Resource):
 
     def get(self):
         args = self.parser.parse_args()
+        expr, docs = args.get('search_expression'), tuple(args.get('documents'))
 
+        return conditional_response(('checks_many', expr, docs), lambda: self.check(expr, docs))
+
+    @staticmethod
+    def check(expr, docs):
         try:
-            expression = logic.parse(args.get('search_expression'))
+            expression = results.parse(expr)
         except logic.ParserException as e:
             return make_error({'position': e.token.position, 'error': e.message}, 'search_expression')
 
-        documents = []
-        for d in args.get('documents'):
-            normalized_doc = logic.analyze(d)
+        def evaluate():
+            if offloader.should_offload(len(docs)):
+                return {'documents': offloader.check_documents(expression, list(docs))}
+
+            documents = []
+            for d in docs:
+                normalized_doc = results.analyze(d)
+
+                documents.append({
+                    'document': d,
+                    'normalized_document': normalize(normalized_doc),
+                    'matched': expression.match(normalized_doc)
+                })
+
+            return {'documents': documents}
+
+        try:
+            return results.single_flight.do(('checks_many', str(expression), docs), evaluate)
+        except OverloadedException:
+            return make_overloaded_error()
 
-            documents.append({
-                'document': d,
-                'normalized_document': normalize(normalized_doc),
-                'matched': expression.match(normalized_doc)
-            })
 
-        return {'documents': documents}
+class CheckMatchStream(Resource):
+    """Same as ``CheckMatchMany``, but the documents are given in a JSON body, e.g.
+
+    .. code-block:: json
+
+        {"search_expression": "a OR b", "documents": ["a", "c"], "echo": false}
+
+    and the results are streamed, one JSON object per line (in the same order as the documents).
+    If ``echo`` is false, the ``document`` and ``normalized_document`` fields are omitted.
+    """
+
+    def post(self):
+        data = flask.request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return make_error('expected a JSON object', 'body')
+
+        expr = data.get('search_expression')
+        if not isinstance(expr, str):
+            return make_error('missing or invalid', 'search_expression')
+
+        documents = data.get('documents')
+        if not isinstance(documents, list) or not all(isinstance(d, str) for d in documents):
+            return make_error('expected a list of strings', 'documents')
+
+        max_documents = flask.current_app.config.get('CHECKS_STREAM_MAX_DOCUMENTS', 50000)
+        if len(documents) > max_documents:
+            return make_error('more than {} documents'.format(max_documents), 'documents', code=413)
+
+        try:
+            expression = results.parse(expr)
+        except logic.ParserException as e:
+            return make_error({'position': e.token.position, 'error': e.message}, 'search_expression')
+
+        echo = data.get('echo', True)
+
+        def generate():
+            for d in documents:
+                normalized_doc = results.analyze(d)
+                result = {'matched': expression.match(normalized_doc)}
+                if echo:
+                    result['document'] = d
+                    result['normalized_document'] = normalize(normalized_doc)
+
+                yield json.dumps(result) + '\n'
+
+        def generate_offloaded(batch):
+            try:
+                for chunk in batch:
+                    for result in chunk:
+                        if not echo:
+                            result = {'matched': result['matched']}
+
+                        yield json.dumps(result) + '\n'
+            except concurrent.futures.TimeoutError:  # the response is truncated
+                offloader.stats.add(timeouts=1)
+            except concurrent.futures.BrokenExecutor:  # idem
+                offloader.reset(batch.executor)
+            finally:
+                batch.close()
+
+        if offloader.should_offload(len(documents)):
+            try:
+                lines = generate_offloaded(offloader.submit(expression, documents))
+            except OverloadedException:
+                return make_overloaded_error()
+        else:
+            lines = generate()
+
+        return flask.Response(flask.stream_with_context(lines), mimetype='application/x-ndjson')
 
 
 class CheckQuestion(Resource):
@@ -81,13 +209,13 @@ class CheckQuestion(Resource):
         args = self.parser.parse_args()
 
         try:
-            expression = logic.parse(args.get('search_expression', ''))
+            expression = results.parse(args.get('search_expression', ''))
         except logic.ParserException as e:
             return make_error({'position': e.token.position, 'error': e.message}, 'search_expression')
 
         user_challenge = UserChallenge.query \
-            .filter(UserChallenge.user.is_(args.get('user'))) \
-            .filter(UserChallenge.challenge.is_(args.get('challenge'))) \
+            .filter(UserChallenge.user == args.get('user')) \
+            .filter(UserChallenge.challenge == args.get('challenge')) \
             .first()
 
         if user_challenge is None:
@@ -99,43 +227,58 @@ class CheckQuestion(Resource):
         if user_challenge.is_done:
             return make_error('challenge done!', 'challenge')
 
-        question = Question.query.get(user_challenge.current_question)
-        documents = question.get_documents()
+        # the question and its documents come from the cache
+        question = content.get_question(user_challenge.current_question)
+        documents = content.get_documents(question.id)
 
-        good_documents = question.get_good_documents()
-        wrong_documents = question.get_wrong_documents()
+        documents = [d for d in documents if d.is_good] + [d for d in documents if not d.is_good]
+        good_documents = [d.content for d in documents if d.is_good]
+        wrong_documents = [d.content for d in documents if not d.is_good]
 
+        # the same (or an equivalent) answer was probably already given by another user
         good_docs = []
         wrong_docs = []
-        for d in documents:
-            if expression.match(logic.analyze(d)):
-                good_docs.append(d)
+        for d, matched in zip(documents, results.grade(question.id, expression, documents)):
+            if matched:
+                good_docs.append(d.content)
             else:
-                wrong_docs.append(d)
+                wrong_docs.append(d.content)
 
         end = good_docs == good_documents and wrong_docs == wrong_documents
         challenge_end = False
 
-        if end:
-            challenge = Challenge.query.get(user_challenge.challenge)
-            questions = challenge.get_questions()
-            index = [q.id for q in questions].index(question.id)
-
-            if index < 0:
-                return make_error('say what? question is not part of the challenge?!?', 'question')
-            if index == len(questions) - 1:
-                user_challenge.is_done = True
-                challenge_end = True
-            else:
-                user_challenge.current_question = questions[index + 1].id
-
-            db.session.add(user_challenge)
-            db.session.add(Answer(args.get('user'), question.id, args.get('search_expression')))
-            db.session.commit()
+        # time since the question was started
+        started = user_challenge.question_started_at or user_challenge.date_created
+        duration = (datetime.datetime.utcnow() - started).total_seconds() if started is not None else None
 
+        if end:
+            question_position, next_question_id = question.position, question.next_question
+            challenge_end = next_question_id is None
+
+            def record_progress():
+                if challenge_end:
+                    user_challenge.is_done = True
+                    stats.record_end(args.get('challenge'), args.get('user'))
+                else:
+                    user_challenge.current_question = next_question_id
+                    user_challenge.question_started_at = db.func.current_timestamp()
+
+                user_challenge.current_position = question_position + 1
+
+            commit_with_retry(record_progress)
+
+        batch_writer.put(Answer, {
+            'user': args.get('user'),
+            'question': question.id,
+            'answer': args.get('search_expression'),
+            'is_correct': end,
+            'duration': duration
+        })
+
+        expected = set(good_documents)
         return {
-            'good_documents': [(d, d in good_documents) for d in good_docs],
-            'wrong_documents': [(d, d in good_documents) for d in wrong_docs],
+            'good_documents': [(d, d in expected) for d in good_docs],
+            'wrong_documents': [(d, d in expected) for d in wrong_docs],
             'question_end': end,
             'challenge_end': challenge_end
         }
@@ -0,0 +1,77 @@
+import gc
+import time
+import logging
+
+from logical_enough import db, logic, profiling, content, results
+
+try:
+    import resource
+except ImportError:  # not on POSIX
+    resource = None
+
+
+logger = logging.getLogger(__name__)
+
+REPORT = {}
+
+
+def max_rss() -> int:
+    """Maximum resident memory of the process so far [KiB] (or 0 if unknown)"""
+
+    if resource is None:
+        return 0
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def warm_up(app) -> dict:
+    """Preload the questions of the public challenges, with their documents analyzed and ``hint_expr`` parsed.
+
+    Everything goes in the (immutable) content and results caches. Then the database connections are closed
+    and the objects are frozen out of the garbage collector, so that with ``gunicorn --preload``, the forked workers
+    share them copy-on-write instead of starting cold.
+
+    Returns a report (also available in the metrics).
+    """
+
+    start_time, start_rss = time.perf_counter(), max_rss()
+    num_challenges = num_questions = num_documents = num_errors = 0
+
+    with app.app_context():
+        for challenge in content.get_public_challenges():
+            num_challenges += 1
+
+            for question in content.get_questions(challenge.id):
+                num_questions += 1
+                try:
+                    results.parse(question.hint_expr)
+                except logic.ParserException as e:  # a broken question must not prevent the app from starting
+                    num_errors += 1
+                    logger.warning('warm-up: invalid hint for question {}: {}'.format(question.id, e.message))
+
+                for document in content.get_documents(question.id):
+                    num_documents += 1
+                    results.analyze(document.content)
+
+        db.session.remove()
+        db.engine.dispose()  # a connection must not be shared with the forked workers
+
+    gc.collect()
+    if hasattr(gc, 'freeze'):  # otherwise the collections write in every object, thus copy them
+        gc.freeze()
+
+    REPORT.update(
+        challenges=num_challenges,
+        questions=num_questions,
+        documents=num_documents,
+        errors=num_errors,
+        duration=time.perf_counter() - start_time,
+        memory=max_rss() - start_rss
+    )
+
+    profiling.register_metrics('warmup', lambda: dict(REPORT))
+    logger.info(
+        'warm-up: {challenges} challenge(s), {questions} question(s) and {documents} document(s) '
+        'in {duration:.3f} s, {memory} KiB ({errors} error(s))'.format(**REPORT))
+
+    return REPORT
@@ -0,0 +1,182 @@
+import os
+import time
+import queue
+import atexit
+import logging
+import threading
+
+from sqlalchemy.exc import IntegrityError
+
+from logical_enough import db, commit_with_retry, profiling
+
+
+logger = logging.getLogger(__name__)
+
+
+class BatchWriter:
+    """Insert rows from a background thread, by batches: everything that is queued within ``BATCH_WRITER_INTERVAL``
+    seconds (or ``BATCH_WRITER_SIZE`` rows) is written in a single transaction.
+
+    The queue is bounded (``BATCH_WRITER_MAX_QUEUE``): if it is full, the row is written synchronously instead.
+    If ``BATCH_WRITER`` is not set, every row is written synchronously.
+
+    Functions can be registered (with ``after_insert()``) to get the rows inserted in a table, within the same
+    transaction.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.queue = None
+        self.thread = None
+        self.pid = None
+        self.lock = threading.Lock()
+        self.hooks = {}
+
+        self.stats = profiling.Counters('queued', 'written', 'batches', 'synchronous', 'failed')
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions['batch_writer'] = self
+        profiling.register_metrics('batch_writer', self.stats.to_dict)
+
+    @property
+    def enabled(self):
+        return self.app.config.get('BATCH_WRITER', False)
+
+    def after_insert(self, model, func) -> None:
+        """Call ``func(rows)`` each time rows are inserted in the table of ``model``"""
+
+        hooks = self.hooks.setdefault(model.__table__, [])
+        if func not in hooks:
+            hooks.append(func)
+
+    def _insert(self, tables: dict) -> None:
+        """Insert the rows of each table, then call the hooks"""
+
+        for table, rows in tables.items():
+            db.session.execute(table.insert(), rows)
+            for func in self.hooks.get(table, []):
+                func(rows)
+
+    def _ensure_started(self):
+        """(Re)start the thread, which does not survive a fork"""
+
+        with self.lock:
+            if self.pid == os.getpid() and self.thread.is_alive():
+                return
+
+            self.queue = queue.Queue(maxsize=self.app.config.get('BATCH_WRITER_MAX_QUEUE', 10000))
+            self.thread = threading.Thread(target=self._run, name='batch-writer', daemon=True)
+            self.thread.start()
+
+            if self.pid is None:
+                atexit.register(self.stop)
+
+            self.pid = os.getpid()
+
+    def put(self, model, row: dict) -> None:
+        """Insert ``row`` in the table of ``model``"""
+
+        if self.enabled:
+            self._ensure_started()
+            try:
+                self.queue.put_nowait((model.__table__, row))
+                self.stats.add(queued=1)
+                return
+            except queue.Full:
+                pass
+
+        commit_with_retry(lambda: self._insert({model.__table__: [row]}))
+        self.stats.add(synchronous=1)
+
+    def flush(self, timeout: float = None) -> bool:
+        """Wait until everything that was queued so far is written"""
+
+        if self.thread is None or self.pid != os.getpid() or not self.thread.is_alive():
+            return True
+
+        done = threading.Event()
+        self.queue.put((None, done))
+        return done.wait(timeout)
+
+    def stop(self, timeout: float = 5) -> None:
+        """Write what remains, then stop the thread"""
+
+        if self.thread is None or self.pid != os.getpid() or not self.thread.is_alive():
+            return
+
+        self.queue.put((None, None))
+        self.thread.join(timeout)
+
+    def _write(self, batch):
+        if not batch:
+            return
+
+        tables = {}
+        for table, row in batch:
+            tables.setdefault(table, []).append(row)
+
+        with self.app.app_context():
+            try:
+                commit_with_retry(lambda: self._insert(tables))
+                self.stats.add(written=len(batch), batches=1)
+            except IntegrityError:  # e.g. an answer to a question which was just deleted: only drop the bad rows
+                db.session.rollback()
+                self._write_one_by_one(batch)
+            except Exception:
+                db.session.rollback()
+                self.stats.add(failed=len(batch))
+                logger.exception('unable to write a batch of {} row(s)'.format(len(batch)))
+
+    def _write_one_by_one(self, batch):
+        for table, row in batch:
+            try:
+                commit_with_retry(lambda: self._insert({table: [row]}))
+                self.stats.add(written=1)
+            except Exception:
+                db.session.rollback()
+                self.stats.add(failed=1)
+                logger.exception('unable to write a row in {}: {}'.format(table.name, row))
+
+        self.stats.add(batches=1)
+
+    def _run(self):
+        while True:
+            batch = []
+            events = []
+            stop = False
+
+            item = self.queue.get()
+            deadline = time.monotonic() + self.app.config.get('BATCH_WRITER_INTERVAL', .05)
+            batch_size = self.app.config.get('BATCH_WRITER_SIZE', 100)
+
+            while True:
+                table, payload = item
+                if table is not None:
+                    batch.append(item)
+                elif payload is None:  # stop
+                    stop = True
+                else:  # flush
+                    events.append(payload)
+
+                if stop or events or len(batch) >= batch_size:
+                    break
+
+                try:
+                    item = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+
+            self._write(batch)
+
+            for event in events:
+                event.set()
+
+            if stop:
+                return
+
+
+batch_writer = BatchWriter()
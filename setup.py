@@ -49,19 +49,18 @@ setup(
         # Specify the Python versions:
         'Framework :: Flask'
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
         'Programming Language :: Python :: 3.7',
     ],
 
 
     packages=find_packages(),
-    python_requires='>=3.5',
+    python_requires='>=3.7',
 
     # requirements
     install_requires=requirements,
 
     extras_require={  # Optional
         'dev': requirements_dev,
+        'yaml': ['PyYAML'],
     },
 )